@@ -41,8 +41,11 @@ class InstantiateModel(Instruction):
         super(InstantiateModel, self).__init__(*args)
 
     @classmethod
-    def execute(cls, vm, model_instance, attrs):
-        pass
+    def execute(cls, vm, model_class, attrs):
+        # the instance is already on the heap when it was just built, but not when the instruction is replayed
+        if vm.heap.get(model_class._vmattrs['_id'].attr_name(id=attrs['id'])) is None:
+            model_class._restore(vm, attrs)
+        vm.heap.instances.add(model_class.__name__, attrs['id'])
 
 
 class DestroyInstance(Instruction):
@@ -62,7 +65,25 @@ class DestroyInstance(Instruction):
 
         for name, attr in model_class._vmattrs.items():
             attr._destroy(id=model_id, vm=vm)
+        vm.heap.instances.discard(model_class.__name__, model_id)
+
 
+class CollapseHeap(Instruction):
+    # COLLAPSE keep
+    # merges all but the last `keep` checkpoints of the Heap, saving memory and access time,
+    # but making undo of the merged commits impossible.
+    opcode = 5
+    mnemonic = 'VM_COLLAPSE'
+    n_args = 1
+    arg_types = (int,)
 
-#TODO: implement CollapseHeap, an instruction which collapses all treects in the Heap, saving memory and access time,
-#TODO: but making commit undo impossible.
+    @classmethod
+    def execute(cls, vm, keep):
+        # the layers of the running transaction and of its savepoints are never merged, so the workspace can still
+        # be rolled back
+        depth = vm.heap.depth()
+        vm.heap.collapse(max(keep, 1 + len(vm.savepoints)))
+        # the savepoints keep pointing at their own checkpoints, which moved down
+        merged = depth - vm.heap.depth()
+        for savepoint in vm.savepoints:
+            savepoint.depth -= merged
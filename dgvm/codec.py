@@ -0,0 +1,364 @@
+# coding: utf-8
+__author__ = 'salvia'
+
+import struct
+
+from .data_structures import Heap_Nothing
+from .datamodel import Datamodel, ntuple
+from .datamodel.meta import DatamodelMeta
+
+
+class CodecError(Exception):
+    pass
+
+
+# first byte of every encoded instruction list. JSON dumps start with '[', so both can share a commit log
+MARKER = b'\x00'
+
+_DOUBLE = struct.Struct('>d')
+
+# tags of the values encoded without a type given by the instruction's arg_types
+_NONE, _FALSE, _TRUE, _INT, _FLOAT, _STR, _LIST, _DICT, _MODEL, _MODEL_CLASS = range(10)
+# tags only found in deltas, whose heap values must come back with their exact type
+_TUPLE, _NTUPLE, _NOTHING = range(10, 13)
+
+
+def _write_varint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _read_varint(data, pos):
+    b = data[pos]
+    if b < 0x80:
+        return b, pos + 1
+    n = b & 0x7f
+    shift = 7
+    while True:
+        pos += 1
+        b = data[pos]
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos + 1
+        shift += 7
+
+
+def _write_int(out, n):
+    # zigzag, so small negative numbers stay small
+    _write_varint(out, n << 1 if n >= 0 else ((-n) << 1) - 1)
+
+
+def _read_int(data, pos):
+    n, pos = _read_varint(data, pos)
+    return (n >> 1) if not n & 1 else -((n + 1) >> 1), pos
+
+
+class BinaryCodec(object):
+    """
+        Compact binary encoding of instructions: the varint opcode of each one followed by its arguments, packed by
+        their type in the instruction's arg_types. int arguments are zigzag varints, float ones 8 byte doubles, str
+        ones a varint length and utf-8, and model instances the index of their model plus a varint id. Arguments of
+        any other type are tagged with their own type, which covers the dicts and lists of InstantiateModel.
+        Models are numbered in name order, so both ends of an encoding must load the same definitions package.
+        Values decode exactly like they do from the JSON mnemonic form: tuples become lists.
+    """
+
+    def __init__(self, vm):
+        self.vm = vm
+        self.models = sorted(vm.datamodels_idx.values(), key=lambda m: m.__name__)
+        # by name, as the models may be imported under more than one module path
+        self.model_index = {m.__name__: i for i, m in enumerate(self.models)}
+        # instruction class -> arg_types the argument codecs were made for, encoders, decoders
+        self._arg_codecs = {}
+
+    def _arg_codec(self, cls):
+        arg_types = cls.arg_types
+        cached = self._arg_codecs.get(cls)
+        if cached is not None and cached[0] is arg_types:
+            return cached
+        encoders, decoders = [], []
+        for t in arg_types:
+            if t is int:
+                encoders.append(_write_int)
+                decoders.append(self._read_int)
+            elif t is float:
+                encoders.append(self._write_float)
+                decoders.append(self._read_float)
+            elif t is str:
+                encoders.append(self._write_str)
+                decoders.append(self._read_str)
+            elif isinstance(t, type) and issubclass(t, Datamodel):
+                encoders.append(self._write_model)
+                decoders.append(self._read_model)
+            else:
+                encoders.append(self._write_value)
+                decoders.append(self._read_value)
+        cached = self._arg_codecs[cls] = (arg_types, encoders, decoders)
+        return cached
+
+    # -----
+
+    @staticmethod
+    def _read_int(data, pos, resolve):
+        return _read_int(data, pos)
+
+    @staticmethod
+    def _write_float(out, value):
+        out += _DOUBLE.pack(value)
+
+    @staticmethod
+    def _read_float(data, pos, resolve):
+        return _DOUBLE.unpack_from(data, pos)[0], pos + 8
+
+    @staticmethod
+    def _write_str(out, value):
+        b = value.encode('utf-8')
+        _write_varint(out, len(b))
+        out += b
+
+    @staticmethod
+    def _read_str(data, pos, resolve):
+        n, pos = _read_varint(data, pos)
+        return bytes(data[pos:pos + n]).decode('utf-8'), pos + n
+
+    def _write_model(self, out, value):
+        _write_varint(out, self.model_index[type(value).__name__])
+        _write_int(out, value.id)
+
+    def _read_model(self, data, pos, resolve):
+        i, pos = _read_varint(data, pos)
+        id, pos = _read_int(data, pos)
+        return resolve(self.models[i], id), pos
+
+    def _write_value(self, out, value):
+        if value is None:
+            out.append(_NONE)
+        elif value is False:
+            out.append(_FALSE)
+        elif value is True:
+            out.append(_TRUE)
+        elif isinstance(value, int):
+            out.append(_INT)
+            _write_int(out, value)
+        elif isinstance(value, float):
+            out.append(_FLOAT)
+            out += _DOUBLE.pack(value)
+        elif isinstance(value, str):
+            out.append(_STR)
+            self._write_str(out, value)
+        elif isinstance(value, (list, tuple, ntuple)):
+            value = list(value)
+            out.append(_LIST)
+            _write_varint(out, len(value))
+            for v in value:
+                self._write_value(out, v)
+        elif isinstance(value, dict):
+            out.append(_DICT)
+            _write_varint(out, len(value))
+            for k, v in value.items():
+                self._write_value(out, k)
+                self._write_value(out, v)
+        elif isinstance(value, Datamodel):
+            out.append(_MODEL)
+            self._write_model(out, value)
+        elif isinstance(value, DatamodelMeta):
+            out.append(_MODEL_CLASS)
+            _write_varint(out, self.model_index[value.__name__])
+        else:
+            raise CodecError('Cannot encode %r' % (value, ))
+
+    def _read_value(self, data, pos, resolve):
+        tag = data[pos]
+        pos += 1
+        if tag == _NONE:
+            return None, pos
+        if tag == _FALSE:
+            return False, pos
+        if tag == _TRUE:
+            return True, pos
+        if tag == _INT:
+            return _read_int(data, pos)
+        if tag == _FLOAT:
+            return self._read_float(data, pos, resolve)
+        if tag == _STR:
+            return self._read_str(data, pos, resolve)
+        if tag == _LIST:
+            n, pos = _read_varint(data, pos)
+            items = []
+            for _ in range(n):
+                v, pos = self._read_value(data, pos, resolve)
+                items.append(v)
+            return items, pos
+        if tag == _DICT:
+            n, pos = _read_varint(data, pos)
+            d = {}
+            for _ in range(n):
+                k, pos = self._read_value(data, pos, resolve)
+                d[k], pos = self._read_value(data, pos, resolve)
+            return d, pos
+        if tag == _MODEL:
+            return self._read_model(data, pos, resolve)
+        if tag == _MODEL_CLASS:
+            i, pos = _read_varint(data, pos)
+            return self.models[i], pos
+        raise CodecError('Unknown value tag %i' % (tag, ))
+
+    # -----
+
+    def encode(self, instructions):
+        """
+            Encodes a sequence of instructions, e.g. a Commit.
+        """
+        out = bytearray(MARKER)
+        _write_varint(out, len(instructions))
+        for instruction in instructions:
+            _write_varint(out, instruction.opcode)
+            for encode, arg in zip(self._arg_codec(type(instruction))[1], instruction.args):
+                encode(out, arg)
+        return bytes(out)
+
+    def decode(self, data, resolve=None):
+        """
+            Returns the (instruction class, arguments) pairs encoded in data. Model instances are made by
+            resolve(model class, id), which defaults to model.get_by_id(vm, id).
+        """
+        if data[:1] != MARKER:
+            raise CodecError('Not a binary encoding')
+        if resolve is None:
+            vm = self.vm
+            resolve = lambda model, id: model.get_by_id(vm, id)
+        opcodes = self.vm.instructions['opcodes']
+        n, pos = _read_varint(data, 1)
+        decoded = []
+        try:
+            for _ in range(n):
+                opcode, pos = _read_varint(data, pos)
+                cls = opcodes[opcode]
+                args = []
+                for decode in self._arg_codec(cls)[2]:
+                    arg, pos = decode(data, pos, resolve)
+                    args.append(arg)
+                decoded.append((cls, tuple(args)))
+        except (IndexError, KeyError, struct.error) as e:
+            raise CodecError('Invalid binary encoding: %r' % (e, ))
+        if pos != len(data):
+            raise CodecError('Trailing bytes after %i instructions' % (n, ))
+        return decoded
+
+    def loads(self, data):
+        """
+            Decodes instructions encoded with encode().
+        """
+        return [cls(*args) for cls, args in self.decode(data)]
+
+
+def encode_delta(delta):
+    """
+        Encodes the delta of a commit, its (addresses, values) as taken from the heap's ChangeLog. Unlike instruction
+        arguments, the values decode to their exact type: ntuples, tuples and Heap_Nothing (a deleted address) are
+        kept. The heap holds no model instances, only their ids, so no VM is needed on either end.
+    """
+    addresses, values = delta
+    out = bytearray(MARKER)
+    _write_varint(out, len(addresses))
+    for address, value in zip(addresses, values):
+        _write_heap_value(out, address)
+        _write_heap_value(out, value)
+    return bytes(out)
+
+
+def decode_delta(data):
+    """
+        Returns the (addresses, values) encoded by encode_delta().
+    """
+    if data[:1] != MARKER:
+        raise CodecError('Not a binary encoding')
+    try:
+        n, pos = _read_varint(data, 1)
+        addresses, values = [], []
+        for _ in range(n):
+            address, pos = _read_heap_value(data, pos)
+            value, pos = _read_heap_value(data, pos)
+            addresses.append(address)
+            values.append(value)
+    except (IndexError, struct.error) as e:
+        raise CodecError('Invalid delta encoding: %r' % (e, ))
+    if pos != len(data):
+        raise CodecError('Trailing bytes after %i delta entries' % (n, ))
+    return tuple(addresses), tuple(values)
+
+
+def _write_heap_value(out, value):
+    if value is None:
+        out.append(_NONE)
+    elif value is False:
+        out.append(_FALSE)
+    elif value is True:
+        out.append(_TRUE)
+    elif isinstance(value, int):
+        out.append(_INT)
+        _write_int(out, value)
+    elif isinstance(value, float):
+        out.append(_FLOAT)
+        out += _DOUBLE.pack(value)
+    elif isinstance(value, str):
+        out.append(_STR)
+        BinaryCodec._write_str(out, value)
+    elif value is Heap_Nothing:
+        out.append(_NOTHING)
+    elif isinstance(value, (list, tuple, ntuple)):
+        if isinstance(value, ntuple):
+            out.append(_NTUPLE)
+        else:
+            out.append(_LIST if isinstance(value, list) else _TUPLE)
+        _write_varint(out, len(value))
+        for v in value:
+            _write_heap_value(out, v)
+    elif isinstance(value, dict):
+        out.append(_DICT)
+        _write_varint(out, len(value))
+        for k, v in value.items():
+            _write_heap_value(out, k)
+            _write_heap_value(out, v)
+    else:
+        raise CodecError('Cannot encode heap value %r' % (value, ))
+
+
+def _read_heap_value(data, pos):
+    tag = data[pos]
+    pos += 1
+    if tag == _NONE:
+        return None, pos
+    if tag == _FALSE:
+        return False, pos
+    if tag == _TRUE:
+        return True, pos
+    if tag == _INT:
+        return _read_int(data, pos)
+    if tag == _FLOAT:
+        return _DOUBLE.unpack_from(data, pos)[0], pos + 8
+    if tag == _STR:
+        return BinaryCodec._read_str(data, pos, None)
+    if tag == _NOTHING:
+        return Heap_Nothing, pos
+    if tag in (_LIST, _TUPLE, _NTUPLE):
+        n, pos = _read_varint(data, pos)
+        items = []
+        for _ in range(n):
+            v, pos = _read_heap_value(data, pos)
+            items.append(v)
+        if tag == _TUPLE:
+            return tuple(items), pos
+        if tag == _NTUPLE:
+            return ntuple(n, items), pos
+        return items, pos
+    if tag == _DICT:
+        n, pos = _read_varint(data, pos)
+        d = {}
+        for _ in range(n):
+            k, pos = _read_heap_value(data, pos)
+            d[k], pos = _read_heap_value(data, pos)
+        return d, pos
+    raise CodecError('Unknown value tag %i' % (tag, ))
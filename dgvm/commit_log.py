@@ -0,0 +1,282 @@
+# coding: utf-8
+__author__ = 'salvia'
+
+import os
+import struct
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+
+
+class CorruptLogError(Exception):
+    pass
+
+
+# record header: payload length and crc32 of the payload
+_HEADER = struct.Struct('>II')
+_SEGMENT_SUFFIX = '.log'
+
+
+class CommitLog(object):
+    """
+        Append-only log of byte records, kept in segment files inside `path`. Each record is the payload length and
+        crc32 followed by the payload. A segment is named after the index of its first record, and a new one is
+        started once the current one grows past `segment_size` bytes.
+
+        Every append reaches the OS before returning. How often the data is fsync'ed to disk is set by
+        `sync_every` (fsync after that many appends, 1 for every append) and/or `sync_interval` (fsync on the
+        first append after that many seconds, and from a timer thread at most that many seconds after an append,
+        so the last appends are synced even if no other one follows). With neither, fsync only happens on sync(),
+        at segment rotation and on close(). Appends between fsyncs share a single one (group commit) and may be lost if the machine
+        crashes, but not if the process does.
+
+        Opening an existing log continues it. A record torn by a crash at the end of the last segment is dropped.
+        The offset of every record in its segment is kept, from the first time the segment is read, so get() and
+        read() go straight to a record.
+    """
+
+    def __init__(self, path, segment_size=64 * 1024 * 1024, sync_every=1, sync_interval=None):
+        if sync_every is not None and sync_every < 1:
+            raise ValueError('sync_every must be >= 1 or None')
+        self.path = path
+        self.segment_size = segment_size
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self._lock = threading.Lock()
+        # first record index of each segment
+        self._segments = []
+        # first record index of a segment -> offsets of its records in the segment file
+        self._offsets = {}
+        self._count = 0
+        self._file = None
+        self._file_size = 0
+        self._unsynced = 0
+        self._last_sync = time.time()
+        # pending timer fsyncing the appends left unsynced, with sync_interval
+        self._timer = None
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._segments = sorted(
+            int(name[:-len(_SEGMENT_SUFFIX)]) for name in os.listdir(path) if name.endswith(_SEGMENT_SUFFIX)
+        )
+        if self._segments:
+            self._recover()
+        else:
+            self._open_segment(0)
+
+    def _segment_path(self, first):
+        return os.path.join(self.path, '%020i%s' % (first, _SEGMENT_SUFFIX))
+
+    def _open_segment(self, first):
+        if not self._segments or self._segments[-1] != first:
+            self._segments.append(first)
+        self._file = open(self._segment_path(first), 'ab')
+        self._file_size = self._file.tell()
+        self._offsets.setdefault(first, array('q'))
+
+    def _recover(self):
+        """
+            Counts the records of the last segment, cutting off a record torn by a crash at its end. A bad record
+            anywhere else is an error.
+        """
+        last = self._segments[-1]
+        segment = self._segment_path(last)
+        end = os.path.getsize(segment)
+        n = 0
+        size = 0
+        offsets = self._offsets[last] = array('q')
+        with open(segment, 'rb') as f:
+            while size < end:
+                header = f.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    break
+                length, crc = _HEADER.unpack(header)
+                if size + _HEADER.size + length > end:
+                    break
+                if zlib.crc32(f.read(length)) != crc:
+                    if size + _HEADER.size + length < end:
+                        raise CorruptLogError('Corrupt record %i in %s' % (last + n, segment))
+                    break
+                offsets.append(size)
+                n += 1
+                size += _HEADER.size + length
+        if size < end:
+            with open(segment, 'r+b') as f:
+                f.truncate(size)
+        self._count = last + n
+        self._open_segment(last)
+
+    def append(self, data):
+        """
+            Appends a record and returns its index.
+        """
+        with self._lock:
+            if self._file_size >= self.segment_size:
+                self._rotate()
+            self._offsets[self._segments[-1]].append(self._file_size)
+            self._file.write(_HEADER.pack(len(data), zlib.crc32(data)))
+            self._file.write(data)
+            self._file.flush()
+            self._file_size += _HEADER.size + len(data)
+            index = self._count
+            self._count += 1
+            self._unsynced += 1
+            if (self.sync_every and self._unsynced >= self.sync_every) or \
+                    (self.sync_interval is not None and time.time() - self._last_sync >= self.sync_interval):
+                self._sync()
+            elif self.sync_interval is not None and self._timer is None:
+                self._timer = threading.Timer(self.sync_interval, self._timed_sync)
+                self._timer.daemon = True
+                self._timer.start()
+            return index
+
+    def _timed_sync(self):
+        with self._lock:
+            self._timer = None
+            if self._file is not None:
+                self._sync()
+
+    def _sync(self):
+        if self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+        self._last_sync = time.time()
+
+    def sync(self):
+        """
+            fsyncs every record appended so far.
+        """
+        with self._lock:
+            self._sync()
+
+    def _rotate(self):
+        self._sync()
+        self._file.close()
+        self._open_segment(self._count)
+
+    def _segment_offsets(self, first):
+        """
+            Offsets of the records of a segment, read from the headers of its records the first time. Must be called
+            with the lock held.
+        """
+        offsets = self._offsets.get(first)
+        if offsets is not None:
+            return offsets
+        i = self._segments.index(first)
+        n = self._segments[i + 1] - first
+        offsets = array('q')
+        with open(self._segment_path(first), 'rb') as f:
+            size = 0
+            while len(offsets) < n:
+                header = f.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    raise CorruptLogError('Missing record %i' % (first + len(offsets), ))
+                offsets.append(size)
+                length = _HEADER.unpack(header)[0]
+                f.seek(length, os.SEEK_CUR)
+                size += _HEADER.size + length
+        self._offsets[first] = offsets
+        return offsets
+
+    def _locate(self, index):
+        # first record index of the segment holding record `index`, and the offset of the record in it
+        first = self._segments[bisect_right(self._segments, index) - 1]
+        return first, self._segment_offsets(first)[index - first]
+
+    @staticmethod
+    def _read_record(f, index):
+        header = f.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            raise CorruptLogError('Missing record %i' % (index, ))
+        length, crc = _HEADER.unpack(header)
+        payload = f.read(length)
+        if len(payload) != length or zlib.crc32(payload) != crc:
+            raise CorruptLogError('Corrupt record %i' % (index, ))
+        return payload
+
+    def get(self, index):
+        """
+            Returns the record at `index`.
+        """
+        with self._lock:
+            if not 0 <= index < self._count:
+                raise IndexError('record index out of range')
+            self._file.flush()
+            first, offset = self._locate(index)
+        with open(self._segment_path(first), 'rb') as f:
+            f.seek(offset)
+            return self._read_record(f, index)
+
+    def read(self, start=0):
+        """
+            Yields the records from index `start` on.
+        """
+        with self._lock:
+            self._file.flush()
+            segments = list(self._segments)
+            count = self._count
+            if start >= count:
+                return
+            first, offset = self._locate(max(start, 0))
+
+        index = max(start, 0)
+        for i in range(segments.index(first), len(segments)):
+            end = segments[i + 1] if i + 1 < len(segments) else count
+            with open(self._segment_path(segments[i]), 'rb') as f:
+                f.seek(offset)
+                while index < end:
+                    yield self._read_record(f, index)
+                    index += 1
+            offset = 0
+
+    def truncate(self, n):
+        """
+            Drops the records from index `n` on, and fsyncs the log.
+        """
+        with self._lock:
+            if not 0 <= n <= self._count:
+                raise ValueError('Cannot truncate a log of %i records to %i' % (self._count, n))
+            if n == self._count:
+                return
+            # the segment left last, found and read while the ones after it still tell where it ends
+            i = max(bisect_left(self._segments, n) - 1, 0)
+            first = self._segments[i]
+            offsets = self._segment_offsets(first)
+            self._file.close()
+            for dropped in self._segments[i + 1:]:
+                os.remove(self._segment_path(dropped))
+                self._offsets.pop(dropped, None)
+            del self._segments[i + 1:]
+            with open(self._segment_path(first), 'r+b') as f:
+                if n - first < len(offsets):
+                    f.truncate(offsets[n - first])
+                    del offsets[n - first:]
+                os.fsync(f.fileno())
+            self._count = n
+            self._unsynced = 0
+            self._open_segment(first)
+
+    def close(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._file is not None:
+                self._sync()
+                self._file.close()
+                self._file = None
+
+    def __iter__(self):
+        return self.read()
+
+    def __len__(self):
+        return self._count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
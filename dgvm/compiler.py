@@ -0,0 +1,140 @@
+# coding: utf-8
+__author__ = 'salvia'
+
+from .datamodel import Datamodel
+from .datamodel.meta import DatamodelStates
+from .instruction import Instruction, MemberInstruction, BadInstructionCall
+
+
+# definitions package -> {instruction class: CompiledInstruction}
+_CACHE = {}
+
+
+class CompiledInstruction(object):
+    """
+        Constructor and executor generated for one instruction class, equivalent to calling the class and then
+        calling the instruction with the vm, but with the argument checks, the model state transitions and the
+        call to execute unrolled for the class' arg_types.
+        `construct(*args)` builds the instruction, `run(vm, instruction)` executes it.
+    """
+
+    def __init__(self, cls, construct, run, source):
+        self.cls = cls
+        self.construct = construct
+        self.run = run
+        # generated python source, for debugging
+        self.source = source
+
+
+def _may_be_model(t):
+    """
+        Whether an argument declared as `t` is always a model, never one, or has to be checked.
+    """
+    if isinstance(t, type):
+        if issubclass(t, Datamodel):
+            return 'always'
+        if issubclass(Datamodel, t):
+            return 'check'
+        return 'never'
+    return 'check'
+
+
+def compile_instruction(cls):
+    """
+        Generates the CompiledInstruction of an instruction class. Classes with their own __init__ keep it as their
+        constructor.
+    """
+    n = cls.n_args
+    arg_types = cls.arg_types
+    names = ['a%i' % (i, ) for i in range(n)]
+    unpack = '%s, = args' % (', '.join(names), ) if n else 'pass'
+    kinds = [_may_be_model(t) for t in arg_types]
+    namespace = {
+        'cls': cls,
+        'new': object.__new__,
+        'Datamodel': Datamodel,
+        'BadInstructionCall': BadInstructionCall,
+        'USER_CHANGING': DatamodelStates.USER_CHANGING,
+        'DESTROYED': DatamodelStates.DESTROYED,
+        'execute': cls.execute,
+    }
+    for i, t in enumerate(arg_types):
+        namespace['t%i' % (i, )] = t
+
+    lines = []
+    generic_init = cls.__init__ in (Instruction.__init__, MemberInstruction.__init__) and len(arg_types) == n
+    if generic_init:
+        model_args = []
+        for name, kind in zip(names, kinds):
+            if kind == 'always':
+                model_args.append('[%s]' % (name, ))
+            elif kind == 'check':
+                model_args.append('([%s] if isinstance(%s, Datamodel) else [])' % (name, name))
+        lines += [
+            'def construct(*args):',
+            '    self = new(cls)',
+            '    if len(args) != %i:' % (n, ),
+            "        raise BadInstructionCall('Wrong number of arguments to ' + str(self))",
+            '    %s' % (unpack, ),
+        ]
+        if n:
+            lines += [
+                '    if %s:' % (' or '.join('not isinstance(a%i, t%i)' % (i, i) for i in range(n)), ),
+                "        raise BadInstructionCall('Wrong type of arguments to ' + str(self))",
+            ]
+        lines += [
+            '    self.args = args',
+            '    self.model_args = %s' % (' + '.join(model_args) if model_args else '[]', ),
+            '    return self',
+            '',
+        ]
+    else:
+        namespace['construct'] = cls
+
+    lines += [
+        'def run(vm, instruction):',
+        '    args = instruction.args',
+    ]
+    if issubclass(cls, MemberInstruction):
+        # the models change state in order, and get their previous state back unless destroyed meanwhile
+        lines += ['    %s' % (unpack, )]
+        models = []
+        for i, (name, kind) in enumerate(zip(names, kinds)):
+            if kind == 'always':
+                lines += ['    s%i = %s._state' % (i, name)]
+                models.append((i, name, None))
+            elif kind == 'check':
+                lines += ['    m%i = isinstance(%s, Datamodel)' % (i, name),
+                          '    s%i = %s._state if m%i else None' % (i, name, i)]
+                models.append((i, name, 'm%i' % (i, )))
+        for i, name, check in models:
+            if check:
+                lines += ['    if %s:' % (check, ), '        %s._state = USER_CHANGING' % (name, )]
+            else:
+                lines += ['    %s._state = USER_CHANGING' % (name, )]
+        lines += ['    try:', '        execute(%s)' % (', '.join(names), ), '    finally:']
+        for i, name, check in models:
+            condition = '%s._state != DESTROYED' % (name, )
+            if check:
+                condition = '%s and %s' % (check, condition)
+            lines += ['        if %s:' % (condition, ), '            %s._state = s%i' % (name, i)]
+        if not models:
+            lines += ['        pass']
+    else:
+        lines += ['    %s' % (unpack, ), '    execute(%s)' % (', '.join(['vm'] + names), )]
+
+    source = '\n'.join(lines) + '\n'
+    exec(compile(source, '<compiled %s>' % (cls.get_name(), ), 'exec'), namespace)
+    return CompiledInstruction(cls, namespace['construct'], namespace['run'], source)
+
+
+def compile_instructions(package, classes):
+    """
+        Returns {instruction class: CompiledInstruction} for `classes`, compiling the ones not yet compiled for the
+        definitions package `package`.
+    """
+    compiled = _CACHE.setdefault(package, {})
+    for cls in classes:
+        if cls not in compiled:
+            compiled[cls] = compile_instruction(cls)
+    return compiled
@@ -1,7 +1,13 @@
+import hashlib
+import itertools
 import threading
+from array import array
 from collections import deque
 
 
+_Treect_Nothing = object()
+
+
 class Treect(object):
 
     def __init__(self, from_dict=None, **kwargs):
@@ -35,6 +41,10 @@ class Treect(object):
     def items(self):
         return self.__d.items()
 
+    @property
+    def _d(self):
+        return self.__d
+
     def __all_items(self, prefix=None):
         if prefix is None:
             prefix = []
@@ -45,9 +55,17 @@ class Treect(object):
             else:
                 yield '/'.join(prefix + [k]), v
 
-    def all_items(self):
+    def all_items(self, prefix=None):
 
-        return self.__all_items()
+        if prefix is None:
+            return self.__all_items()
+
+        v = self.get(prefix, _Treect_Nothing)
+        if isinstance(v, self.__class__):
+            return self.__class__.__all_items(v, str(prefix).split('/'))
+        if v is _Treect_Nothing:
+            return iter(())
+        return iter([(prefix, v)])
 
     def to_dict(self):
 
@@ -177,23 +195,1002 @@ class Treect(object):
         return repr(self.__d)
 
 
+_HASH_MASK = (1 << 128) - 1
+
+
+def _canonical(value):
+    # sequences compare equal whatever their type (Pair values may be tuples, lists or ntuples)
+    if isinstance(value, str):
+        return 's' + repr(value)
+    if isinstance(value, bool) or value is None:
+        return repr(value)
+    if isinstance(value, (int, float)):
+        return 'n' + repr(value)
+    if isinstance(value, (list, tuple)) or (hasattr(value, '__iter__') and hasattr(value, '__len__')
+                                            and not isinstance(value, (bytes, dict))):
+        return '[' + ','.join(_canonical(v) for v in value) + ']'
+    return type(value).__name__ + repr(value)
+
+
+def item_hash(address, value):
+    """
+        Hash of a single (address, value) pair. Unlike hash(), it is the same in every process.
+    """
+    digest = hashlib.blake2b((_canonical(address) + '=' + _canonical(value)).encode('utf-8'), digest_size=16)
+    return int.from_bytes(digest.digest(), 'big')
+
+
+def merkle_diff(children_a, children_b, prefix=None):
+    """
+        Yields the addresses whose values differ between two hashed trees, given for each tree a function which
+        returns the {key: (hash, is_node)} children of a prefix (see HashedTreect.children). Only descends into
+        the subtrees whose hashes differ, so the functions may well be remote calls.
+    """
+    a = children_a(prefix)
+    b = children_b(prefix)
+    for k in list(a) + [k for k in b if k not in a]:
+        ea = a.get(k)
+        eb = b.get(k)
+        if ea == eb:
+            continue
+        address = k if prefix is None else '%s/%s' % (prefix, k)
+        node_a = ea is not None and ea[1]
+        node_b = eb is not None and eb[1]
+        # a value changed, appeared or disappeared
+        if (ea is not None and not node_a) or (eb is not None and not node_b):
+            yield address
+        if node_a or node_b:
+            for d in merkle_diff(children_a if node_a else _no_children, children_b if node_b else _no_children,
+                                 address):
+                yield d
+
+
+def _no_children(prefix):
+    return {}
+
+
+class HashedTreect(Treect):
+    """
+        Treect whose every node keeps `hash`, the sum (mod 2**128) of item_hash(address, value) over the values
+        under it, updated on each set and delete. Equal hashes mean equal contents (barring a 2**-128 collision),
+        so __eq__ costs O(1) and diff() only walks the subtrees whose hashes differ. Empty nodes hash to 0, so they
+        don't count. Nodes must only be changed through the HashedTreect methods.
+
+        copy() shares every node with the copy. A node is then copied by the first write going through it, from
+        either tree, so a write copies at most one node per level.
+    """
+
+    def __init__(self, from_dict=None, **kwargs):
+        self.hash = 0
+        # address of this node in the root tree
+        self._prefix = None
+        # the nodes a root changes in place have the root's owner, the others may be shared with a copy
+        self._owner = object()
+        super(HashedTreect, self).__init__(from_dict, **kwargs)
+
+    def _address(self, key):
+        return key if self._prefix is None else '%s/%s' % (self._prefix, key)
+
+    def _path(self, key, create):
+        """
+            Returns the nodes from this one down to the one holding `key`, and the key inside that node.
+        """
+        if not isinstance(key, str):
+            return [self], key
+        keys = key.split('/')
+        nodes = [self]
+        node = self
+        owner = self._owner
+        for k in keys[:-1]:
+            child = node._d.get(k, _Treect_Nothing)
+            if child is _Treect_Nothing and create:
+                child = HashedTreect()
+                child._prefix = node._address(k)
+                child._owner = owner
+                node._d[k] = child
+            elif not isinstance(child, HashedTreect):
+                raise KeyError(key)
+            elif child._owner is not owner:
+                child = node._d[k] = child._own(owner)
+            nodes.append(child)
+            node = child
+        return nodes, keys[-1]
+
+    @staticmethod
+    def _contribution(address, value):
+        if isinstance(value, HashedTreect):
+            return value.hash
+        return item_hash(address, value)
+
+    def _update(self, nodes, delta):
+        for node in nodes:
+            node.hash = (node.hash + delta) & _HASH_MASK
+
+    def __setitem__(self, key, value):
+        if isinstance(value, Treect):
+            # the values of the subtree are rehashed under their new addresses
+            if key in self:
+                del self[key]
+            nodes, k = self._path(key, True)
+            child = HashedTreect()
+            child._prefix = nodes[-1]._address(k)
+            child._owner = self._owner
+            nodes[-1]._d[k] = child
+            for k2, v in value.all_items():
+                child[k2] = v
+            self._update(nodes, child.hash)
+            return
+        nodes, k = self._path(key, True)
+        node = nodes[-1]
+        address = node._address(k)
+        delta = item_hash(address, value)
+        old = node._d.get(k, _Treect_Nothing)
+        if old is not _Treect_Nothing:
+            delta -= self._contribution(address, old)
+        node._d[k] = value
+        self._update(nodes, delta)
+
+    def __delitem__(self, key):
+        nodes, k = self._path(key, False)
+        node = nodes[-1]
+        old = node._d.pop(k)
+        self._update(nodes, -self._contribution(node._address(k), old))
+
+    def delete(self, item):
+        del self[item]
+
+    def children(self, prefix=None):
+        """
+            Returns {key: (hash, is_node)} for the children of the node at `prefix` (this one if None).
+        """
+        node = self if prefix is None else self.get(prefix)
+        if not isinstance(node, HashedTreect):
+            return {}
+        return {
+            k: (v.hash, True) if isinstance(v, HashedTreect) else (item_hash(node._address(k), v), False)
+            for k, v in node.items()
+        }
+
+    def diff(self, other):
+        """
+            Returns the addresses whose values differ between this tree and `other`.
+        """
+        return list(merkle_diff(self.children, other.children))
+
+    def _own(self, owner):
+        # shallow copy of the node, its children still shared
+        t = HashedTreect()
+        t.hash = self.hash
+        t._prefix = self._prefix
+        t._owner = owner
+        t._d.update(self._d)
+        return t
+
+    def copy(self):
+        """
+            Returns a copy of the tree, in O(number of children of the root): both trees share the nodes below,
+            until written.
+        """
+        t = self._own(object())
+        # the nodes below are shared now, so this tree copies them before writing too
+        self._owner = object()
+        return t
+
+    def __eq__(self, other):
+        if isinstance(other, HashedTreect):
+            return self.hash == other.hash
+        return super(HashedTreect, self).__eq__(other)
+
+    def __ne__(self, other):
+        if isinstance(other, HashedTreect):
+            return self.hash != other.hash
+        return super(HashedTreect, self).__ne__(other)
+
+
+class FlatLayer(dict):
+    """
+        A single flat hash keyed by the full address (e.g. 'Infantry/O/3/health'), used as a Heap layer.
+        Reads and writes never split the address. A prefix index (prefix -> set of child prefixes) is built
+        lazily, on the first subtree query, and kept up to date afterwards, so layers which are never queried
+        by prefix never pay for it.
+    """
+
+    def __init__(self, from_dict=None, **kwargs):
+        super(FlatLayer, self).__init__()
+        self._index = None
+
+        if from_dict:
+            for k, v in Treect(from_dict).all_items():
+                self[k] = v
+
+        for k, v in kwargs.items():
+            self[k.replace('__', '/')] = v
+
+    def set(self, key, val):
+        self[key] = val
+
+    def delete(self, item):
+        del self[item]
+
+    def __setitem__(self, key, value):
+        if self._index is not None and key not in self:
+            self._index_add(key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        if self._index is not None:
+            self._index_remove(key)
+
+    @staticmethod
+    def _prefixes(key):
+        """
+            Yields (parent, child) pairs for every level of `key`. Non string keys live at the root.
+        """
+        if not isinstance(key, str):
+            yield '', key
+            return
+        parent = ''
+        pos = key.find('/')
+        while pos != -1:
+            child = key[:pos]
+            yield parent, child
+            parent = child
+            pos = key.find('/', pos + 1)
+        yield parent, key
+
+    def _index_add(self, key):
+        for parent, child in self._prefixes(key):
+            children = self._index.get(parent)
+            if children is None:
+                children = self._index[parent] = set()
+            children.add(child)
+
+    def _index_remove(self, key):
+        for parent, child in reversed(list(self._prefixes(key))):
+            # a prefix stays in its parent while it still has children of its own, or is itself a key
+            if self._index.get(child) or child in self:
+                break
+            children = self._index[parent]
+            children.discard(child)
+            if children:
+                break
+            del self._index[parent]
+
+    def _build_index(self):
+        self._index = {}
+        for key in self:
+            self._index_add(key)
+
+    def all_items(self, prefix=None):
+        """
+            Yields (address, value) for every address in this layer, or only for those under `prefix`.
+        """
+        if prefix is None:
+            for item in self.items():
+                yield item
+            return
+
+        if self._index is None:
+            self._build_index()
+
+        stack = [prefix]
+        while stack:
+            p = stack.pop()
+            if p in self:
+                yield p, dict.__getitem__(self, p)
+            stack.extend(self._index.get(p, ()))
+
+    def to_dict(self):
+        t = Treect()
+        for k, v in self.items():
+            t[k] = v
+        return t.to_dict()
+
+    def dump(self):
+        print()
+        for k, v in self.all_items():
+            print('%s%s%s' % (k, ((80 - len(str(k))) * ' '), v))
+        print()
+
+    @classmethod
+    def from_dict(cls, from_dict):
+        return cls(from_dict)
+
+
 class _Heap_DeletedObj(object):
 
     def __str__(self):
         return 'Heap_DeletedObj'
 
+    def __reduce__(self):
+        # unpickles to the same sentinel
+        return 'Heap_Nothing' if self is Heap_Nothing else 'Heap_DeletedObj'
+
 
 Heap_DeletedObj = _Heap_DeletedObj()
 Heap_Nothing = _Heap_DeletedObj()
 
 
-class Heap(object):
+class Column(object):
+    """
+        Array backed storage of one scalar attribute of a model, indexed by instance id. `states` tells, for each
+        id, whether the cell is empty (0), holds a value (1) or holds None (2).
+    """
+
+    EMPTY = 0
+    VALUE = 1
+    NONE = 2
+
+    def __init__(self, model_name, attr_name, typecode, cast):
+        self.model_name = model_name
+        self.attr_name = attr_name
+        self.key = model_name + '/' + attr_name
+        self.typecode = typecode
+        self.cast = cast
+        self.values = array(typecode)
+        self.states = bytearray()
+
+    def address(self, id):
+        return '%s/O/%i/%s' % (self.model_name, id, self.attr_name)
+
+    def cell(self, id):
+        """
+            Returns the (state, value) pair of a cell.
+        """
+        if id < len(self.states):
+            return self.states[id], self.values[id]
+        return Column.EMPTY, 0
+
+    def get(self, id):
+        if id < len(self.states):
+            state = self.states[id]
+            if state == Column.VALUE:
+                return self.cast(self.values[id])
+            if state == Column.NONE:
+                return None
+        raise KeyError(self.address(id))
+
+    def put(self, id, state, value):
+        if id >= len(self.states):
+            grow = id + 1 - len(self.states)
+            self.states.extend(bytes(grow))
+            self.values.extend(array(self.typecode, bytes(grow * self.values.itemsize)))
+        self.states[id] = state
+        self.values[id] = value
+
+    def items(self):
+        for id, state in enumerate(self.states):
+            if state == Column.VALUE:
+                yield self.address(id), self.cast(self.values[id])
+            elif state == Column.NONE:
+                yield self.address(id), None
+
+    def copy(self):
+        c = Column(self.model_name, self.attr_name, self.typecode, self.cast)
+        c.values = array(self.typecode, self.values)
+        c.states = bytearray(self.states)
+        return c
+
+
+class ColumnUndo(object):
+    """
+        Cells of one column overwritten during one checkpoint, packed in arrays like the column itself.
+    """
+
+    def __init__(self, column):
+        self.key = column.key
+        self.ids = array('q')
+        self.states = bytearray()
+        self.values = array(column.typecode)
+
+    def append(self, id, state, value):
+        self.ids.append(id)
+        self.states.append(state)
+        self.values.append(value)
+
+
+class ColumnStore(object):
+    """
+        Columns of every columnar model of a heap, keyed by '<model>/<attribute>'. Overwritten cells are recorded
+        in the heap journal (one ColumnUndo per column and checkpoint), so columns follow checkpoint, revert and
+        collapse like the rest of the heap.
+    """
+
+    name = 'columns'
+
+    def __init__(self, heap):
+        self.heap = heap
+        self.columns = {}
+        # number of non-empty cells
+        self.live = 0
+        # column key -> (journal level, ColumnUndo) of the last checkpoint which wrote to the column
+        self._undo = {}
+
+    def column(self, model_name, attr_name, typecode, cast):
+        key = model_name + '/' + attr_name
+        c = self.columns.get(key)
+        if c is None:
+            c = self.columns[key] = Column(model_name, attr_name, typecode, cast)
+        return c
+
+    def _save(self, column, id, state, value):
+        journal = self.heap._journal
+        if len(journal) == 1:
+            return
+        undo = self._undo.get(column.key)
+        if undo is None or undo[0] is not journal[-1]:
+            undo = (journal[-1], ColumnUndo(column))
+            self._undo[column.key] = undo
+            self.heap.record(self.name, 'restore', (undo[1], ))
+        undo[1].append(id, state, value)
+
+    def set(self, column, id, value):
+        state = Column.NONE if value is None else Column.VALUE
+        with self.heap._lock:
+            if self.heap.changes is not None:
+                self.heap.changes.before_cell(column, id)
+            old_state, old_value = column.cell(id)
+            column.put(id, state, 0 if value is None else value)
+            if old_state == Column.EMPTY:
+                self.live += 1
+            self._save(column, id, old_state, old_value)
+            if self.heap.merkle is not None:
+                self.heap.merkle.set(column.address(id), column.get(id))
+
+    def delete(self, column, id):
+        with self.heap._lock:
+            old_state, old_value = column.cell(id)
+            if old_state == Column.EMPTY:
+                return
+            if self.heap.changes is not None:
+                self.heap.changes.before_cell(column, id)
+            column.put(id, Column.EMPTY, 0)
+            self.live -= 1
+            self._save(column, id, old_state, old_value)
+            if self.heap.merkle is not None:
+                self.heap.merkle.delete(column.address(id))
+
+    def restore(self, undo):
+        column = self.columns[undo.key]
+        for i in range(len(undo.ids) - 1, -1, -1):
+            id = undo.ids[i]
+            state = undo.states[i]
+            if column.cell(id)[0] == Column.EMPTY:
+                self.live += 1
+            if state == Column.EMPTY:
+                self.live -= 1
+            column.put(id, state, undo.values[i])
+
+    def all_items(self, prefix=None):
+        for column in list(self.columns.values()):
+            if prefix is None:
+                items = column.items()
+            else:
+                root = column.model_name + '/O'
+                sub = str(prefix) + '/'
+                if root == prefix or root.startswith(sub):
+                    items = column.items()
+                elif sub.startswith(root + '/'):
+                    items = ((k, v) for k, v in column.items() if k == prefix or k.startswith(sub))
+                else:
+                    continue
+            for item in items:
+                yield item
+
+    def fork(self, heap):
+        store = ColumnStore(heap)
+        store.columns = {k: c.copy() for k, c in self.columns.items()}
+        store.live = self.live
+        return store
+
+
+class InstanceIndex(object):
+    """
+        Ids of the live instances of each model. Kept by the InstantiateModel and DestroyInstance instructions.
+        Changes are journaled in the heap, so the index follows checkpoints, reverts and collapses like the rest of
+        it. The ids of each model are a PersistentMap, which forks share.
+    """
+
+    name = 'instances'
+
+    def __init__(self, heap):
+        self.heap = heap
+        # model name -> PersistentMap of id -> None
+        self.models = {}
+
+    def add(self, model_name, id):
+        with self.heap._lock:
+            ids = self.models.get(model_name, _EMPTY_IDS)
+            if id in ids:
+                return
+            self.models[model_name] = ids.set(id, None)
+            self.heap.record(self.name, 'undo', (model_name, id, False))
+
+    def discard(self, model_name, id):
+        with self.heap._lock:
+            ids = self.models.get(model_name)
+            if not ids or id not in ids:
+                return
+            self.models[model_name] = ids.delete(id)
+            self.heap.record(self.name, 'undo', (model_name, id, True))
+
+    def undo(self, model_name, id, present):
+        ids = self.models.get(model_name, _EMPTY_IDS)
+        self.models[model_name] = ids.set(id, None) if present else ids.delete(id)
+
+    def ids(self, model_name):
+        """
+            Returns the ids of the live instances of the model, in increasing order. The ids are copied, so the
+            instances may be created or destroyed while iterating over them.
+        """
+        with self.heap._shared_lock:
+            return sorted(self.models.get(model_name, ()))
+
+    def __contains__(self, item):
+        model_name, id = item
+        return id in self.models.get(model_name, ())
+
+    def fork(self, heap):
+        index = InstanceIndex(heap)
+        index.models = dict(self.models)
+        return index
+
+
+class SpatialGrid(object):
+    """
+        Uniform grid over the positions of one Pair or Trio attribute. Every cell is `cell_size` wide in each
+        dimension and holds the ids of the instances positioned inside it. Cells and positions are kept in
+        PersistentMaps, so copying a grid costs O(1) and a move O(log n).
+    """
+
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        # cell coordinates -> frozenset of ids
+        self.cells = PersistentMap()
+        # id -> position tuple
+        self.positions = PersistentMap()
+
+    def cell_of(self, position):
+        size = self.cell_size
+        return tuple(int(c // size) for c in position)
+
+    def put(self, id, position):
+        """
+            Moves `id` to `position` (None removes it). Returns its previous position.
+        """
+        old = self.positions.get(id)
+        cells = self.cells
+        if old is not None:
+            if position is not None and position == old:
+                return old
+            cell = self.cell_of(old)
+            ids = cells[cell] - {id}
+            cells = cells.set(cell, ids) if ids else cells.delete(cell)
+        if position is not None:
+            self.positions = self.positions.set(id, position)
+            cell = self.cell_of(position)
+            cells = cells.set(cell, cells.get(cell, frozenset()) | {id})
+        elif old is not None:
+            self.positions = self.positions.delete(id)
+        self.cells = cells
+        return old
+
+    def in_cell(self, position):
+        """
+            Ids of the instances in the grid cell containing `position`.
+        """
+        return sorted(self.cells.get(self.cell_of(position), ()))
+
+    def at(self, position):
+        """
+            Ids of the instances exactly at `position`.
+        """
+        position = tuple(position)
+        position_of = self.positions.get
+        return sorted(id for id in self.cells.get(self.cell_of(position), ()) if position_of(id) == position)
+
+    def within(self, position, radius):
+        """
+            Ids of the instances at euclidean distance <= `radius` from `position`.
+        """
+        lo = self.cell_of([c - radius for c in position])
+        hi = self.cell_of([c + radius for c in position])
+        n_cells = 1
+        for a, b in zip(lo, hi):
+            n_cells *= b - a + 1
+
+        # a big radius covers more cells than there are occupied ones, so only look at the occupied cells
+        if n_cells > len(self.cells):
+            cells = (
+                ids for cell, ids in self.cells.items()
+                if all(a <= c <= b for a, c, b in zip(lo, cell, hi))
+            )
+        else:
+            cells = (self.cells.get(cell) for cell in itertools.product(*[range(a, b + 1) for a, b in zip(lo, hi)]))
+
+        r2 = radius * radius
+        position_of = self.positions.get
+        found = []
+        for ids in cells:
+            if not ids:
+                continue
+            for id in ids:
+                d2 = 0
+                for a, b in zip(position_of(id), position):
+                    d2 += (a - b) * (a - b)
+                if d2 <= r2:
+                    found.append(id)
+        found.sort()
+        return found
+
+    def copy(self):
+        grid = SpatialGrid(self.cell_size)
+        grid.cells = self.cells
+        grid.positions = self.positions
+        return grid
+
+
+class SpatialIndex(object):
+    """
+        SpatialGrids of the spatially indexed attributes, by 'Model/attribute' key. Kept up to date by the
+        attributes on every set and destroy. Changes are journaled in the heap like InstanceIndex's. Forking shares
+        the grids' maps, see SpatialGrid.
+    """
+
+    name = 'spatial'
+
+    def __init__(self, heap):
+        self.heap = heap
+        self.grids = {}
+
+    def grid(self, key, cell_size):
+        g = self.grids.get(key)
+        if g is None:
+            g = self.grids[key] = SpatialGrid(cell_size)
+        return g
+
+    def move(self, key, cell_size, id, position):
+        if position is not None:
+            position = tuple(position)
+            # partially set positions can't be placed in the grid
+            if None in position:
+                position = None
+        with self.heap._lock:
+            old = self.grid(key, cell_size).put(id, position)
+            if old != position:
+                self.heap.record(self.name, 'undo', (key, id, old))
+
+    def undo(self, key, id, position):
+        self.grids[key].put(id, position)
+
+    def fork(self, heap):
+        index = SpatialIndex(heap)
+        index.grids = {k: g.copy() for k, g in self.grids.items()}
+        return index
+
+
+class MerkleState(object):
+    """
+        HashedTreect copy of the live state of a heap, column cells included, kept by heaps created with
+        hashed=True. It makes heap.state_hash() O(1) and lets heap.diff() only walk the subtrees which differ.
+        Changes are journaled in the heap like the other attachments'. Forking shares the tree, see
+        HashedTreect.copy().
+    """
+
+    name = 'merkle'
+
+    def __init__(self, heap):
+        self.heap = heap
+        self.tree = HashedTreect()
+
+    def set(self, key, value):
+        tree = self.tree
+        old = tree.get(key, _Treect_Nothing)
+        tree[key] = value
+        self.heap.record(self.name, 'undo', (key, old))
+
+    def delete(self, key):
+        tree = self.tree
+        old = tree.get(key, _Treect_Nothing)
+        if old is _Treect_Nothing:
+            return
+        del tree[key]
+        self.heap.record(self.name, 'undo', (key, old))
+
+    def undo(self, key, old):
+        if old is _Treect_Nothing:
+            del self.tree[key]
+        else:
+            self.tree[key] = old
+
+    def fork(self, heap):
+        state = MerkleState(heap)
+        state.tree = self.tree.copy()
+        return state
+
+
+class UndoRecord(object):
+    """
+        Addresses written by a commit, with the value each one had before the commit and the one it was left with.
+        Heap_Nothing stands for an address which held nothing.
+    """
+
+    __slots__ = ('addresses', 'old', 'new')
+
+    def __init__(self, addresses, old, new):
+        self.addresses = addresses
+        self.old = old
+        self.new = new
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def merge(self, later):
+        """
+            Returns the UndoRecord of this record's writes followed by those of `later`.
+        """
+        old = dict(zip(later.addresses, later.old))
+        old.update(zip(self.addresses, self.old))
+        new = dict(zip(self.addresses, self.new))
+        new.update(zip(later.addresses, later.new))
+        addresses = tuple(old)
+        return UndoRecord(addresses, tuple(old[k] for k in addresses), tuple(new[k] for k in addresses))
+
+
+class ChangeLog(object):
+    """
+        Value each address written since the last take() had before its first write, column cells included.
+        The heap engines and the ColumnStore call it before every write, with the lock held. Unlike the other
+        attachments it is not journaled: it spans checkpoints, and reverting them leaves it alone, so whoever
+        reverts must clear() it. Forking starts an empty log.
+    """
+
+    name = 'changes'
+
+    def __init__(self, heap):
+        self.heap = heap
+        # address -> value before the first write, or Heap_Nothing
+        self.old = {}
+        # address -> (column, id) of the column cells in self.old
+        self.cells = {}
+
+    def before(self, key):
+        if key not in self.old:
+            self.old[key] = self.heap.get(key, Heap_Nothing)
+
+    def before_cell(self, column, id):
+        address = column.address(id)
+        if address not in self.old:
+            self.old[address] = self._cell_value(column, id)
+            self.cells[address] = (column, id)
+
+    @staticmethod
+    def _cell_value(column, id):
+        try:
+            return column.get(id)
+        except KeyError:
+            return Heap_Nothing
+
+    def take(self):
+        """
+            Returns the UndoRecord of the writes since the last take() and starts over.
+        """
+        with self.heap._lock:
+            old, cells = self.old, self.cells
+            self.old, self.cells = {}, {}
+            addresses = tuple(old)
+            new = []
+            for k in addresses:
+                cell = cells.get(k)
+                new.append(self.heap.get(k, Heap_Nothing) if cell is None else self._cell_value(*cell))
+        return UndoRecord(addresses, tuple(old[k] for k in addresses), tuple(new))
+
+    def clear(self):
+        self.old = {}
+        self.cells = {}
+
+    def forget(self, n):
+        """
+            Forgets every address but the first `n` written, e.g. after reverting the writes made since. Costs as
+            much as the forgotten addresses.
+        """
+        old, cells = self.old, self.cells
+        while len(old) > n:
+            cells.pop(old.popitem()[0], None)
+
+    def fork(self, heap):
+        return ChangeLog(heap)
+
+
+class _SharedLock(object):
+
+    def __init__(self, lock):
+        self.lock = lock
+
+    def __enter__(self):
+        self.lock.acquire_read()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.lock.release_read()
+
+
+class ReadWriteLock(object):
+    """
+        Lock which lets in any number of readers at once, or a single writer.
+        Used as a context manager (or through acquire/release) it is taken for writing, and the writer may re-enter
+        it and read while writing. `shared` is a context manager which takes it for reading. Readers must not try to
+        upgrade to writing.
+        Writers are preferred: once one waits, new readers wait behind it, so a steady flow of readers cannot starve
+        the writers. Threads which already read may read again.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._depth = 0
+        self._waiting_writers = 0
+        # read depth of each thread
+        self._local = threading.local()
+        self.shared = _SharedLock(self)
+
+    def acquire_read(self):
+        me = threading.get_ident()
+        local = self._local
+        depth = getattr(local, 'depth', 0)
+        with self._cond:
+            if not depth:
+                while self._writer != me and (self._writer is not None or self._waiting_writers):
+                    self._cond.wait()
+            self._readers += 1
+        local.depth = depth + 1
+
+    def release_read(self):
+        self._local.depth -= 1
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._depth += 1
+                return True
+            self._waiting_writers += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = me
+            self._depth = 1
+        return True
+
+    def release(self):
+        with self._cond:
+            if self._writer != threading.get_ident():
+                raise RuntimeError('cannot release un-acquired lock')
+            self._depth -= 1
+            if not self._depth:
+                self._writer = None
+                self._cond.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class HeapSnapshot(object):
+    """
+        Read-only view of a heap as it was when the snapshot was taken. Reading it never waits for the writers
+        of the original heap.
+    """
+
+    def __init__(self, heap):
+        self._heap = heap
+
+    def get(self, item, default=None):
+        return self._heap.get(item, default)
+
+    def all_items(self, prefix=None):
+        return self._heap.all_items(prefix)
+
+    def iter_items(self, prefix=None):
+        return self._heap.iter_items(prefix)
+
+    def state_hash(self):
+        return self._heap.state_hash()
+
+    def subtree_hashes(self, prefix=None):
+        return self._heap.subtree_hashes(prefix)
+
+    def diff(self, other):
+        return self._heap.diff(other)
+
+    def make_collapsed(self, keep_deleted=False):
+        return self._heap.make_collapsed(keep_deleted)
+
+    def percent_used(self):
+        return self._heap.percent_used()
+
+    def dump(self):
+        self._heap.dump()
+
+    def set(self, address, obj):
+        self[address] = obj
+
+    def delete(self, item):
+        del self[item]
+
+    def __getitem__(self, item):
+        return self._heap[item]
+
+    def __setitem__(self, key, value):
+        raise TypeError('Heap snapshots are read-only')
 
-    def __init__(self, size):
-        super(Heap, self).__init__()
+    def __delitem__(self, key):
+        raise TypeError('Heap snapshots are read-only')
+
+    def __len__(self):
+        return len(self._heap)
+
+
+class BaseHeap(object):
+    """
+        Public interface and shared machinery of the heap classes.
+        Subclasses provide the storage of addresses (`__getitem__`, `__setitem__`, `__delitem__`, `_checkpoint`,
+        `_revert`, `_merge`, `_collapse`, `_fork`, `_count` and `_all_items`). Structures kept beside the addresses, such as
+        the ColumnStore, are attached by name and record how to undo their changes in the heap journal, which has
+        one list of undo records per checkpoint.
+    """
+
+    # storage used for collapsed copies of the heap
+    layer_class = Treect
+
+    def __init__(self, size, concurrency='lock', hashed=False):
+        """
+            `concurrency` is either 'lock', where every access takes the same re-entrant lock, or 'rw', where reads
+            share a ReadWriteLock and only wait for writes in progress.
+            `hashed` keeps a MerkleState of the heap, for O(1) state_hash() and fast diff().
+        """
+        super(BaseHeap, self).__init__()
         self.size = size
-        self._data = deque([Treect()])
-        self._lock = threading.RLock()
+        self.concurrency = concurrency
+        if concurrency == 'lock':
+            self._lock = threading.RLock()
+            self._shared_lock = self._lock
+        elif concurrency == 'rw':
+            self._lock = ReadWriteLock()
+            self._shared_lock = self._lock.shared
+        else:
+            raise ValueError('Unknown heap concurrency mode: ' + str(concurrency))
+        # (attachment name, method name, args) undo records of each checkpoint level. the base is never reverted.
+        self._journal = [None]
+        self.attachments = {}
+        self.columns = self.attach(ColumnStore(self))
+        self.instances = self.attach(InstanceIndex(self))
+        self.spatial = self.attach(SpatialIndex(self))
+        self.merkle = self.attach(MerkleState(self)) if hashed else None
+        # ChangeLog of the writes, when one is attached (see LocalVM's undo_records)
+        self.changes = None
+
+    def attach(self, obj):
+        self.attachments[obj.name] = obj
+        return obj
+
+    def record(self, name, method, args):
+        """
+            Records that `attachments[name].method(*args)` undoes a change made in the current checkpoint.
+        """
+        if len(self._journal) > 1:
+            self._journal[-1].append((name, method, args))
 
     def set(self, address, obj):
         self[address] = obj
@@ -211,47 +1208,257 @@ class Heap(object):
         return float(len(self)) / float(self.size) * 100
 
     def checkpoint(self):
-        self._data.append(Treect())
+        with self._lock:
+            self._checkpoint()
+            self._journal.append([])
 
     def revert(self):
-        if len(self._data) == 1:
+        if len(self._journal) == 1:
             raise ValueError('Cannot revert Heap, no checkpoints found!')
+        with self._lock:
+            self._revert()
+            for name, method, args in reversed(self._journal.pop()):
+                getattr(self.attachments[name], method)(*args)
+
+    def merge(self):
+        """
+            Merges the newest checkpoint into the one before it, so that reverting that one also reverts the writes
+            made since the newest. Costs as much as the writes of the newest checkpoint.
+        """
+        if len(self._journal) == 1:
+            raise ValueError('Cannot merge Heap, no checkpoints found!')
+        with self._lock:
+            if len(self._journal) == 2:
+                self.collapse()
+                return
+            self._merge()
+            self._journal[-2].extend(self._journal.pop())
+
+    def depth(self):
+        """
+            Number of checkpoints which can still be reverted.
+        """
+        return len(self._journal) - 1
+
+    def collapse(self, keep=0):
+        """
+            Merges every checkpoint but the newest `keep` ones into the base. Merged checkpoints can no
+            longer be reverted.
+        """
+        with self._lock:
+            n = len(self._journal) - 1 - keep
+            if n <= 0:
+                return
+            self._collapse(n)
+            del self._journal[1:n + 1]
+
+    def fork(self, concurrency=None):
+        """
+            Returns an independent heap, without checkpoints, holding the current state of this one.
+            It uses the same concurrency mode as this heap unless `concurrency` is given.
+        """
+        with self._lock:
+            h = self._fork(concurrency or self.concurrency)
+            for name, obj in self.attachments.items():
+                h.attachments[name] = obj.fork(h)
+            h.columns = h.attachments[ColumnStore.name]
+            h.instances = h.attachments[InstanceIndex.name]
+            h.spatial = h.attachments[SpatialIndex.name]
+            h.merkle = h.attachments.get(MerkleState.name)
+            h.changes = h.attachments.get(ChangeLog.name)
+        return h
+
+    def state_hash(self):
+        """
+            Returns a hash of the live contents of the heap: two heaps holding the same (address, value) pairs have
+            the same hash, whatever their engine or history. O(1) for hashed heaps, a full pass otherwise.
+        """
+        with self._shared_lock:
+            if self.merkle is not None:
+                return self.merkle.tree.hash
+            h = 0
+            for k, v in self.iter_items():
+                h += item_hash(k, v)
+            return h & _HASH_MASK
+
+    def subtree_hashes(self, prefix=None):
+        """
+            Returns {key: (hash, is_node)} for the children of `prefix`, see merkle_diff(). Hashed heaps only.
+        """
+        if self.merkle is None:
+            raise ValueError('subtree_hashes() needs a heap created with hashed=True')
+        with self._shared_lock:
+            return self.merkle.tree.children(prefix)
+
+    def diff(self, other):
+        """
+            Returns the addresses whose values differ between this heap and `other`, any object with
+            subtree_hashes() (e.g. a RemoteHeap). Hashed heaps only.
+        """
+        return list(merkle_diff(self.subtree_hashes, other.subtree_hashes))
+
+    def snapshot(self):
+        """
+            Returns a read-only HeapSnapshot of the current state. It costs as much as fork(), i.e. O(1) with a
+            PersistentHeap.
+        """
+        # nothing writes to the copy, so the cheaper plain lock is enough whatever this heap uses
+        return HeapSnapshot(self.fork('lock'))
+
+    def make_collapsed(self, keep_deleted=False):
+        t = self.layer_class()
+        with self._shared_lock:
+            for k, v in self.iter_items():
+                t[k] = v
+        return t
+
+    def iter_items(self, prefix=None):
+        """
+            Yields the live (address, value) pairs of the heap, optionally only those under `prefix`, in a single
+            pass over the storage and without copying it. Unlike all_items() it does not take the lock, so the heap
+            must not change while the iteration runs. dump(), make_collapsed() and exports are built on it.
+        """
+        items = self._all_items(prefix)
+        if not self.columns.columns:
+            return items
+        return itertools.chain(items, self.columns.all_items(prefix))
+
+    def all_items(self, prefix=None):
+        """
+            Returns an iterator over a copy of the live (address, value) pairs of the heap, optionally only those
+            under `prefix`. The heap may be changed while iterating over it.
+        """
+        with self._shared_lock:
+            items = list(self.iter_items(prefix))
+        return iter(items)
+
+    def __len__(self):
+        return self._count() + self.columns.live
+
+    def __repr__(self):
+        return str(self)
+
+    def __str__(self):
+        return '<Heap object at %s, %s%% used, with size=%s>' % (id(self), self.percent_used(), self.size)
+
+    def dump(self):
+        print()
+        with self._shared_lock:
+            for k, v in self.iter_items():
+                print('%s%s%s' % (k, ((80 - len(str(k))) * ' '), v))
+        print()
+
+
+class Heap(BaseHeap):
+    """
+        Heap made of one Treect per checkpoint. Reads go from the newest layer to the oldest, deleted addresses are
+        marked with Heap_DeletedObj.
+    """
+
+    # storage used for each checkpoint layer
+    layer_class = Treect
+
+    def __init__(self, size, concurrency='lock', hashed=False):
+        super(Heap, self).__init__(size, concurrency, hashed)
+        self._data = deque([self.layer_class()])
+        # number of live addresses, and how much each layer changed it (so a revert can undo it)
+        self._live = 0
+        self._live_deltas = deque([0])
+
+    def _checkpoint(self):
+        self._data.append(self.layer_class())
+        self._live_deltas.append(0)
+
+    def _revert(self):
         self._data.pop()
+        self._live -= self._live_deltas.pop()
 
-    def collapse(self):
-        self._data = deque([self.make_collapsed()])
+    def _merge(self):
+        top = self._data.pop()
+        delta = self._live_deltas.pop()
+        self._live_deltas[-1] += delta
+        if len(self._data) == 1:
+            self._merge_into_base(top)
+            return
+        # deleted addresses keep their marker, the layer below is not the base
+        below = self._data[-1]
+        for k, v in top.all_items():
+            below[k] = v
+
+    def _merge_into_base(self, layer):
+        base = self._data[0]
+        for k, v in layer.all_items():
+            if v is Heap_DeletedObj:
+                if k in base:
+                    del base[k]
+            else:
+                base[k] = v
+
+    def _collapse(self, n):
+        # merges the layers in place, so the cost is proportional to the writes held by the merged layers
+        for _ in range(n):
+            self._merge_into_base(self._data[1])
+            del self._data[1]
+            self._live_deltas[0] += self._live_deltas[1]
+            del self._live_deltas[1]
+
+    def _fork(self, concurrency):
+        h = type(self)(self.size, concurrency)
+        base = h._data[0]
+        for k, v in self._all_items():
+            base[k] = v
+        h._live = self._live
+        h._live_deltas[0] = self._live
+        return h
 
     def make_collapsed(self, keep_deleted=False):
-
-        t = Treect()
-        for container in self._data:
-            for k, v in container.all_items():
+        t = self.layer_class()
+        with self._shared_lock:
+            for k, v in self._merged_items(keep_deleted=keep_deleted):
+                t[k] = v
+            for k, v in self.columns.all_items():
                 t[k] = v
-
-        if not keep_deleted:
-            t2 = Treect()
-            for k, v in t.all_items():
-                if v is Heap_DeletedObj:
-                    continue
-                t2[k] = v
-            return t2
         return t
 
-    def __len__(self):
-        count = 0
-        collapsed = self.make_collapsed()
-        for _, __ in collapsed.all_items():
-            count += 1
-        return count
+    def _merged_items(self, prefix=None, keep_deleted=False):
+        """
+            Yields every address once, with its value in the newest layer holding it. Goes from the newest layer to
+            the oldest and only remembers the addresses of the layers above the base, which are the small ones.
+        """
+        layers = self._data
+        seen = set()
+        for i in range(len(layers) - 1, -1, -1):
+            for k, v in layers[i].all_items(prefix):
+                if k in seen:
+                    continue
+                if i:
+                    seen.add(k)
+                if keep_deleted or v is not Heap_DeletedObj:
+                    yield k, v
+
+    def _all_items(self, prefix=None):
+        return self._merged_items(prefix)
+
+    def _count(self):
+        return self._live
+
+    def _lookup(self, item):
+        """
+            Returns the live value of `item`, or Heap_Nothing. Must be called with the lock held.
+        """
+        for treect in reversed(self._data):
+            v = treect.get(item, Heap_Nothing)
+            if v is Heap_DeletedObj:
+                return Heap_Nothing
+            if v is not Heap_Nothing:
+                return v
+        return Heap_Nothing
 
     def __getitem__(self, item):
-        with self._lock:
-            for treect in reversed(self._data):
-                v = treect.get(item, Heap_Nothing)
-                if v is Heap_DeletedObj:
-                    raise KeyError
-                if v is not Heap_Nothing:
-                    return v
+        with self._shared_lock:
+            v = self._lookup(item)
+            if v is not Heap_Nothing:
+                return v
 
         raise KeyError()
 
@@ -259,20 +1466,450 @@ class Heap(object):
         if not isinstance(key, (int, str)):
             raise ValueError('Heap address must be of type int or string, not ' + type(key).__name__)
         with self._lock:
+            if self.changes is not None:
+                self.changes.before(key)
+            if self._lookup(key) is Heap_Nothing:
+                self._live += 1
+                self._live_deltas[-1] += 1
             self._data[-1][key] = value
+            if self.merkle is not None:
+                self.merkle.set(key, value)
 
     def __delitem__(self, key):
         with self._lock:
+            if self.changes is not None:
+                self.changes.before(key)
+            if self._lookup(key) is not Heap_Nothing:
+                self._live -= 1
+                self._live_deltas[-1] -= 1
             self._data[-1][key] = Heap_DeletedObj
+            if self.merkle is not None:
+                self.merkle.delete(key)
+
+
+class FlatHeap(Heap):
+    """
+        Heap whose layers are FlatLayers: each read is a single hash lookup per layer, regardless of how many
+        '/' separated levels the address has.
+    """
+
+    layer_class = FlatLayer
+
+
+class VersionedHeap(BaseHeap):
+    """
+        Heap which keeps, for each address, a stack of [level, value] versions, plus the list of addresses
+        written at each checkpoint level. A read only looks at the top of a single stack, so it costs the same no
+        matter how many checkpoints were made, and a revert only costs as much as the writes of the reverted level.
+    """
+
+    def __init__(self, size, concurrency='lock', hashed=False):
+        super(VersionedHeap, self).__init__(size, concurrency, hashed)
+        # address -> list of [level, value], oldest first
+        self._versions = {}
+        # addresses which got a new version at each checkpoint level (the base cannot be reverted, so it is not tracked)
+        self._touched = [None]
+        # absolute level of the base. levels are never renumbered, collapsing just moves the base up.
+        self._base = 0
+        # number of live addresses
+        self._live = 0
+
+    def _checkpoint(self):
+        self._touched.append([])
+
+    def _revert(self):
+        versions = self._versions
+        live = self._live
+        for key in self._touched.pop():
+            stack = versions[key]
+            if stack.pop()[1] is not Heap_DeletedObj:
+                live -= 1
+            if not stack:
+                del versions[key]
+            elif stack[-1][1] is not Heap_DeletedObj:
+                live += 1
+        self._live = live
+
+    def _merge(self):
+        level = self._base + len(self._touched) - 1
+        versions = self._versions
+        below = self._touched[-2]
+        for key in self._touched.pop():
+            stack = versions[key]
+            if len(stack) > 1 and stack[-2][0] == level - 1:
+                value = stack.pop()[1]
+                stack[-1][1] = value
+            else:
+                stack[-1][0] = level - 1
+                below.append(key)
+
+    def _collapse(self, n):
+        base = self._base + n
+        versions = self._versions
+        merged = set()
+        for level in self._touched[1:n + 1]:
+            merged.update(level)
+        for key in merged:
+            # squash the versions at or below the new base into a single one
+            stack = versions[key]
+            j = 0
+            while j + 1 < len(stack) and stack[j + 1][0] <= base:
+                j += 1
+            value = stack[j][1]
+            rest = stack[j + 1:]
+            if value is Heap_DeletedObj:
+                if rest:
+                    versions[key] = rest
+                else:
+                    del versions[key]
+            else:
+                versions[key] = [[base, value]] + rest
+        self._touched = [None] + self._touched[n + 1:]
+        self._base = base
 
-    def __repr__(self):
-        return str(self)
+    def _fork(self, concurrency):
+        h = type(self)(self.size, concurrency)
+        for k, v in self._all_items():
+            h[k] = v
+        return h
 
-    def __str__(self):
-        return '<Heap object at %s, %s%% used, with size=%s>' % (id(self), self.percent_used(), self.size)
+    def _all_items(self, prefix=None):
+        if prefix is None:
+            items = ((k, stack[-1][1]) for k, stack in self._versions.items())
+        else:
+            sub = str(prefix) + '/'
+            items = (
+                (k, stack[-1][1]) for k, stack in self._versions.items()
+                if k == prefix or (isinstance(k, str) and k.startswith(sub))
+            )
+        return ((k, v) for k, v in items if v is not Heap_DeletedObj)
+
+    def _count(self):
+        return self._live
 
-    def dump(self):
-        print()
-        for k, v in self.make_collapsed().all_items():
-            print('%s%s%s' % (k, ((80 - len(k)) * ' '), v))
-        print()
+    def __getitem__(self, item):
+        with self._shared_lock:
+            stack = self._versions.get(item)
+            if stack is not None:
+                v = stack[-1][1]
+                if v is not Heap_DeletedObj:
+                    return v
+
+        raise KeyError()
+
+    def _write(self, key, value):
+        level = self._base + len(self._touched) - 1
+        stack = self._versions.get(key)
+        if stack is not None and stack[-1][1] is not Heap_DeletedObj:
+            self._live -= 1
+        if value is not Heap_DeletedObj:
+            self._live += 1
+        if level == self._base:
+            # the base cannot be reverted, so it only keeps the current value of each address
+            if value is Heap_DeletedObj:
+                self._versions.pop(key, None)
+            else:
+                self._versions[key] = [[level, value]]
+            return
+        if stack is None:
+            self._versions[key] = [[level, value]]
+        elif stack[-1][0] == level:
+            stack[-1][1] = value
+            return
+        else:
+            stack.append([level, value])
+        self._touched[level - self._base].append(key)
+
+    def __setitem__(self, key, value):
+        if not isinstance(key, (int, str)):
+            raise ValueError('Heap address must be of type int or string, not ' + type(key).__name__)
+        with self._lock:
+            if self.changes is not None:
+                self.changes.before(key)
+            self._write(key, value)
+            if self.merkle is not None:
+                self.merkle.set(key, value)
+
+    def __delitem__(self, key):
+        with self._lock:
+            if self.changes is not None:
+                self.changes.before(key)
+            self._write(key, Heap_DeletedObj)
+            if self.merkle is not None:
+                self.merkle.delete(key)
+
+
+_HAMT_BITS = 5
+_HAMT_MASK = (1 << _HAMT_BITS) - 1
+_HAMT_HASH_BITS = 64
+_HAMT_HASH_MASK = (1 << _HAMT_HASH_BITS) - 1
+
+
+def _popcount(x):
+    return bin(x).count('1')
+
+
+class _HamtNode(object):
+    """
+        Bitmap indexed node of a PersistentMap. Each entry is either a (key, value) leaf or a child node.
+        Nodes are never changed after creation.
+    """
+
+    __slots__ = ('bitmap', 'entries')
+
+    def __init__(self, bitmap, entries):
+        self.bitmap = bitmap
+        self.entries = entries
+
+
+class _HamtCollision(object):
+    """
+        Leaves whose keys have the same full hash.
+    """
+
+    __slots__ = ('hash', 'entries')
+
+    def __init__(self, hash, entries):
+        self.hash = hash
+        self.entries = entries
+
+
+def _hamt_hash(key):
+    return hash(key) & _HAMT_HASH_MASK
+
+
+def _hamt_pair(leaf1, h1, leaf2, h2, shift):
+    """
+        Builds the smallest subtree holding two leaves with different keys.
+    """
+    if shift >= _HAMT_HASH_BITS:
+        return _HamtCollision(h1, [leaf1, leaf2])
+    i1 = (h1 >> shift) & _HAMT_MASK
+    i2 = (h2 >> shift) & _HAMT_MASK
+    if i1 == i2:
+        return _HamtNode(1 << i1, [_hamt_pair(leaf1, h1, leaf2, h2, shift + _HAMT_BITS)])
+    if i1 < i2:
+        return _HamtNode((1 << i1) | (1 << i2), [leaf1, leaf2])
+    return _HamtNode((1 << i1) | (1 << i2), [leaf2, leaf1])
+
+
+def _hamt_set(node, key, value, h, shift):
+    """
+        Returns (new node, whether a key was added). Only the path from the root to the changed leaf is copied.
+    """
+    if node.__class__ is _HamtCollision:
+        entries = list(node.entries)
+        for i, leaf in enumerate(entries):
+            if leaf[0] == key:
+                entries[i] = (key, value)
+                return _HamtCollision(h, entries), False
+        entries.append((key, value))
+        return _HamtCollision(h, entries), True
+
+    bit = 1 << ((h >> shift) & _HAMT_MASK)
+    idx = _popcount(node.bitmap & (bit - 1))
+    entries = node.entries
+
+    if not node.bitmap & bit:
+        return _HamtNode(node.bitmap | bit, entries[:idx] + [(key, value)] + entries[idx:]), True
+
+    entry = entries[idx]
+    if entry.__class__ is tuple:
+        if entry[0] == key:
+            if entry[1] is value:
+                return node, False
+            new = (key, value)
+            added = False
+        else:
+            new = _hamt_pair(entry, _hamt_hash(entry[0]), (key, value), h, shift + _HAMT_BITS)
+            added = True
+    else:
+        new, added = _hamt_set(entry, key, value, h, shift + _HAMT_BITS)
+        if new is entry:
+            return node, False
+
+    entries = list(entries)
+    entries[idx] = new
+    return _HamtNode(node.bitmap, entries), added
+
+
+def _hamt_delete(node, key, h, shift):
+    """
+        Returns the new node (None if it became empty, or a bare leaf if only one is left below the root),
+        or the very same node if `key` is not found.
+    """
+    if node.__class__ is _HamtCollision:
+        entries = [leaf for leaf in node.entries if leaf[0] != key]
+        if len(entries) == len(node.entries):
+            return node
+        if len(entries) == 1:
+            return entries[0]
+        return _HamtCollision(node.hash, entries)
+
+    bit = 1 << ((h >> shift) & _HAMT_MASK)
+    if not node.bitmap & bit:
+        return node
+    idx = _popcount(node.bitmap & (bit - 1))
+    entry = node.entries[idx]
+
+    if entry.__class__ is tuple:
+        if entry[0] != key:
+            return node
+        new = None
+    else:
+        new = _hamt_delete(entry, key, h, shift + _HAMT_BITS)
+        if new is entry:
+            return node
+
+    if new is None:
+        bitmap = node.bitmap & ~bit
+        if not bitmap:
+            return None
+        entries = node.entries[:idx] + node.entries[idx + 1:]
+        if len(entries) == 1 and entries[0].__class__ is tuple and shift:
+            return entries[0]
+        return _HamtNode(bitmap, entries)
+
+    entries = list(node.entries)
+    entries[idx] = new
+    if len(entries) == 1 and new.__class__ is tuple and shift:
+        return new
+    return _HamtNode(node.bitmap, entries)
+
+
+def _hamt_items(node):
+    stack = [node]
+    while stack:
+        for entry in stack.pop().entries:
+            if entry.__class__ is tuple:
+                yield entry
+            else:
+                stack.append(entry)
+
+
+_EMPTY_HAMT_NODE = _HamtNode(0, [])
+
+
+class PersistentMap(object):
+    """
+        Immutable hash array mapped trie. set() and delete() return a new map which shares every untouched node
+        with the old one, so a write costs O(log n) new memory and a copy costs nothing.
+    """
+
+    __slots__ = ('_root', '_count')
+
+    def __init__(self, root=_EMPTY_HAMT_NODE, count=0):
+        self._root = root
+        self._count = count
+
+    def get(self, key, default=None):
+        h = _hamt_hash(key)
+        node = self._root
+        shift = 0
+        while True:
+            if node.__class__ is _HamtCollision:
+                for leaf in node.entries:
+                    if leaf[0] == key:
+                        return leaf[1]
+                return default
+            bit = 1 << ((h >> shift) & _HAMT_MASK)
+            if not node.bitmap & bit:
+                return default
+            entry = node.entries[_popcount(node.bitmap & (bit - 1))]
+            if entry.__class__ is tuple:
+                return entry[1] if entry[0] == key else default
+            node = entry
+            shift += _HAMT_BITS
+
+    def set(self, key, value):
+        root, added = _hamt_set(self._root, key, value, _hamt_hash(key), 0)
+        if root is self._root:
+            return self
+        return PersistentMap(root, self._count + 1 if added else self._count)
+
+    def delete(self, key):
+        root = _hamt_delete(self._root, key, _hamt_hash(key), 0)
+        if root is self._root:
+            return self
+        return PersistentMap(_EMPTY_HAMT_NODE if root is None else root, self._count - 1)
+
+    def items(self):
+        return _hamt_items(self._root)
+
+    def __getitem__(self, item):
+        v = self.get(item, Heap_Nothing)
+        if v is Heap_Nothing:
+            raise KeyError(item)
+        return v
+
+    def __contains__(self, item):
+        return self.get(item, Heap_Nothing) is not Heap_Nothing
+
+    def __iter__(self):
+        return (k for k, _ in self.items())
+
+    def __len__(self):
+        return self._count
+
+
+_EMPTY_IDS = PersistentMap()
+
+
+class PersistentHeap(BaseHeap):
+    """
+        Heap backed by a PersistentMap. Every checkpoint is just a reference to the map as it was, so
+        checkpoint(), revert(), collapse() and fork() are O(1), and reads do not depend on the number of checkpoints.
+    """
+
+    def __init__(self, size, concurrency='lock', hashed=False):
+        super(PersistentHeap, self).__init__(size, concurrency, hashed)
+        # map as of each checkpoint, the last one being the current state
+        self._roots = [PersistentMap()]
+
+    def _checkpoint(self):
+        self._roots.append(self._roots[-1])
+
+    def _revert(self):
+        self._roots.pop()
+
+    def _merge(self):
+        del self._roots[-2]
+
+    def _collapse(self, n):
+        del self._roots[:n]
+
+    def _fork(self, concurrency):
+        h = type(self)(self.size, concurrency)
+        h._roots = [self._roots[-1]]
+        return h
+
+    def _all_items(self, prefix=None):
+        root = self._roots[-1]
+        if prefix is None:
+            return root.items()
+        sub = str(prefix) + '/'
+        return ((k, v) for k, v in root.items() if k == prefix or (isinstance(k, str) and k.startswith(sub)))
+
+    def _count(self):
+        return len(self._roots[-1])
+
+    def __getitem__(self, item):
+        return self._roots[-1][item]
+
+    def __setitem__(self, key, value):
+        if not isinstance(key, (int, str)):
+            raise ValueError('Heap address must be of type int or string, not ' + type(key).__name__)
+        with self._lock:
+            if self.changes is not None:
+                self.changes.before(key)
+            self._roots[-1] = self._roots[-1].set(key, value)
+            if self.merkle is not None:
+                self.merkle.set(key, value)
+
+    def __delitem__(self, key):
+        with self._lock:
+            if self.changes is not None:
+                self.changes.before(key)
+            self._roots[-1] = self._roots[-1].delete(key)
+            if self.merkle is not None:
+                self.merkle.delete(key)
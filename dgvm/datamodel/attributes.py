@@ -104,6 +104,7 @@ class ntuple(object):
 
 class Integer(VMAttribute):
     attr_type = int
+    typecode = 'q'
 
 
 class String(VMAttribute):
@@ -112,10 +113,12 @@ class String(VMAttribute):
 
 class Float(VMAttribute):
     attr_type = float
+    typecode = 'd'
 
 
 class Boolean(VMAttribute):
     attr_type = bool
+    typecode = 'b'
 
 
 class List(TypedVMAttribute):
@@ -124,12 +127,14 @@ class List(TypedVMAttribute):
 
 class Pair(TypedVMAttribute):
     attr_type = ntuple
+    spatial = True
     coerce_function = functools.partial(ntuple, 2)
     coerce_val = True
 
 
 class Trio(TypedVMAttribute):
     attr_type = ntuple
+    spatial = True
     coerce_function = functools.partial(ntuple, 3)
     coerce_val = True
 
@@ -24,12 +24,15 @@ class DatamodelMeta(type):
         vmattrs = {}
         member_instructions = []
         dct['_id'] = IDVMAttribute()
+        columnar = getattr(cls, 'columnar', False)
         for key, atr in dct.items():
             if key == 'id':
                 raise AttributeError('Manual definition of id is not allowed. Model was:' + name)
             if isinstance(atr, VMAttribute):
                 atr.set_name(key)
                 atr.set_model_name(name)
+                # scalar attributes of columnar models are kept in typed arrays instead of one heap address each
+                atr.columnar = bool(columnar and atr.typecode)
                 vmattrs[key] = atr
             if isinstance(atr, MemberInstructionWrapper):
                 atr.create(cls)
@@ -47,6 +50,12 @@ class VMAttribute(object):
     attr_type = None
     coerce_val = False
     coerce_function = None
+    # array typecode used to store the attribute in columnar models (None if it cannot be stored in a column)
+    typecode = None
+    columnar = False
+    # whether the attribute can have a spatial index (see TypedVMAttribute), and its grid cell size if it has one
+    spatial = False
+    spatial_index = None
 
     def __init__(self, default=None, null=False, **kwargs):
         self.name = id(self)
@@ -56,31 +65,66 @@ class VMAttribute(object):
         self.null = null
         if self.coerce_val and not self.coerce_function:
             self.coerce_function = self.attr_type
+        # instance id -> heap address of this attribute, so addresses are only formatted once per instance
+        self._addresses = {}
+        self._column_key = None
 
     def set_name(self, name):
         self.name = name
+        self._addresses = {}
+        self._column_key = '%s/%s' % (self.model_name, self.name)
 
     def set_model_name(self, model_name):
         self.model_name = model_name
+        self._addresses = {}
+        self._column_key = '%s/%s' % (self.model_name, self.name)
 
     def attr_name(self, instance=None, id=None):
-        return '%s/O/%i/%s' % (self.model_name, id if id else instance.id, self.name)
+        if not id:
+            id = instance.id
+        address = self._addresses.get(id)
+        if address is None:
+            address = self._addresses[id] = '%s/O/%i/%s' % (self.model_name, id, self.name)
+        return address
+
+    def _column(self, vm):
+        columns = vm.heap.columns
+        c = columns.columns.get(self._column_key)
+        if c is None:
+            c = columns.column(self.model_name, self.name, self.typecode, self.attr_type)
+        return c
 
     def _get_wrapped_value(self, instance):
+        if self.columnar:
+            try:
+                return self._column(instance.vm).get(instance.id)
+            except KeyError:
+                return None
         attr_name = self.attr_name(instance)
         return instance.vm.heap.get(attr_name)
 
     def _set_wrapped_value(self, instance, value):
         from dgvm.datamodel import Datamodel
+        if self.columnar:
+            instance.vm.heap.columns.set(self._column(instance.vm), instance.id, value)
+            return
         attr_name = self.attr_name(instance)
         if isinstance(value, Datamodel):
             value = value.id
         instance.vm.heap.set(attr_name, value)
+        if self.spatial_index:
+            instance.vm.heap.spatial.move(self._column_key, self.spatial_index, instance.id, value)
 
     def _destroy(self, instance=None, id=None, vm=None):
-        attr_name = self.attr_name(instance=instance, id=id)
         if instance:
             vm = instance.vm
+            id = instance.id
+        if self.columnar:
+            return vm.heap.columns.delete(self._column(vm), id)
+        if self.spatial_index:
+            vm.heap.spatial.move(self._column_key, self.spatial_index, id, None)
+        attr_name = self.attr_name(id=id)
+        self._addresses.pop(id, None)
         return vm.heap.delete(attr_name)
 
     def __get__(self, instance, owner):
@@ -95,33 +139,33 @@ class VMAttribute(object):
         if self.coerce_val:
             value = self.coerce_function(value)
 
-        def normal():
-            raise AttributeError('Cannot set attribute after object creation, build a new object or use Instructions.')
+        state = instance._state
 
-        def user_changing():
+        if state == DatamodelStates.USER_CHANGING:
             self.on_change.validate(instance, value)
             self._set_wrapped_value(instance, value)
-
-        def engine_changing():
+        elif state == DatamodelStates.ENGINE_CHANGING:
             self._set_wrapped_value(instance, value)
-
-        def destroyed():
+        elif state == DatamodelStates.NORMAL:
+            raise AttributeError('Cannot set attribute after object creation, build a new object or use Instructions.')
+        else:
             raise ModelDestroyedError()
 
-        actions = {
-            DatamodelStates.NORMAL: normal,
-            DatamodelStates.USER_CHANGING: user_changing,
-            DatamodelStates.ENGINE_CHANGING: engine_changing,
-            DatamodelStates.DESTROYED: destroyed
-        }
-
-        actions[instance._state]()
-
 
 class TypedVMAttribute(VMAttribute):
 
-    def __init__(self, subtype, default=None, **kwargs):
+    def __init__(self, subtype, default=None, spatial_index=None, **kwargs):
+        """
+            spatial_index: grid cell size. When given, the instances are indexed by the value of this attribute,
+            see Datamodel.objects(vm).near(). Only for Pair and Trio attributes.
+        """
         super(TypedVMAttribute, self).__init__(default=default, **kwargs)
+        if spatial_index is not None:
+            if not self.spatial:
+                raise ValueError('spatial_index is only supported by Pair and Trio attributes')
+            if spatial_index <= 0:
+                raise ValueError('spatial_index must be a positive cell size')
+            self.spatial_index = spatial_index
         if not subtype:
             raise ValueError('subtype cannot be None')
         if self.coerce_val:
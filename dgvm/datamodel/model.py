@@ -4,6 +4,7 @@ __author__ = 'salvia'
 from threading import Lock
 
 from .meta import DatamodelMeta, DatamodelStates
+from .query import QuerySet
 from ..builtin_instructions import InstantiateModel, DestroyInstance
 
 
@@ -14,7 +15,6 @@ class InvalidModel(Exception):
     pass
 
 
-# TODO: implement .objects(.all/.filter)
 class Datamodel(metaclass=DatamodelMeta):
     """
         Base class for all models.
@@ -23,6 +23,9 @@ class Datamodel(metaclass=DatamodelMeta):
 
     _state = DatamodelStates.NORMAL
 
+    # when True, Integer, Float and Boolean attributes are stored in typed arrays indexed by id (see ColumnStore)
+    columnar = False
+
     _lock = Lock()
 
     def __init__(self, vm, noinit=False, **kwargs):
@@ -149,6 +152,40 @@ class Datamodel(metaclass=DatamodelMeta):
 
         return val
 
+    @classmethod
+    def _restore(cls, vm, attrs):
+        """
+            Writes an instance to the heap from the attributes of its InstantiateModel instruction.
+        """
+        from dgvm.datamodel import ForeignModel
+
+        id = attrs['id']
+        item = cls(vm, noinit=True)
+        item._state = DatamodelStates.ENGINE_CHANGING
+        item._vmattrs['_id']._set_wrapped_value(item, id, id)
+        item.id = id
+        for k, v in cls._vmattrs.items():
+            if k == '_id':
+                continue
+            if isinstance(v, ForeignModel) and k + '_id' in attrs:
+                setattr(item, k, v.subtype.get_by_id(vm, attrs[k + '_id']))
+            elif k in attrs:
+                setattr(item, k, attrs[k])
+        item._state = DatamodelStates.NORMAL
+
+        key = cls.__name__ + '/IDCOUNTER'
+        with cls._lock:
+            if (vm.heap.get(key) or 0) < id:
+                vm.heap.set(key, id)
+        return item
+
+    @classmethod
+    def objects(cls, vm):
+        """
+            Returns a QuerySet over the live instances of this model in vm, e.g. Infantry.objects(vm).all()
+        """
+        return QuerySet(cls, vm)
+
     @classmethod
     def get_by_id(cls, vm, id):
 
@@ -0,0 +1,134 @@
+# coding: utf-8
+__author__ = 'salvia'
+
+import operator
+
+
+def _compare_value(value):
+    from .model import Datamodel
+
+    # foreign models are compared by id
+    if isinstance(value, Datamodel):
+        return value.id
+    return value
+
+
+def _in(a, b):
+    return a in b
+
+
+_lookups = {
+    'exact': operator.eq,
+    'ne': operator.ne,
+    'gt': operator.gt,
+    'gte': operator.ge,
+    'lt': operator.lt,
+    'lte': operator.le,
+    'in': _in,
+}
+
+
+class QuerySet(object):
+    """
+        Lazy query over the live instances of a model, as returned by Model.objects(vm).
+        Instances are only fetched while iterating, and only the heap addresses of the filtered attributes of the
+        queried model are read. Filters use Django-like lookups, e.g. Infantry.objects(vm).filter(health__lt=10).
+        Supported lookups are exact (the default), ne, gt, gte, lt, lte and in. Foreign models compare by id.
+        Attributes declared with a spatial_index can also be queried by position with near(), at() and in_cell().
+    """
+
+    def __init__(self, model, vm, conditions=(), spatial=None):
+        self.model = model
+        self.vm = vm
+        self.conditions = tuple(conditions)
+        # (attribute name, SpatialGrid method name, args) which picks the candidate ids, or None for every instance
+        self.spatial = spatial
+
+    def all(self):
+        return QuerySet(self.model, self.vm, self.conditions, self.spatial)
+
+    def filter(self, **kwargs):
+        conditions = list(self.conditions)
+        for key, value in sorted(kwargs.items()):
+            name, _, lookup = key.partition('__')
+            lookup = lookup or 'exact'
+            if lookup not in _lookups:
+                raise ValueError('Unknown lookup %s in filter %s' % (lookup, key))
+            if name != 'id' and name not in self.model._vmattrs:
+                raise ValueError('%s has no attribute %s' % (self.model.__name__, name))
+            if lookup == 'in':
+                value = [_compare_value(v) for v in value]
+            else:
+                value = _compare_value(value)
+            conditions.append((name, _lookups[lookup], value))
+        return QuerySet(self.model, self.vm, conditions, self.spatial)
+
+    def _spatial_query(self, name, method, *args):
+        attr = self.model._vmattrs.get(name)
+        if attr is None or not attr.spatial_index:
+            raise ValueError('%s.%s has no spatial index' % (self.model.__name__, name))
+        if self.spatial:
+            raise ValueError('Only one spatial query can be made per QuerySet')
+        return QuerySet(self.model, self.vm, self.conditions, (name, method, args))
+
+    def near(self, name, position, radius):
+        """
+            Instances whose `name` attribute is at euclidean distance <= radius from position.
+        """
+        return self._spatial_query(name, 'within', tuple(position), radius)
+
+    def at(self, name, position):
+        """
+            Instances whose `name` attribute equals position.
+        """
+        return self._spatial_query(name, 'at', tuple(position))
+
+    def in_cell(self, name, position):
+        """
+            Instances in the same spatial index cell as position.
+        """
+        return self._spatial_query(name, 'in_cell', tuple(position))
+
+    def _ids(self):
+        heap = self.vm.heap
+        if self.spatial is None:
+            return heap.instances.ids(self.model.__name__)
+        attr_name, method, args = self.spatial
+        with heap._shared_lock:
+            grid = heap.spatial.grids.get(self.model._vmattrs[attr_name]._column_key)
+            return getattr(grid, method)(*args) if grid else []
+
+    def count(self):
+        if not self.conditions:
+            return len(self._ids())
+        return sum(1 for _ in self)
+
+    def first(self):
+        for instance in self:
+            return instance
+        return None
+
+    def _matches(self, instance):
+        for name, op, value in self.conditions:
+            v = instance.id if name == 'id' else _compare_value(getattr(instance, name))
+            if v is None and op is not operator.eq and op is not operator.ne:
+                return False
+            if not op(v, value):
+                return False
+        return True
+
+    def __iter__(self):
+        index = self.vm.heap.instances
+        name = self.model.__name__
+        for id in self._ids():
+            # skip instances destroyed since the iteration started
+            if (name, id) not in index:
+                continue
+            instance = self.model.get_by_id(self.vm, id)
+            if self._matches(instance):
+                yield instance
+
+    def __repr__(self):
+        return '<QuerySet of %s: %i conditions%s>' % (
+            self.model.__name__, len(self.conditions), ', %s %s' % self.spatial[:2] if self.spatial else ''
+        )
@@ -0,0 +1,200 @@
+# coding: utf-8
+__author__ = 'salvia'
+
+import json
+import os
+import pickle
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+
+from .builtin_instructions import BeginTransaction, EndTransaction, InstantiateModel, DestroyInstance
+from .datamodel import Datamodel
+
+
+class CorruptIndexError(Exception):
+    pass
+
+
+# magic, format version, position of the last commit indexed, hash chain head at that commit
+_HEADER = struct.Struct('>8sIQ32s')
+_MAGIC = b'DGVMCIDX'
+_VERSION = 1
+
+_EMPTY = array('q')
+
+# model instance referenced by a commit decoded without loading its models
+_Ref = namedtuple('_Ref', ('model', 'id'))
+
+
+def _ref(model, id):
+    return _Ref(model.__name__, id)
+
+
+def touched(cls, args):
+    """
+        Yields the (model name, id) of the model instances touched by an instruction: the ones it takes as
+        arguments, or the one it creates or destroys.
+    """
+    if cls is InstantiateModel:
+        yield args[0].__name__, args[1]['id']
+    elif cls is DestroyInstance:
+        yield args[0].__name__, args[1]
+    else:
+        for a in args:
+            if isinstance(a, Datamodel):
+                yield type(a).__name__, a.id
+            elif isinstance(a, _Ref):
+                yield tuple(a)
+
+
+def _contains(positions, position):
+    i = bisect_left(positions, position)
+    return i < len(positions) and positions[i] == position
+
+
+class CommitIndex(object):
+    """
+        Positions of the commits (1 for the first commit, see LocalVM.commit_index) which touched each model
+        instance, by (model name, id), and which ran each opcode, transaction boundaries left out. Each key keeps
+        its positions in an ascending array('q'), so find() walks them lazily in either order.
+        LocalVM keeps one up to date at every commit when created with history_index=True.
+    """
+
+    def __init__(self):
+        # (model name, id) -> positions
+        self.models = {}
+        # opcode -> positions
+        self.opcodes = {}
+        # position of the last commit indexed
+        self.position = 0
+
+    @staticmethod
+    def _append(index, key, position):
+        positions = index.get(key)
+        if positions is None:
+            index[key] = array('q', (position, ))
+        elif positions[-1] != position:
+            positions.append(position)
+
+    def add(self, position, pairs):
+        """
+            Indexes the (instruction class, args) pairs of the commit at `position`. Commits up to self.position
+            are indexed already and ignored.
+        """
+        if position <= self.position:
+            return
+        for cls, args in pairs:
+            if cls is BeginTransaction or cls is EndTransaction:
+                continue
+            self._append(self.opcodes, cls.opcode, position)
+            for key in touched(cls, args):
+                self._append(self.models, key, position)
+        self.position = position
+
+    def add_commit(self, position, commit):
+        self.add(position, ((type(i), i.args) for i in commit))
+
+    def add_dump(self, vm, position, dump):
+        """
+            Indexes a commit serialized by Commit.dumps(), without running its instructions or loading the models
+            they reference.
+        """
+        if position <= self.position:
+            return
+        if isinstance(dump, bytes):
+            self.add(position, vm.binary_codec.decode(dump, _ref))
+            return
+        mnemonics = vm.instructions['mnemonics']
+        models = vm.datamodels_idx
+
+        def deserialize(a):
+            if isinstance(a, list) and len(a) == 2:
+                if a[0] == 'DatamodelMeta':
+                    return models[a[1]]
+                if a[0] in models:
+                    return _Ref(a[0], a[1])
+            return a
+
+        self.add(position, ((mnemonics[p[0]], [deserialize(a) for a in p[1:]]) for p in json.loads(dump)))
+
+    def truncate(self, position):
+        """
+            Forgets the commits after `position`.
+        """
+        for index in (self.models, self.opcodes):
+            for key in list(index):
+                positions = index[key]
+                n = bisect_right(positions, position)
+                if not n:
+                    del index[key]
+                elif n < len(positions):
+                    del positions[n:]
+        self.position = min(self.position, position)
+
+    def find(self, model=None, id=None, opcode=None, reverse=False, limit=None):
+        """
+            Yields the positions of the commits which touched a model instance and/or ran an opcode, oldest first,
+            or newest first with reverse=True, up to position `limit` when given.
+            The instance is either a model instance, or a model class or name and an id. The opcode is an opcode
+            or an instruction class.
+        """
+        lists = []
+        if model is not None:
+            if isinstance(model, Datamodel):
+                key = (type(model).__name__, model.id)
+            elif id is None:
+                raise ValueError('No id given for model %s' % (model, ))
+            else:
+                key = (model if isinstance(model, str) else model.__name__, id)
+            lists.append(self.models.get(key, _EMPTY))
+        if opcode is not None:
+            lists.append(self.opcodes.get(getattr(opcode, 'opcode', opcode), _EMPTY))
+        if not lists:
+            raise ValueError('Give a model instance, an opcode or both')
+        lists.sort(key=len)
+        return self._find(lists[0], lists[1:], reverse, limit)
+
+    @staticmethod
+    def _find(positions, others, reverse, limit):
+        end = len(positions) if limit is None else bisect_right(positions, limit)
+        for i in (range(end - 1, -1, -1) if reverse else range(end)):
+            position = positions[i]
+            if all(_contains(other, position) for other in others):
+                yield position
+
+    def save(self, path, chain_head):
+        """
+            Writes the index to `path`, tagged with the hash chain head at self.position (see LocalVM.chain_head).
+            It replaces the previous file only once fully written.
+        """
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, _VERSION, self.position, chain_head.to_bytes(32, 'big')))
+            pickle.dump((self.models, self.opcodes), f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+            Returns (index, chain head at its last position) of an index written by save().
+        """
+        with open(path, 'rb') as f:
+            header = f.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                raise CorruptIndexError('Truncated commit index %s' % (path, ))
+            magic, version, position, chain_head = _HEADER.unpack(header)
+            if magic != _MAGIC or version != _VERSION:
+                raise CorruptIndexError('Invalid commit index %s' % (path, ))
+            try:
+                models, opcodes = pickle.load(f)
+            except Exception as e:
+                raise CorruptIndexError('Corrupt commit index %s: %r' % (path, e))
+        index = cls()
+        index.models = models
+        index.opcodes = opcodes
+        index.position = position
+        return index, int.from_bytes(chain_head, 'big')
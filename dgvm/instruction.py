@@ -83,6 +83,18 @@ class Instruction(metaclass=InstructionMeta):
         self.args = args
         self.model_args = [arg for arg in args if isinstance(arg, Datamodel)]
 
+    @classmethod
+    def _unchecked(cls, args):
+        """
+            Builds an instruction without the checks of __init__, from arguments known to be valid (e.g. replayed).
+        """
+        from .datamodel import Datamodel
+
+        self = cls.__new__(cls)
+        self.args = args
+        self.model_args = [arg for arg in args if isinstance(arg, Datamodel)]
+        return self
+
     def __call__(self, vm):
         map(lambda model: model._to_user_changing_state(), self.model_args)
         try:
@@ -135,6 +147,9 @@ class Instruction(metaclass=InstructionMeta):
         args = parts[1:]
         parsed_args = [deserialize(a) for a in args]
 
+        compiled = vm.compiled.get(cls)
+        if compiled is not None:
+            return compiled.construct(*parsed_args)
         return cls(*parsed_args)
 
 
@@ -157,13 +172,17 @@ class MemberInstruction(Instruction):
         super(MemberInstruction, self).__init__(*args)
 
     def __call__(self, vm):
+        # the models may be the caller's own instances, already changing when called from another instruction
+        states = [model._state for model in self.model_args]
         list(map(lambda model: model._to_user_changing_state(), self.model_args))
         try:
             self.execute(*self.args)
         except Exception as e:
             raise e
         finally:
-            list(map(lambda model: model._to_normal_state(), self.model_args))
+            for model, state in zip(self.model_args, states):
+                if not model.is_destroyed():
+                    model._state = state
 
 
     @classmethod
@@ -189,9 +208,19 @@ class MemberInstructionView(object):
         return setattr(self.__dict__['wrapper'].i, key, value)
 
     def __call__(self, *args, **kwargs):
+        from .vm import LocalVM
+
         model_instance = self.__dict__['instance']
-        mnemonic_form = self.__dict__['wrapper'].i(model_instance, *args, **kwargs).mnemonize()
-        model_instance.vm.execute_from_mnemonic([mnemonic_form])
+        vm = model_instance.vm
+        i = self.__dict__['wrapper'].i
+        if isinstance(vm, LocalVM):
+            # run the instruction as built, with the class the vm registered for its opcode, which differs when
+            # the definitions package was imported under another module path too
+            i = vm.instructions['opcodes'].get(i.opcode, i)
+            c = vm.compiled.get(i)
+            vm.execute([(c.construct if c else i)(model_instance, *args, **kwargs)])
+        else:
+            vm.execute_from_mnemonic([i(model_instance, *args, **kwargs).mnemonize()])
         return None
 
 
@@ -0,0 +1,114 @@
+# coding: utf-8
+__author__ = 'salvia'
+
+import os
+import pickle
+import struct
+
+
+class CorruptSnapshotError(Exception):
+    pass
+
+
+# magic, format version, commit index, hash chain head
+_HEADER = struct.Struct('>8sIQ32s')
+_MAGIC = b'DGVMSNAP'
+_VERSION = 1
+_SUFFIX = '.snap'
+# number of (address, value) pairs pickled together
+_CHUNK = 4096
+
+
+class SnapshotStore(object):
+    """
+        Directory of binary heap snapshots, each one named after the number of commits it contains, and tagged with
+        the hash chain head at that commit (see LocalVM.chain_head). A snapshot is a header followed by pickled
+        chunks of the (address, value) pairs of the heap, so neither writing nor loading one needs a second copy of
+        the heap in memory. A snapshot file only appears once completely written and fsync'ed.
+
+        LocalVM writes one every `every` commits and keeps the newest `keep` ones.
+    """
+
+    def __init__(self, path, every=1000, keep=2):
+        if every < 1 or keep < 1:
+            raise ValueError('every and keep must be >= 1')
+        self.path = path
+        self.every = every
+        self.keep = keep
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _snapshot_path(self, index):
+        return os.path.join(self.path, '%020i%s' % (index, _SUFFIX))
+
+    def indexes(self):
+        """
+            Commit indexes of the stored snapshots, oldest first.
+        """
+        return sorted(int(name[:-len(_SUFFIX)]) for name in os.listdir(self.path) if name.endswith(_SUFFIX))
+
+    def due(self, index):
+        return index % self.every == 0
+
+    def has(self, index):
+        return os.path.exists(self._snapshot_path(index))
+
+    def write(self, heap, index, chain_head):
+        """
+            Writes a snapshot of `heap` after `index` commits, then drops the oldest snapshots.
+        """
+        path = self._snapshot_path(index)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, _VERSION, index, chain_head.to_bytes(32, 'big')))
+            pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+            chunk = []
+            with heap._shared_lock:
+                for item in heap.iter_items():
+                    chunk.append(item)
+                    if len(chunk) == _CHUNK:
+                        pickler.dump(chunk)
+                        pickler.clear_memo()
+                        chunk = []
+            if chunk:
+                pickler.dump(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+        for old in self.indexes()[:-self.keep]:
+            os.remove(self._snapshot_path(old))
+
+    def latest(self):
+        """
+            Returns the commit index of the newest snapshot, or None.
+        """
+        indexes = self.indexes()
+        return indexes[-1] if indexes else None
+
+    def read(self, index):
+        """
+            Returns (chain head, iterator over the (address, value) pairs) of the snapshot taken after `index`
+            commits.
+        """
+        f = open(self._snapshot_path(index), 'rb')
+        header = f.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            f.close()
+            raise CorruptSnapshotError('Truncated snapshot %i' % (index, ))
+        magic, version, stored_index, chain_head = _HEADER.unpack(header)
+        if magic != _MAGIC or version != _VERSION or stored_index != index:
+            f.close()
+            raise CorruptSnapshotError('Invalid snapshot %i' % (index, ))
+
+        def items():
+            with f:
+                while True:
+                    try:
+                        chunk = pickle.load(f)
+                    except EOFError:
+                        return
+                    for item in chunk:
+                        yield item
+
+        return int.from_bytes(chain_head, 'big'), items()
@@ -0,0 +1,112 @@
+import json
+import tempfile
+import time
+import unittest
+
+from dgvm.builtin_instructions import InstantiateModel, DestroyInstance
+from dgvm.codec import CodecError, encode_delta, decode_delta
+from dgvm.data_structures import Heap_Nothing
+from dgvm.datamodel import ntuple
+from dgvm.commit_log import CommitLog
+from dgvm.instruction import Instruction
+from dgvm.vm import LocalVM as VM, Commit, CompactionPolicy
+from dgvm.tests import fixtures
+from dgvm.tests.simple_game_test.datamodels import Infantry, Board, Soldier
+
+
+class CodecTests(unittest.TestCase):
+
+    def test_round_trip(self):
+
+        vm = VM('simple_game_test')
+        fixtures.play(vm, 3, tag='unit')
+        codec = vm.binary_codec
+        previous = 0
+        for commit in vm.commits:
+            data = commit.dumps(codec)
+            assert isinstance(data, bytes)
+            loaded = Commit.loads(vm, data, previous)
+            assert loaded.dumps() == commit.dumps()
+            assert loaded.calc_hash() == commit.calc_hash()
+            previous = commit.calc_hash()
+
+        values = {'id': 7, 'width': -3, 'height': 2 ** 70, 'ratio': 0.1, 'name': 'b\xf6ard', 'none': None,
+                  'flags': [True, False, [1, -1]], 'nested': {'a': (1, 2)}}
+        instructions = [InstantiateModel(Board, values), DestroyInstance(Board, 7)]
+        data = codec.encode(instructions)
+        assert [i.mnemonize() for i in codec.loads(data)] == [i.mnemonize() for i in instructions]
+        self.assertRaises(CodecError, codec.decode, data[:-1])
+        self.assertRaises(CodecError, codec.decode, data + b'\x00')
+        self.assertRaises(CodecError, codec.decode, json.dumps([]).encode('utf-8'))
+
+        other = VM('simple_game_test')
+        other.execute_from_binary(codec.encode([vm.commits[0][1]]))
+        other.commit()
+        assert Board.get_by_id(other, 1).width == 50
+
+    def test_delta(self):
+
+        # heap values come back with their exact type, unlike instruction arguments
+        delta = (('Board/IDCOUNTER', 'Infantry/O/1/position', 'Infantry/O/1/tag', 'Infantry/O/2/health', 7),
+                 (2 ** 70, ntuple(2, 3, -4), None, Heap_Nothing, [(1, 2.5), {'a': [True, False]}, 'b\xf6ard']))
+        addresses, values = decode_delta(encode_delta(delta))
+        assert addresses == delta[0]
+        assert values == delta[1] and isinstance(values[1], ntuple) and values[3] is Heap_Nothing
+        assert isinstance(values[4][0], tuple) and isinstance(values[4], list)
+        data = encode_delta(delta)
+        self.assertRaises(CodecError, decode_delta, data[:-1])
+        self.assertRaises(CodecError, decode_delta, data + b'\x00')
+        self.assertRaises(CodecError, encode_delta, (('Board/O/1/width', ), (object(), )))
+
+    def test_commit_log(self):
+
+        with tempfile.TemporaryDirectory() as path:
+            with CommitLog(path) as log:
+                vm = VM('simple_game_test', commit_log=log, commit_codec='binary')
+                fixtures.play(vm, 3, tag='unit')
+                # a log can mix both encodings
+                vm.commit_codec = 'json'
+                Infantry.get_by_id(vm, 1).move(7, 7)
+                vm.commit()
+                sizes = [len(record) for record in log]
+                assert len(sizes) == vm.commit_index
+
+            with CommitLog(path) as log:
+                recovered = VM('simple_game_test', commit_log=log)
+                assert recovered.chain_head == vm.chain_head
+                assert recovered.state_hash() == vm.state_hash()
+                assert Infantry.get_by_id(recovered, 1).position == (7, 7)
+                assert Soldier.get_by_id(recovered, 1).tag == 'unit'
+
+                recovered = VM('simple_game_test')
+                recovered.replay_stream(log, verify=True)
+                assert recovered.chain_head == vm.chain_head
+
+        self.assertRaises(ValueError, VM, 'simple_game_test', commit_codec='xml')
+
+    def test_performance(self):
+
+        vm = VM('simple_game_test', compaction=CompactionPolicy())
+        fixtures.play(vm, 3000, tag='unit')
+        commits = list(vm.commits)
+        codec = vm.binary_codec
+        n_instructions = sum(len(c) for c in commits)
+
+        decoders = (
+            ('json', None, lambda dump: [Instruction._load(vm, p) for p in json.loads(dump)]),
+            ('binary', codec, codec.loads),
+        )
+        for name, c, decode in decoders:
+            a = time.time()
+            dumps = [commit.dumps(c) for commit in commits]
+            b = time.time()
+            for dump in dumps:
+                decode(dump)
+            d = time.time()
+            size = sum(len(dump.encode('utf-8') if c is None else dump) for dump in dumps)
+            print('%s: %.1f bytes/instruction, encodes %i instructions/s, decodes %i instructions/s' % (
+                name, size / n_instructions, n_instructions / (b - a), n_instructions / (d - b)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+import os
+import tempfile
+import time
+import unittest
+
+from dgvm.commit_log import CommitLog, CorruptLogError
+from dgvm.vm import LocalVM as VM, Commit, decode_record
+from dgvm.tests.simple_game_test.datamodels import Infantry, Board
+
+
+class CommitLogTests(unittest.TestCase):
+
+    def test_append_read(self):
+
+        with tempfile.TemporaryDirectory() as path:
+            with CommitLog(path, segment_size=100) as log:
+                for i in range(50):
+                    assert log.append(('record %i' % i).encode('utf-8')) == i
+                assert len(log) == 50
+                assert len(os.listdir(path)) > 1
+                assert [r.decode('utf-8') for r in log.read(45)] == ['record %i' % i for i in range(45, 50)]
+
+            with CommitLog(path, segment_size=100) as log:
+                assert len(log) == 50
+                assert log.append(b'more') == 50
+                records = list(log)
+                assert len(records) == 51
+                assert records[0] == b'record 0'
+                assert records[-1] == b'more'
+                # single records, from segments written before the log was opened and after
+                assert [log.get(i) for i in (0, 13, 49, 50)] == [b'record 0', b'record 13', b'record 49', b'more']
+                assert next(log.read(37)) == b'record 37'
+                self.assertRaises(IndexError, log.get, 51)
+
+                log.truncate(12)
+                assert len(log) == 12 and list(log.read(10)) == [b'record 10', b'record 11']
+                assert log.append(b'twelve') == 12
+            with CommitLog(path, segment_size=100) as log:
+                assert len(log) == 13 and log.get(12) == b'twelve'
+
+    def test_truncate(self):
+
+        # segments written before the log was opened are only read when needed, truncating included
+        with tempfile.TemporaryDirectory() as path:
+            with CommitLog(path, segment_size=100) as log:
+                for i in range(30):
+                    log.append(('record %i' % i).encode('utf-8'))
+            with CommitLog(path, segment_size=100) as log:
+                first = log._segments[-1]
+                log.truncate(first)
+                assert len(log) == first and log._segments[-1] < first
+                assert log.get(first - 1) == ('record %i' % (first - 1)).encode('utf-8')
+            with CommitLog(path, segment_size=100) as log:
+                self.assertRaises(ValueError, log.truncate, first + 1)
+                log.truncate(5)
+                assert list(log) == [('record %i' % i).encode('utf-8') for i in range(5)]
+                assert log.append(b'five') == 5
+            with CommitLog(path, segment_size=100) as log:
+                assert len(log) == 6 and log.get(5) == b'five'
+                log.truncate(0)
+                assert list(log) == [] and log.append(b'zero') == 0
+
+    def test_torn_tail(self):
+
+        with tempfile.TemporaryDirectory() as path:
+            with CommitLog(path, sync_every=None) as log:
+                log.append(b'first')
+                log.append(b'second')
+
+            segment = os.path.join(path, sorted(os.listdir(path))[-1])
+            with open(segment, 'r+b') as f:
+                f.truncate(os.path.getsize(segment) - 2)
+
+            with CommitLog(path) as log:
+                assert list(log) == [b'first']
+                log.append(b'third')
+                assert list(log) == [b'first', b'third']
+
+            with open(segment, 'r+b') as f:
+                f.seek(10)
+                f.write(b'X')
+            self.assertRaises(CorruptLogError, CommitLog, path)
+
+    def test_sync_interval(self):
+
+        with tempfile.TemporaryDirectory() as path:
+            with CommitLog(path, sync_every=None, sync_interval=0.05) as log:
+                log.append(b'first')
+                log.append(b'second')
+                assert log._unsynced == 2
+                # no append follows, the timer syncs them
+                deadline = time.time() + 5
+                while log._unsynced and time.time() < deadline:
+                    time.sleep(0.01)
+                assert log._unsynced == 0 and log._timer is None
+                log.append(b'third')
+            assert log._timer is None
+
+    def test_vm(self):
+
+        with tempfile.TemporaryDirectory() as path:
+            with CommitLog(path) as log:
+                with VM('simple_game_test', commit_log=log) as vm:
+                    i = Infantry(
+                        vm,
+                        n_units=1,
+                        attack_dmg=1,
+                        armor=0,
+                        health=1,
+                        action=10,
+                        position=(1, 1),
+                        board=Board(vm, width=20, height=20)
+                    )
+                    vm.commit()
+                    i.move(2, 2)
+                    vm.commit()
+
+                    assert len(log) == 2
+                    records = [decode_record(record) for record in log]
+                    assert [hash(Commit.loads(vm, dump, previous)) for previous, _, dump in records] == \
+                        [hash(c) for c in vm.commits]
+                    assert [previous for previous, _, _ in records] == [0, vm.commits[0].calc_hash()]
+                    assert records[-1][1] == vm.chain_head
+
+    def test_fork(self):
+
+        with tempfile.TemporaryDirectory() as path:
+            with CommitLog(path) as log:
+                vm = VM('simple_game_test', commit_log=log)
+                i = Infantry(vm, n_units=1, attack_dmg=1, armor=0, health=1, action=10, position=(1, 1),
+                             board=Board(vm, width=20, height=20))
+                vm.commit()
+                fork = vm.fork()
+                Infantry.get_by_id(fork, i.id).move(2, 2)
+                fork.commit()
+
+                # the fork's commits stay out of the parent's log
+                assert fork.commit_log is None and fork.snapshots is None
+                assert len(log) == 1
+            with CommitLog(path) as log:
+                recovered = VM('simple_game_test', commit_log=log)
+                assert Infantry.get_by_id(recovered, i.id).position == (1, 1)
+                assert recovered.chain_head == vm.chain_head
+
+    def test_performance(self):
+
+        settings = (
+            ('fsync every commit', dict(sync_every=1)),
+            ('fsync every 32 commits', dict(sync_every=32)),
+            ('fsync every 10ms', dict(sync_every=None, sync_interval=0.01)),
+            ('no fsync', dict(sync_every=None)),
+        )
+        for name, options in settings:
+            with tempfile.TemporaryDirectory() as path:
+                with CommitLog(path, **options) as log:
+                    with VM('simple_game_test', commit_log=log) as vm:
+                        board = Board(vm, width=200, height=200)
+                        vm.commit()
+                        a = time.time()
+                        for _ in range(500):
+                            Board(vm, width=10, height=board.id)
+                            vm.commit()
+                        b = time.time()
+                    record = vm.get_last_commit_dump().encode('utf-8')
+                    c = time.time()
+                    for _ in range(2000):
+                        log.append(record)
+                    d = time.time()
+                print('%s: %i VM commits/s, %i log appends/s' % (name, 500 / (b - a), 2000 / (d - c)))
+
+
+if __name__ == '__main__':
+    unittest.main()
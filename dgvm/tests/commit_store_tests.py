@@ -0,0 +1,86 @@
+import gc
+import os
+import time
+import unittest
+
+from dgvm.vm import LocalVM as VM, CompactionPolicy
+from dgvm.tests import fixtures
+from dgvm.tests.simple_game_test.datamodels import Infantry, Soldier
+
+
+def resident_memory():
+    """
+        Resident set size of the process in bytes, or None where /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class CommitStoreTests(unittest.TestCase):
+
+    def test_spill(self):
+
+        full = VM('simple_game_test', heap_hashed=True, undo_records=True)
+        fixtures.play(full, 30)
+        vm = VM('simple_game_test', heap_hashed=True, undo_records=True, history_index=True, resident_commits=4)
+        fixtures.play(vm, 30)
+        vm.commits.cache = 3
+
+        assert len(vm.commits) == len(full.commits) == 34
+        assert vm.commits.spilled() == 30
+        assert [c.calc_hash() for c in vm.commits] == [c.calc_hash() for c in full.commits]
+        assert [c.dumps() for c in vm.commits] == [c.dumps() for c in full.commits]
+        assert vm.commits[0].dumps() == full.commits[0].dumps()
+        assert vm.commits[-1] is vm.get_last_commit()
+        self.assertRaises(IndexError, vm.commits.__getitem__, 34)
+        # read back through the LRU cache
+        assert vm.commits[5] is vm.commits[5]
+        assert len(vm.commits._lru) == 3
+
+        position, commit = next(vm.find_commits(Soldier, 3, reverse=True))
+        assert position == 4 and commit.calc_hash() == full.commits[3].calc_hash()
+
+        # spilled commits keep their undo records
+        vm.rewind_to(10)
+        full.rewind_to(10)
+        assert vm.state_hash() == full.state_hash()
+        assert vm.commits.spilled() == 10
+        vm.fast_forward()
+        full.fast_forward()
+        assert vm.state_hash() == full.state_hash() and vm.chain_head == full.chain_head
+
+        # the commits keep going after a rollback
+        Infantry.get_by_id(vm, 1).move(7, 7)
+        vm.rollback()
+        Infantry.get_by_id(vm, 1).move(8, 8)
+        vm.commit()
+        assert vm.commits[-1].calc_hash() == vm.chain_head
+        assert len(vm.fork().commits) == 0
+
+        self.assertRaises(ValueError, VM, 'simple_game_test', resident_commits=0)
+
+    def test_performance(self):
+
+        n = 20000
+        for resident in (None, 1000):
+            gc.collect()
+            before = resident_memory()
+            vm = VM('simple_game_test', compaction=CompactionPolicy(), resident_commits=resident)
+            a = time.time()
+            fixtures.play(vm, n)
+            b = time.time()
+            gc.collect()
+            after = resident_memory()
+            assert len(vm.commits) == n + 4
+            memory = 'unknown' if before is None else '%.1f MB' % ((after - before) / 2 ** 20, )
+            print('resident_commits=%s: %i commits/s, resident memory grew by %s' % (
+                resident, n / (b - a), memory))
+            vm.commits.close()
+            del vm
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+import time
+import unittest
+
+from dgvm.builtin_instructions import InstantiateModel, DestroyInstance, CollapseHeap
+from dgvm.compiler import compile_instructions
+from dgvm.datamodel.meta import DatamodelStates
+from dgvm.vm import LocalVM as VM, CompactionPolicy
+from dgvm.tests import fixtures
+from dgvm.tests.simple_game_test.datamodels import Infantry, Board, Soldier
+from dgvm.tests.simple_game_test.datamodels.tank import Tank
+
+
+def outcome(f, *args, **kwargs):
+    try:
+        f(*args, **kwargs)
+    except Exception as e:
+        return type(e).__name__
+    return None
+
+
+class CompilerTests(unittest.TestCase):
+
+    def play(self, vm):
+        """
+            Runs a game through every instruction of simple_game_test, including failing calls, and returns the
+            outcome of each step.
+        """
+        steps = []
+        board = Board(vm, width=20, height=20)
+        units = fixtures.make_units(vm, board, 2, armor=1, health=10, action=50)
+        tanks = [Tank(vm, attack_dmg=5, armor=2, health=30, action=60, position=(5, i), board=board) for i in range(2)]
+        vm.commit()
+
+        steps.append(outcome(units[0].move, 3, 4))
+        steps.append(outcome(units[1].move, 2, 2))
+        steps.append(outcome(tanks[0].move, 6, 6))
+        steps.append(outcome(units[2].attack, units[3]))
+        steps.append(outcome(units[3].attack, units[0]))
+        steps.append(outcome(tanks[1].attack, tanks[0]))
+        vm.commit()
+
+        # constraint violations, off the board and out of action
+        steps.append(outcome(units[0].move, 30, 30))
+        steps.append(outcome(units[1].move, 19, 19))
+        steps.append(outcome(tanks[0].move, -1, 0))
+        vm.commit()
+        # the same model twice
+        steps.append(outcome(units[2].attack, units[2]))
+        steps.append(outcome(tanks[0].attack, tanks[0]))
+        vm.commit()
+
+        # bad calls
+        steps.append(outcome(units[0].move, 1))
+        steps.append(outcome(units[0].move, 1, '1'))
+        steps.append(outcome(units[0].attack, 3))
+        steps.append(outcome(units[0].move, x=1, y=1))
+
+        # rolled back work
+        units[3].move(4, 4)
+        vm.rollback()
+        vm.commit()
+
+        units[1].destroy()
+        steps.append(outcome(lambda: units[1].move(1, 1)))
+        steps.append(outcome(units[0].attack, units[1]))
+        vm.commit()
+
+        vm.execute([CollapseHeap(1)])
+        vm.commit()
+        steps.append([u._state for u in units + tanks])
+        return steps
+
+    def test_parity(self):
+
+        interpreted = VM('simple_game_test', heap_hashed=True, compiled=False)
+        compiled = VM('simple_game_test', heap_hashed=True)
+        assert not interpreted.compiled and compiled.compiled
+
+        steps = self.play(interpreted)
+        assert steps == self.play(compiled)
+        assert 'ConstraintViolation' in steps and 'BadInstructionCall' in steps and 'TypeError' in steps
+        assert 'ModelDestroyedError' in steps
+        assert compiled.state_hash() == interpreted.state_hash()
+        assert compiled.chain_head == interpreted.chain_head
+        assert [c.dumps() for c in compiled.commits] == [c.dumps() for c in interpreted.commits]
+        assert [type(i) for c in compiled.commits for i in c] == [type(i) for c in interpreted.commits for i in c]
+
+    def test_construct(self):
+
+        vm = VM('simple_game_test')
+        board = Board(vm, width=20, height=20)
+        unit = Infantry(vm, n_units=1, attack_dmg=3, armor=1, health=10, action=50, position=(1, 1), board=board)
+        vm.commit()
+
+        samples = [(), (1, ), (unit, ), (unit, 1), (unit, 1, 2), (unit, unit), (unit, '1', 2), (Board, 1),
+                   (Board, {'id': 1}), (1, 2, 3)]
+        for cls, c in vm.compiled.items():
+            assert c.cls is cls
+            if cls in (InstantiateModel, DestroyInstance):
+                assert c.construct is cls
+            for args in samples:
+                expected, got = outcome(cls, *args), outcome(c.construct, *args)
+                assert expected == got, (cls, args, expected, got)
+                if expected is None:
+                    a, b = cls(*args), c.construct(*args)
+                    assert type(a) is type(b) and a.args == b.args and a.model_args == b.model_args
+                    assert a.mnemonize() == b.mnemonize()
+
+        # compiled once per definitions package
+        assert VM('simple_game_test').compiled is vm.compiled
+        assert compile_instructions('simple_game_test', [vm.get_instruction('INF.MOVE')]) is vm.compiled
+        assert 'USER_CHANGING' in vm.compiled[vm.get_instruction('INF.MOVE')].source
+
+    def test_performance(self):
+
+        for compiled in (False, True):
+            vm = VM('simple_game_test', compaction=CompactionPolicy(keep=1, batch=1), compiled=compiled)
+            board = Board(vm, width=20, height=20)
+            unit = Infantry(vm, n_units=1, attack_dmg=3, armor=1, health=10, action=10 ** 9, position=(1, 1),
+                            board=board)
+            other = Soldier(vm, n_units=1, attack_dmg=3, armor=1, health=10 ** 9, action=10 ** 9, position=(1, 1),
+                            board=board)
+            vm.commit()
+            a = time.time()
+            for n in range(3000):
+                unit.move(1 + n % 2, 1)
+                unit.attack(other)
+                if n % 10 == 9:
+                    vm.commit()
+            b = time.time()
+            assert unit._state == DatamodelStates.NORMAL
+            print('%s: %i member instruction calls/s' % ('compiled' if compiled else 'interpreted', 6000 / (b - a)))
+
+
+if __name__ == '__main__':
+    unittest.main()
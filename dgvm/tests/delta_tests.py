@@ -0,0 +1,120 @@
+import tempfile
+import time
+import unittest
+
+from dgvm.commit_log import CommitLog
+from dgvm.codec import BinaryCodec
+from dgvm.vm import LocalVM as VM, CompactionPolicy, decode_record, encode_record
+from dgvm.tests import fixtures
+from dgvm.tests.simple_game_test.datamodels import Infantry, Board, Soldier
+
+
+class DeltaTests(unittest.TestCase):
+
+    def play(self, vm, moves, codec=None):
+        records = []
+
+        def record():
+            vm.commit()
+            records.append(encode_record(vm.get_last_commit(), codec))
+
+        board = Board(vm, width=50, height=50)
+        record()
+        units = fixtures.make_units(vm, board)
+        record()
+        units[2].attack(units[3])
+        units[3].attack(units[0])
+        record()
+        units[5].destroy()
+        units[1].move(4, 4)
+        units[1].destroy()
+        record()
+        for i in range(moves):
+            units[i % 3 * 2].move(1 + i % 3, 1 + i % 5)
+            units[2].attack(units[i % 2 * 4])
+            record()
+        return records
+
+    def test_deltas(self):
+
+        leader = VM('simple_game_test', heap_hashed=True, delta_commits=True, history_index=True)
+        records = self.play(leader, 20)
+        binary = self.play(VM('simple_game_test', heap_hashed=True, delta_commits=True), 20, BinaryCodec(leader))
+        assert all(c.delta is not None and len(c.delta[0]) for c in leader.commits)
+        # deletes are part of the delta
+        assert 'Soldier/O/3/health' in dict(zip(*leader.commits[3].delta))
+
+        follower = VM('simple_game_test', heap_hashed=True, history_index=True)
+        for r in records:
+            commit = follower.apply_delta(r)
+            assert decode_record(encode_record(commit))[2] == decode_record(r)[2]
+        assert fixtures.state(follower) == fixtures.state(leader)
+        assert [p for p, _ in follower.find_commits(Soldier, 2)] == [p for p, _ in leader.find_commits(Soldier, 2)]
+
+        for stream, deltas in ((records, True), (records, False), (binary, True), (binary, False)):
+            replica = VM('simple_game_test', heap_hashed=True)
+            assert replica.replay_stream(stream, batch_size=7, deltas=deltas) == len(records)
+            assert fixtures.state(replica) == fixtures.state(leader), deltas
+            # records without a delta still replay
+            plain = VM('simple_game_test', heap_hashed=True)
+            plain.replay_stream([encode_record(c) for c in replica.commits])
+            assert fixtures.state(plain) == fixtures.state(leader)
+        self.assertRaises(ValueError, plain.apply_delta, encode_record(plain.get_last_commit()))
+
+        # the delta is logged with the commit, and spilled commits keep it
+        with tempfile.TemporaryDirectory() as path:
+            with CommitLog(path) as log:
+                vm = VM('simple_game_test', heap_hashed=True, delta_commits=True, commit_log=log, resident_commits=2)
+                self.play(vm, 20)
+                assert vm.commits[0].delta == leader.commits[0].delta
+            with CommitLog(path) as log:
+                recovered = VM('simple_game_test', heap_hashed=True, commit_log=log)
+                assert fixtures.state(recovered) == fixtures.state(leader)
+
+    def test_performance(self):
+
+        n = 3000
+        leader = VM('simple_game_test', compaction=CompactionPolicy(), delta_commits=True)
+        board = Board(leader, width=50, height=50)
+        units = [Infantry(leader, n_units=1, attack_dmg=3, armor=0, health=10 ** 6, action=10 ** 9, position=(i, i),
+                          board=board) for i in range(20)]
+        leader.commit()
+        records = [encode_record(leader.get_last_commit(), leader.binary_codec)]
+        for i in range(n):
+            # every move and attack checks the action limit, and moves the board bounds of the related board
+            for j in range(4):
+                unit = units[(i + j) % 20]
+                unit.move((i + j) % 50, (i * 7 + j) % 50)
+                unit.attack(units[(i + j + 1) % 20])
+            leader.commit()
+            records.append(encode_record(leader.get_last_commit(), leader.binary_codec))
+        for c in leader.commits:
+            c.delta = None
+        plain = [encode_record(c, leader.binary_codec) for c in leader.commits]
+        print('record size: %.0f bytes with the delta, %.0f without' % (
+            sum(map(len, records)) / float(len(records)), sum(map(len, plain)) / float(len(plain))))
+
+        for deltas in (False, True):
+            replica = VM('simple_game_test')
+            a = time.time()
+            replica.replay_stream(records, deltas=deltas)
+            b = time.time()
+            assert replica.state_hash() == leader.state_hash()
+            print('replay_stream, deltas=%s: %i commits/s' % (deltas, len(records) / (b - a)))
+
+        replica = VM('simple_game_test', compaction=CompactionPolicy())
+        a = time.time()
+        for record in records[:1000]:
+            replica.replay(decode_record(record)[2])
+        b = time.time()
+        follower = VM('simple_game_test')
+        for record in records[:1000]:
+            follower.apply_delta(record)
+        c = time.time()
+        assert follower.state_hash() == replica.state_hash()
+        print('one record at a time: %i commits/s with replay(), %i with apply_delta()' % (
+            1000 / (b - a), 1000 / (c - b)))
+
+
+if __name__ == '__main__':
+    unittest.main()
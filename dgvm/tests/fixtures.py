@@ -0,0 +1,54 @@
+from dgvm.tests.simple_game_test.datamodels import Infantry, Board, Soldier
+
+
+# attributes of the units made by make_units(), unless given
+UNIT = dict(n_units=1, attack_dmg=3, armor=0, health=1000, action=10 ** 9)
+
+
+def make_units(vm, board=None, n=3, first=0, **values):
+    """
+        Creates an Infantry and a Soldier at (i, i) for each of the `n` positions from `first` on, on `board` or on a
+        new 50x50 Board, and returns them in that order. `values` override the attributes in UNIT.
+    """
+    if board is None:
+        board = Board(vm, width=50, height=50)
+    values = dict(UNIT, **values)
+    units = []
+    for i in range(first, first + n):
+        for model in (Infantry, Soldier):
+            units.append(model(vm, position=(i, i), board=board, **values))
+    return units
+
+
+def play(vm, moves, commit=None, **values):
+    """
+        Plays the game most tests share, committing each step with commit(vm), vm.commit() by default: a board,
+        three pairs of units (see make_units), an attack, a destroy, then `moves` moves. Returns the units.
+    """
+    if commit is None:
+        commit = type(vm).commit
+    board = Board(vm, width=50, height=50)
+    commit(vm)
+    units = make_units(vm, board, **values)
+    commit(vm)
+    units[2].attack(units[3])
+    commit(vm)
+    units[5].destroy()
+    commit(vm)
+    for i in range(moves):
+        units[i % 3].move(1 + i % 3, 1 + i % 5)
+        commit(vm)
+    return units
+
+
+def state(vm, near=(1, 1), distance=2):
+    """
+        What the tests compare VMs by: state hash, chain head, the live units and the Infantry ids found by the
+        spatial index near a position.
+    """
+    return (
+        vm.state_hash(),
+        vm.chain_head,
+        sorted((type(u).__name__, u.id, u.position, u.health) for m in (Infantry, Soldier) for u in m.objects(vm)),
+        sorted(u.id for u in Infantry.objects(vm).near('position', near, distance)),
+    )
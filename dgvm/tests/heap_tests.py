@@ -1,13 +1,21 @@
+__author__ = 'salvia'
+import random
+import threading
+import time
+import tracemalloc
 import unittest
 
-from dgvm.data_structures import Heap
+from dgvm.data_structures import Heap, FlatHeap, FlatLayer, VersionedHeap, PersistentHeap, PersistentMap, \
+    ReadWriteLock, SpatialGrid, HashedTreect
 
 
 class HeapTests(unittest.TestCase):
 
+    heap_class = Heap
+
     def test_history(self):
 
-        t = Heap(128)
+        t = self.heap_class(128)
         t.checkpoint()
         t[0] = 1
 
@@ -31,23 +39,698 @@ class HeapTests(unittest.TestCase):
 
         assert t[0] == 'abcde'
 
+    def test_delete(self):
 
-if __name__ == '__main__':
-    unittest.main()
+        t = self.heap_class(128)
+        t['Infantry/O/1/health'] = 10
+        t['Infantry/O/1/armor'] = 2
+        t.checkpoint()
+        del t['Infantry/O/1/health']
+
+        assert t.get('Infantry/O/1/health') is None
+        assert len(t) == 1
 
+        t.revert()
+
+        assert t['Infantry/O/1/health'] == 10
+        assert len(t) == 2
+
+    def test_all_items(self):
+
+        t = self.heap_class(128)
+        t['Infantry/O/1/health'] = 10
+        t['Infantry/O/2/health'] = 20
+        t['Board/O/1/width'] = 20
+        t.checkpoint()
+        t['Infantry/O/2/health'] = 15
+        t['Infantry/O/3/health'] = 30
+        del t['Infantry/O/1/health']
+
+        assert dict(t.all_items('Infantry/O')) == {
+            'Infantry/O/2/health': 15,
+            'Infantry/O/3/health': 30,
+        }
+        assert dict(t.all_items('Board')) == {'Board/O/1/width': 20}
+        assert dict(t.all_items('Tank')) == {}
+        assert len(list(t.all_items())) == 3
+        assert dict(t.make_collapsed().all_items()) == dict(t.all_items())
+
+        t.collapse()
+
+        assert dict(t.all_items()) == {
+            'Infantry/O/2/health': 15,
+            'Infantry/O/3/health': 30,
+            'Board/O/1/width': 20,
+        }
+
+    def test_collapse_keep(self):
+
+        t = self.heap_class(128)
+        t['a/b'] = 0
+        t['a/c'] = 0
+        for i in range(1, 6):
+            t.checkpoint()
+            t['a/b'] = i
+        del t['a/c']
+
+        t.collapse(2)
+
+        assert t.depth() == 2
+        assert t['a/b'] == 5
+        assert t.get('a/c') is None
 
+        t.revert()
 
+        assert t['a/b'] == 4
+        assert t['a/c'] == 0
 
+        t.revert()
 
+        assert t['a/b'] == 3
+        self.assertRaises(ValueError, t.revert)
 
+        t.collapse()
 
+        assert t.depth() == 0
+        assert dict(t.all_items()) == {'a/b': 3, 'a/c': 0}
 
+    def test_merge(self):
 
+        t = self.heap_class(128)
+        columns = t.columns
+        health = columns.column('Infantry', 'health', 'q', int)
+        t['a/b'] = 0
+        t['a/c'] = 0
+        t.checkpoint()
+        t['a/b'] = 1
+        t.checkpoint()
+        t['a/b'] = 2
+        del t['a/c']
+        columns.set(health, 1, 10)
+        t.checkpoint()
+        t['a/c'] = 3
+        t['a/d'] = 4
 
+        t.merge()
 
+        assert t.depth() == 2
+        assert dict(t.all_items()) == {'a/b': 2, 'a/c': 3, 'a/d': 4, 'Infantry/O/1/health': 10}
+        assert len(t) == 4
 
+        t.merge()
+        t.checkpoint()
+        t['a/b'] = 5
+        t.revert()
 
+        assert t['a/b'] == 2
 
+        t.revert()
 
+        assert t.depth() == 0
+        assert dict(t.all_items()) == {'a/b': 0, 'a/c': 0}
+        assert len(t) == 2
 
+        t.checkpoint()
+        t['a/b'] = 6
+        t.merge()
+
+        assert t.depth() == 0 and t['a/b'] == 6
+        self.assertRaises(ValueError, t.merge)
+
+    def test_len(self):
+
+        # counted after every operation, and only now and then, so merges and collapses carry the count along
+        for every in (1, 25):
+            rnd = random.Random(7)
+            t = self.heap_class(128)
+
+            for n in range(2000):
+                op = rnd.random()
+                key = 'Infantry/O/%i/health' % rnd.randint(1, 20)
+                if op < 0.4:
+                    t[key] = rnd.randint(0, 100)
+                elif op < 0.6:
+                    del t[key]
+                elif op < 0.75:
+                    t.checkpoint()
+                elif op < 0.85 and t.depth():
+                    t.revert()
+                elif op < 0.95 and t.depth():
+                    t.merge()
+                elif op >= 0.95:
+                    t.collapse(rnd.randint(0, t.depth()))
+
+                if not n % every:
+                    assert len(t) == len(list(t.all_items()))
+
+        assert t.percent_used() == len(t) / 128.0 * 100
+
+    def test_snapshot(self):
+
+        t = self.heap_class(128, 'rw')
+        t['a/b'] = 1
+        t.checkpoint()
+        t['a/c'] = 2
+        snapshot = t.snapshot()
+        t['a/b'] = 3
+        t.revert()
 
+        assert dict(snapshot.all_items()) == {'a/b': 1, 'a/c': 2}
+        assert snapshot['a/c'] == 2
+        assert len(snapshot) == 2
+        assert dict(t.all_items()) == {'a/b': 1}
+        with self.assertRaises(TypeError):
+            snapshot['a/b'] = 4
+
+    def test_state_hash(self):
+
+        rnd = random.Random(5)
+        t = self.heap_class(128, hashed=True)
+        hashes = [t.state_hash()]
+
+        for _ in range(2000):
+            op = rnd.random()
+            key = 'Infantry/O/%i/%s' % (rnd.randint(1, 10), rnd.choice(('health', 'position')))
+            if op < 0.45:
+                t[key] = rnd.randint(0, 5) if key.endswith('health') else (rnd.randint(0, 2), 1)
+            elif op < 0.6:
+                del t[key]
+            elif op < 0.8:
+                t.checkpoint()
+                hashes.append(t.state_hash())
+            elif op < 0.95 and t.depth():
+                t.revert()
+                assert t.state_hash() == hashes.pop()
+            elif op >= 0.95:
+                keep = rnd.randint(0, t.depth())
+                t.collapse(keep)
+                del hashes[1:len(hashes) - keep]
+
+            if op < 0.6:
+                reference = Heap(128)
+                for k, v in t.all_items():
+                    reference[k] = v
+                assert t.state_hash() == reference.state_hash()
+                assert t.diff(t.fork()) == []
+
+        t.collapse()
+        t.checkpoint()
+        f = t.fork()
+        t['Infantry/O/3/health'] = -1
+        t['Tank/O/1/health'] = 1
+        t.columns.set(t.columns.column('Soldier', 'morale', 'd', float), 1, 0.5)
+        assert sorted(t.diff(f)) == ['Infantry/O/3/health', 'Soldier/O/1/morale', 'Tank/O/1/health']
+        t.revert()
+        assert t.diff(f) == []
+        assert t.state_hash() == f.state_hash() == HashedTreect(dict(f.all_items())).hash
+
+    def test_columns(self):
+
+        t = self.heap_class(128)
+        columns = t.columns
+        health = columns.column('Infantry', 'health', 'q', int)
+        t['Infantry/O/1/_id'] = 1
+        columns.set(health, 1, 10)
+        t.checkpoint()
+        columns.set(health, 1, 5)
+        columns.set(health, 2, None)
+        t.checkpoint()
+        columns.delete(health, 1)
+
+        assert len(t) == 2
+        self.assertRaises(KeyError, health.get, 1)
+
+        t.revert()
+
+        assert health.get(1) == 5
+        assert health.get(2) is None
+        assert dict(t.all_items('Infantry/O/2')) == {'Infantry/O/2/health': None}
+        assert len(t) == 3
+
+        t.collapse()
+        self.assertRaises(ValueError, t.revert)
+
+        f = t.fork()
+        f.columns.set(f.columns.columns['Infantry/health'], 1, 1)
+
+        assert health.get(1) == 5
+        assert dict(f.all_items()) == {'Infantry/O/1/_id': 1, 'Infantry/O/1/health': 1, 'Infantry/O/2/health': None}
+
+    def test_parity(self):
+
+        rnd = random.Random(42)
+        reference = Heap(128)
+        t = self.heap_class(128)
+        depth = 0
+
+        for _ in range(5000):
+            op = rnd.random()
+            key = 'Infantry/O/%i/health' % rnd.randint(1, 20)
+            if op < 0.4:
+                value = rnd.randint(0, 100)
+                reference[key] = value
+                t[key] = value
+            elif op < 0.55:
+                del reference[key]
+                del t[key]
+            elif op < 0.75:
+                reference.checkpoint()
+                t.checkpoint()
+                depth += 1
+            elif op < 0.95 and depth:
+                reference.revert()
+                t.revert()
+                depth -= 1
+            elif op >= 0.95:
+                keep = rnd.randint(0, depth)
+                reference.collapse(keep)
+                t.collapse(keep)
+                depth = min(depth, keep)
+
+            assert t.get(key) == reference.get(key)
+
+        assert dict(t.all_items()) == dict(reference.all_items())
+        assert len(t) == len(reference)
+
+    def test_iter_items(self):
+
+        rnd = random.Random(11)
+        t = self.heap_class(128)
+        # one full copy of the expected state per checkpoint
+        states = [{}]
+
+        for _ in range(3000):
+            op = rnd.random()
+            key = 'Infantry/O/%i/%s' % (rnd.randint(1, 10), rnd.choice(('health', 'armor')))
+            if op < 0.45:
+                states[-1][key] = t[key] = rnd.randint(0, 100)
+            elif op < 0.6:
+                states[-1].pop(key, None)
+                del t[key]
+            elif op < 0.8:
+                t.checkpoint()
+                states.append(dict(states[-1]))
+            elif op < 0.95 and t.depth():
+                t.revert()
+                states.pop()
+            elif op >= 0.95:
+                keep = rnd.randint(0, t.depth())
+                t.collapse(keep)
+                del states[:len(states) - 1 - keep]
+
+            assert dict(t.iter_items()) == states[-1]
+            assert len(list(t.iter_items())) == len(states[-1])
+            assert dict(t.iter_items('Infantry/O/3')) == {
+                k: v for k, v in states[-1].items() if k.startswith('Infantry/O/3/')
+            }
+
+        assert dict(t.make_collapsed().all_items()) == states[-1]
+
+
+class FlatHeapTests(HeapTests):
+
+    heap_class = FlatHeap
+
+    def test_prefix_index(self):
+
+        t = FlatLayer()
+        t['a/b/c'] = 1
+        t['a/b/d'] = 2
+        t['a/e'] = 3
+
+        assert dict(t.all_items('a/b')) == {'a/b/c': 1, 'a/b/d': 2}
+
+        # index is now built, so it must follow writes and deletes
+        t['a/b/f'] = 4
+        del t['a/b/c']
+        del t['a/e']
+
+        assert dict(t.all_items('a/b')) == {'a/b/d': 2, 'a/b/f': 4}
+        assert dict(t.all_items('a')) == {'a/b/d': 2, 'a/b/f': 4}
+        assert t.to_dict() == {'a': {'b': {'d': 2, 'f': 4}}}
+
+        del t['a/b/d']
+        del t['a/b/f']
+
+        assert list(t.all_items('a')) == []
+        assert t._index == {}
+
+    def test_performance(self):
+
+        for heap_class in (Heap, FlatHeap):
+            for depth in (1, 4, 8, 16):
+                h = heap_class(128)
+                keys = ['/'.join(['k'] * (depth - 1) + [str(i)]) for i in range(100)]
+                for key in keys:
+                    h[key] = 1
+                for _ in range(9):
+                    h.checkpoint()
+
+                a = time.time()
+                for _ in range(100):
+                    for key in keys:
+                        h[key]
+                b = time.time()
+                print('%s: 10k reads at depth %i through 10 layers took: %f' % (heap_class.__name__, depth, b - a))
+
+
+class VersionedHeapTests(HeapTests):
+
+    heap_class = VersionedHeap
+
+    def test_performance(self):
+
+        for heap_class in (Heap, VersionedHeap):
+            for n_checkpoints in (10, 100, 1000):
+                h = heap_class(128)
+                keys = ['Infantry/O/%i/health' % i for i in range(100)]
+                for key in keys:
+                    h[key] = 1
+                for i in range(n_checkpoints):
+                    h.checkpoint()
+                    h[keys[i % 100]] = i
+
+                a = time.time()
+                for _ in range(10):
+                    for key in keys:
+                        h[key]
+                b = time.time()
+                print('%s: 1k reads over %i checkpoints took: %f' % (heap_class.__name__, n_checkpoints, b - a))
+
+
+class ConcurrencyTests(unittest.TestCase):
+
+    def test_rw_lock(self):
+
+        lock = ReadWriteLock()
+        readers = threading.Barrier(3, timeout=5)
+
+        def read():
+            with lock.shared:
+                # only passes if all three readers are inside at once
+                readers.wait()
+
+        threads = [threading.Thread(target=read) for _ in range(3)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+
+        with lock:
+            with lock:
+                with lock.shared:
+                    pass
+            th = threading.Thread(target=lambda: lock.shared.__enter__() and lock.release_read())
+            th.start()
+            th.join(0.05)
+            # readers from other threads wait for the writer
+            assert th.is_alive()
+        th.join(5)
+        assert not th.is_alive()
+
+        # writers are preferred: new readers wait behind a waiting writer, while the current ones may read again
+        with lock.shared:
+            writer = threading.Thread(target=lambda: lock.acquire() and lock.release())
+            writer.start()
+            while not lock._waiting_writers:
+                time.sleep(0.001)
+            reader = threading.Thread(target=lambda: lock.shared.__enter__() and lock.release_read())
+            reader.start()
+            with lock.shared:
+                reader.join(0.05)
+                assert reader.is_alive() and writer.is_alive()
+        writer.join(5)
+        reader.join(5)
+        assert not writer.is_alive() and not reader.is_alive()
+
+    def _read_throughput(self, heap, reader, nthreads, reads=20000):
+
+        stop = threading.Event()
+        transactions = [0]
+
+        def write():
+            i = 0
+            while not stop.is_set():
+                # a transaction: holds the heap for a while and writes a few addresses
+                with heap._lock:
+                    heap.checkpoint()
+                    for j in range(50):
+                        heap['Infantry/O/%i/health' % j] = i
+                    time.sleep(0.001)
+                    heap.collapse()
+                i += 1
+                transactions[0] = i
+                time.sleep(0.001)
+
+        def read():
+            r = reader()
+            for i in range(reads):
+                r['Infantry/O/%i/health' % (i % 1000)]
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        threads = [threading.Thread(target=read) for _ in range(nthreads)]
+        a = time.time()
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        b = time.time()
+        stop.set()
+        writer.join()
+        return nthreads * reads / (b - a), transactions[0] / (b - a)
+
+    def test_performance(self):
+
+        for mode in ('lock', 'rw', 'snapshot'):
+            heap = Heap(1000, 'lock' if mode == 'lock' else 'rw')
+            for i in range(1000):
+                heap['Infantry/O/%i/health' % i] = i
+            reader = heap.snapshot if mode == 'snapshot' else (lambda: heap)
+            # every thread shares the GIL, so aggregate read throughput can't grow much with threads; what changes
+            # between modes is how much the readers and the writer stall each other
+            for nthreads in (1, 2, 4, 8):
+                print('%s reads, %i threads: %i reads/s, writer got %i transactions/s' % (
+                    (mode, nthreads) + self._read_throughput(heap, reader, nthreads)))
+
+
+class SpatialIndexTests(unittest.TestCase):
+
+    def test_grid(self):
+
+        rnd = random.Random(3)
+        grid = SpatialGrid(5)
+        positions = {}
+        for _ in range(2000):
+            id = rnd.randint(1, 200)
+            position = (rnd.randint(-50, 50), rnd.randint(-50, 50)) if rnd.random() < 0.8 else None
+            assert grid.put(id, position) == positions.get(id)
+            if position is None:
+                positions.pop(id, None)
+            else:
+                positions[id] = position
+
+        for _ in range(100):
+            center = (rnd.randint(-60, 60), rnd.randint(-60, 60))
+            radius = rnd.choice((0, 1, 4, 7.5, 30, 200))
+            expected = sorted(
+                id for id, p in positions.items()
+                if (p[0] - center[0]) ** 2 + (p[1] - center[1]) ** 2 <= radius ** 2
+            )
+            assert grid.within(center, radius) == expected
+            assert grid.at(center) == sorted(id for id, p in positions.items() if p == center)
+
+    def test_revert(self):
+
+        t = Heap(128)
+        t.spatial.move('Infantry/position', 4, 1, (1, 1))
+        t.checkpoint()
+        t.spatial.move('Infantry/position', 4, 1, (10, 10))
+        t.spatial.move('Infantry/position', 4, 2, (1, 2))
+        f = t.fork()
+        t.revert()
+
+        grid = t.spatial.grids['Infantry/position']
+        assert grid.within((0, 0), 3) == [1]
+        assert grid.at((10, 10)) == []
+        assert f.spatial.grids['Infantry/position'].within((0, 0), 3) == [2]
+
+        # forking shares the grid, and a move on either side leaves the other alone
+        p = PersistentHeap(128)
+        p.spatial.move('Infantry/position', 4, 1, (1, 1))
+        f = p.fork()
+        assert f.spatial.grids['Infantry/position'].cells is p.spatial.grids['Infantry/position'].cells
+        f.spatial.move('Infantry/position', 4, 1, (10, 10))
+        p.spatial.move('Infantry/position', 4, 2, (1, 2))
+        assert p.spatial.grids['Infantry/position'].within((0, 0), 3) == [1, 2]
+        assert f.spatial.grids['Infantry/position'].within((0, 0), 3) == []
+        assert f.spatial.grids['Infantry/position'].at((10, 10)) == [1]
+
+    def test_performance(self):
+
+        for n in (10000, 100000):
+            rnd = random.Random(n)
+            side = int((n * 10) ** 0.5)
+            heap = Heap(n)
+            for id in range(1, n + 1):
+                position = (rnd.randint(0, side), rnd.randint(0, side))
+                heap['Infantry/O/%i/position' % id] = position
+                heap.spatial.move('Infantry/position', 8, id, position)
+            grid = heap.spatial.grids['Infantry/position']
+            centers = [(rnd.randint(0, side), rnd.randint(0, side)) for _ in range(100)]
+
+            a = time.time()
+            # the scan reads every position through the heap, so only time a few of them
+            for x, y in centers[-5:]:
+                found = []
+                for id in range(1, n + 1):
+                    px, py = heap['Infantry/O/%i/position' % id]
+                    if (px - x) ** 2 + (py - y) ** 2 <= 100:
+                        found.append(id)
+            b = time.time()
+            for center in centers:
+                assert len(grid.within(center, 10)) >= 0
+            c = time.time()
+            assert grid.within(centers[-1], 10) == found
+            print('%i units, one radius-10 query: linear scan took: %f, spatial index took: %f' % (
+                n, (b - a) / 5, (c - b) / 100))
+
+
+class MerkleTests(unittest.TestCase):
+
+    def test_performance(self):
+
+        plain = Heap(100000)
+        hashed = Heap(100000, hashed=True)
+        for heap in (plain, hashed):
+            a = time.time()
+            for i in range(100000):
+                heap['Infantry/O/%i/health' % i] = i
+            b = time.time()
+            print('%s: 100k writes took: %f' % ('hashed' if heap.merkle else 'plain', b - a))
+
+        other = hashed.fork()
+        for i in range(0, 100000, 10000):
+            other['Infantry/O/%i/health' % i] = -i
+
+        a = time.time()
+        assert dict(hashed.all_items()) != dict(other.all_items())
+        b = time.time()
+        equal = hashed.state_hash() == other.state_hash()
+        c = time.time()
+        diff = hashed.diff(other)
+        d = time.time()
+        assert not equal and len(diff) == 9
+        print('100k addresses: comparing all items took: %f, comparing state_hash took: %f, '
+              'diff of 9 changes took: %f' % (b - a, c - b, d - c))
+
+
+class CollidingKey(object):
+
+    def __init__(self, n):
+        self.n = n
+
+    def __hash__(self):
+        return self.n % 3
+
+    def __eq__(self, other):
+        return isinstance(other, CollidingKey) and other.n == self.n
+
+
+class PersistentHeapTests(HeapTests):
+
+    heap_class = PersistentHeap
+
+    def test_map(self):
+
+        rnd = random.Random(3)
+        m = PersistentMap()
+        d = {}
+        snapshots = []
+
+        for _ in range(5000):
+            k = rnd.choice([rnd.randint(0, 300), CollidingKey(rnd.randint(0, 30))])
+            if rnd.random() < 0.6:
+                v = rnd.random()
+                m = m.set(k, v)
+                d[k] = v
+            else:
+                m = m.delete(k)
+                d.pop(k, None)
+            if rnd.random() < 0.01:
+                snapshots.append((m, dict(d)))
+
+        assert len(m) == len(d)
+        assert dict(m.items()) == d
+        for k, v in d.items():
+            assert m[k] == v
+
+        # older versions are left untouched by later writes
+        for snapshot, expected in snapshots:
+            assert dict(snapshot.items()) == expected
+            assert len(snapshot) == len(expected)
+
+    def test_fork(self):
+
+        t = self.heap_class(128)
+        t['a/b'] = 1
+        t['a/c'] = 2
+        f = t.fork()
+        f['a/b'] = 3
+        del f['a/c']
+        t['a/d'] = 4
+
+        assert dict(t.all_items()) == {'a/b': 1, 'a/c': 2, 'a/d': 4}
+        assert dict(f.all_items()) == {'a/b': 3}
+        assert f.depth() == 0
+
+        # the instance index is shared too, and adding or removing ids on either side leaves the other alone
+        t.checkpoint()
+        t.instances.add('Infantry', 2)
+        t.instances.add('Infantry', 1)
+        f = t.fork()
+        assert f.instances.models['Infantry'] is t.instances.models['Infantry']
+        f.instances.discard('Infantry', 1)
+        t.instances.add('Infantry', 3)
+        assert t.instances.ids('Infantry') == [1, 2, 3]
+        assert f.instances.ids('Infantry') == [2]
+        t.revert()
+        assert t.instances.ids('Infantry') == []
+
+    def test_performance(self):
+
+        world = self.heap_class(100000)
+        for i in range(100000):
+            world['Infantry/O/%i/health' % i] = i
+
+        a = time.time()
+        forks = [world.fork() for _ in range(10000)]
+        b = time.time()
+        for i, f in enumerate(forks):
+            f['Infantry/O/%i/health' % i] = -i
+        c = time.time()
+
+        assert world['Infantry/O/5/health'] == 5
+        assert forks[5]['Infantry/O/5/health'] == -5
+        print('PersistentHeap: 10k forks from a 100k-key world took: %f, one write in each took: %f' % (b - a, c - b))
+
+        tracemalloc.start()
+        forks = [world.fork() for _ in range(1000)]
+        for i, f in enumerate(forks):
+            f['Infantry/O/%i/health' % i] = -i
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print('PersistentHeap: %i bytes per fork with one write' % (memory / 1000, ))
+
+        small = Heap(10000)
+        for i in range(10000):
+            small['Infantry/O/%i/health' % i] = i
+        a = time.time()
+        for i in range(10):
+            small.fork()
+        b = time.time()
+        print('Heap: 10 forks from a 10k-key world took: %f' % (b - a, ))
+
+
+if __name__ == '__main__':
+    unittest.main()
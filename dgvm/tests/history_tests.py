@@ -0,0 +1,112 @@
+import os
+import tempfile
+import time
+import unittest
+
+from dgvm.builtin_instructions import InstantiateModel, DestroyInstance
+from dgvm.commit_log import CommitLog
+from dgvm.history import CommitIndex, touched
+from dgvm.snapshots import SnapshotStore
+from dgvm.vm import LocalVM as VM, CompactionPolicy
+from dgvm.tests import fixtures
+from dgvm.tests.simple_game_test.datamodels import Infantry, Soldier
+
+
+class HistoryTests(unittest.TestCase):
+
+    def scan(self, vm, model_name, id):
+        """
+            Positions of the commits touching an instance, found by going through every instruction.
+        """
+        first = vm.commit_index - len(vm.commits) + 1
+        return [first + i for i, commit in enumerate(vm.commits)
+                if any((model_name, id) in touched(type(inst), inst.args) for inst in commit)]
+
+    def test_find(self):
+
+        vm = VM('simple_game_test', history_index=True)
+        units = fixtures.play(vm, 12)
+        move = vm.get_instruction('INF.MOVE')
+
+        for model_name, id in (('Infantry', 1), ('Infantry', 2), ('Soldier', 2), ('Soldier', 3), ('Board', 1)):
+            expected = self.scan(vm, model_name, id)
+            assert expected
+            assert [p for p, _ in vm.find_commits(model_name, id)] == expected
+            assert [p for p, _ in vm.find_commits(vm.get_model(model_name), id, reverse=True)] == expected[::-1]
+        assert [p for p, _ in vm.find_commits(units[1])] == self.scan(vm, 'Soldier', 1)
+        assert list(vm.find_commits('Infantry', 99)) == []
+
+        # the last time an instance was touched, without going through the rest
+        position, commit = next(vm.find_commits(units[2], reverse=True))
+        assert commit is vm.commits[position - 1]
+        assert any(type(i) is move and i.args[0].id == 2 for i in commit)
+
+        assert [p for p, _ in vm.find_commits(opcode=DestroyInstance)] == [4]
+        assert [p for p, _ in vm.find_commits(opcode=InstantiateModel.opcode)] == [1, 2]
+        both = [p for p, _ in vm.find_commits(units[0], opcode=move)]
+        assert both == [p for p in self.scan(vm, 'Infantry', 1) if p > 4]
+        self.assertRaises(ValueError, vm.find_commits, 'Infantry')
+        self.assertRaises(ValueError, VM('simple_game_test').find_commits, units[0])
+
+        # rebuilt in one pass, and forgets what a new commit after rewinding replaces
+        assert vm.rebuild_history().models == vm.history.models
+        vm = VM('simple_game_test', history_index=True, undo_records=True)
+        units = fixtures.play(vm, 12)
+        vm.rewind_to(6)
+        assert max(p for p, _ in vm.find_commits(units[0])) <= 6
+        Soldier.get_by_id(vm, 1).move(4, 4)
+        vm.commit()
+        assert [p for p, _ in vm.find_commits(units[0])] == self.scan(vm, 'Infantry', 1)
+        assert [p for p, _ in vm.find_commits(units[1], reverse=True)][:1] == [7]
+
+    def test_persist(self):
+
+        with tempfile.TemporaryDirectory() as path:
+            snapshots = SnapshotStore(os.path.join(path, 'snapshots'), every=5)
+            with CommitLog(os.path.join(path, 'log')) as log:
+                vm = VM('simple_game_test', commit_log=log, snapshots=snapshots, history_index=True,
+                        commit_codec='binary')
+                fixtures.play(vm, 4)
+                vm.commit_codec = 'json'
+                Infantry.get_by_id(vm, 1).move(9, 9)
+                vm.commit()
+                index_path = os.path.join(log.path, 'commits.idx')
+                # saved with the snapshot of commit 5
+                assert CommitIndex.load(index_path)[0].position == 5
+
+            with CommitLog(os.path.join(path, 'log')) as log:
+                recovered = VM('simple_game_test', commit_log=log, snapshots=snapshots, history_index=True)
+                assert recovered.history.position == vm.commit_index
+                assert recovered.history.models == vm.history.models
+                assert recovered.history.opcodes == vm.history.opcodes
+                # commits before the snapshot come from the log
+                assert len(recovered.commits) == 4
+                for position, commit in recovered.find_commits(Infantry, 1):
+                    assert commit.calc_hash() == vm.commits[position - 1].calc_hash()
+
+                # a broken index file is rebuilt from the log
+                with open(index_path, 'wb') as f:
+                    f.write(b'DGVM')
+                recovered = VM('simple_game_test', commit_log=log, history_index=True)
+                assert recovered.history.models == vm.history.models
+                recovered.save_history()
+                assert CommitIndex.load(index_path)[0].models == vm.history.models
+
+    def test_performance(self):
+
+        vm = VM('simple_game_test', compaction=CompactionPolicy(), history_index=True)
+        fixtures.play(vm, 3000)
+        n = 100
+        a = time.time()
+        for _ in range(n):
+            found = [p for p, _ in vm.find_commits('Soldier', 2)]
+        b = time.time()
+        scanned = self.scan(vm, 'Soldier', 2)
+        c = time.time()
+        assert found == scanned
+        print('find_commits(): %.6fs, scanning %i commits: %.3fs, %.0fx faster' % (
+            (b - a) / n, len(vm.commits), c - b, (c - b) * n / (b - a)))
+
+
+if __name__ == '__main__':
+    unittest.main()
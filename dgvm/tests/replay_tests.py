@@ -0,0 +1,125 @@
+import time
+import unittest
+
+from dgvm.commit_log import CorruptLogError
+from dgvm.constraints import ConstraintViolation
+from dgvm.builtin_instructions import BeginTransaction, EndTransaction
+from dgvm.vm import LocalVM as VM, Commit, CompactionPolicy, decode_record, encode_record
+from dgvm.tests import fixtures
+from dgvm.tests.simple_game_test.datamodels import Infantry, Soldier
+
+
+class ReplayTests(unittest.TestCase):
+
+    def record(self, vm):
+        vm.commit()
+        return encode_record(vm.get_last_commit())
+
+    def play(self, vm, moves):
+        records = []
+        fixtures.play(vm, moves, lambda vm: records.append(self.record(vm)), health=10)
+        return records
+
+    def test_replay_stream(self):
+
+        vm = VM('simple_game_test', heap_hashed=True)
+        records = self.play(vm, 20)
+
+        for verify in (False, True):
+            replayed = VM('simple_game_test', heap_hashed=True)
+            assert replayed.replay_stream(records, batch_size=7, verify=verify) == len(records)
+            assert replayed.commit_index == vm.commit_index
+            assert replayed.chain_head == vm.chain_head
+            assert replayed.state_hash() == vm.state_hash()
+            assert [hash(c) for c in replayed.commits] == [hash(c) for c in vm.commits]
+            assert [c.dumps() for c in replayed.commits] == [c.dumps() for c in vm.commits]
+            assert [i.id for i in Soldier.objects(replayed)] == [1, 2]
+
+            # replayed instances go back to normal, and the VM keeps going
+            unit = Infantry.get_by_id(replayed, 1)
+            self.assertRaises(AttributeError, setattr, unit, 'health', 1)
+            unit.move(5, 5)
+            replayed.commit()
+            assert Infantry.get_by_id(replayed, 1).position == (5, 5)
+
+        # stored hashes are only checked with verify=True, but records must follow each other
+        previous, commit_hash, dump = decode_record(records[1])
+        bad = list(records)
+        bad[1] = ('%064x%064x' % (previous, commit_hash + 1) + dump).encode('utf-8')
+        self.assertRaises(CorruptLogError, VM('simple_game_test').replay_stream, bad, verify=True)
+        bad = records[:1] + records[2:]
+        self.assertRaises(CorruptLogError, VM('simple_game_test').replay_stream, bad)
+
+        # a rejected record leaves the state as the records before it left it
+        previous, commit_hash, dump = decode_record(records[-1])
+        bad = records[:-1] + [('%064x%064x' % (previous, commit_hash + 1) + dump).encode('utf-8')]
+        replayed = VM('simple_game_test', heap_hashed=True)
+        self.assertRaises(CorruptLogError, replayed.replay_stream, bad, verify=True)
+        expected = VM('simple_game_test', heap_hashed=True)
+        expected.replay_stream(records[:-1])
+        assert replayed.commit_index == expected.commit_index
+        assert replayed.state_hash() == expected.state_hash()
+
+    def test_trusted(self):
+
+        vm = VM('simple_game_test')
+        records = self.play(vm, 1)
+        # the last move taken off the 50x50 board
+        previous, commit_hash, dump = decode_record(records[-1])
+        dump = dump.replace('["Infantry", 1], 1, 1]', '["Infantry", 1], 60, 60]')
+        bad = records[:-1] + [('%064x%064x' % (previous, commit_hash) + dump).encode('utf-8')]
+
+        self.assertRaises(ConstraintViolation, VM('simple_game_test').replay_stream, bad)
+        replayed = VM('simple_game_test')
+        assert replayed.replay_stream(bad, trusted=True) == len(bad)
+        assert Infantry.get_by_id(replayed, 1).position == (60, 60)
+
+    def test_hash(self):
+
+        vm = VM('simple_game_test')
+        records = self.play(vm, 3)
+        other = VM('simple_game_test')
+        self.play(other, 3)
+        assert [hash(c) for c in other.commits] == [hash(c) for c in vm.commits]
+
+        # every commit hash covers the one before it
+        dump = vm.commits[-1].dumps()
+        assert Commit.loads(vm, dump, vm.commits[-2].calc_hash()).calc_hash() == vm.chain_head
+        assert Commit.loads(vm, dump).calc_hash() != vm.chain_head
+        assert len(set(hash(c) for c in list(vm.commits)[-3:])) == 3
+
+        # appending changes the hash
+        commit = Commit(vm.chain_head)
+        commit.append(BeginTransaction())
+        h = hash(commit)
+        commit.append(EndTransaction())
+        assert hash(commit) != h
+        assert hash(commit) == hash(Commit.loads(vm, commit.dumps(), vm.chain_head))
+
+    def test_performance(self):
+
+        vm = VM('simple_game_test', compaction=CompactionPolicy())
+        records = self.play(vm, 1500)
+        n_instructions = sum(len(c) for c in vm.commits)
+
+        a = time.time()
+        fast = VM('simple_game_test')
+        fast.replay_stream(records)
+        b = time.time()
+        print('replay_stream(): %i instructions/s' % (n_instructions / (b - a), ))
+
+        # replay() stacks a heap checkpoint per commit, so without compaction its reads get slower as it goes
+        for name, compaction in (('no compaction', None), ('CompactionPolicy()', CompactionPolicy())):
+            c = time.time()
+            slow = VM('simple_game_test', compaction=compaction)
+            for record in records:
+                slow.replay(decode_record(record)[2])
+            d = time.time()
+            assert fast.chain_head == slow.chain_head == vm.chain_head
+            assert fast.state_hash() == slow.state_hash()
+            print('replay() with %s: %i instructions/s, %.1fx slower' % (
+                name, n_instructions / (d - c), (d - c) / (b - a)))
+
+
+if __name__ == '__main__':
+    unittest.main()
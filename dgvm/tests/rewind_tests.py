@@ -0,0 +1,122 @@
+import time
+import unittest
+
+from dgvm.data_structures import Heap, FlatHeap, VersionedHeap, PersistentHeap
+from dgvm.vm import LocalVM as VM, CompactionPolicy, encode_record
+from dgvm.tests import fixtures
+from dgvm.tests.simple_game_test.datamodels import Infantry, Board
+
+
+class RewindTests(unittest.TestCase):
+
+    def play(self, vm, moves):
+        """
+            Plays a game and returns (state hash, chain head, units, spatial lookup) after each commit, the first
+            one being the empty VM.
+        """
+        states = [fixtures.state(vm)]
+        board = Board(vm, width=50, height=50)
+        vm.commit()
+        states.append(fixtures.state(vm))
+        units = fixtures.make_units(vm, board)
+        vm.commit()
+        states.append(fixtures.state(vm))
+        units[2].attack(units[3])
+        vm.commit()
+        states.append(fixtures.state(vm))
+        units[5].destroy()
+        vm.commit()
+        states.append(fixtures.state(vm))
+        units[3].move(9, 9)
+        units[3].destroy()
+        vm.commit()
+        states.append(fixtures.state(vm))
+        for i in range(moves):
+            units[i % 2].move(1 + i % 3, 1 + i % 5)
+            units[2].attack(units[i % 2])
+            vm.commit()
+            states.append(fixtures.state(vm))
+        return states
+
+    def test_rewind(self):
+
+        for heap_class in (Heap, FlatHeap, VersionedHeap, PersistentHeap):
+            vm = VM('simple_game_test', heap_class=heap_class, heap_hashed=True, undo_records=True,
+                    compaction=CompactionPolicy(keep=2, batch=2))
+            states = self.play(vm, 10)
+            top = vm.commit_index
+            assert all(c.undo is not None and len(c.undo) for c in vm.commits)
+
+            for n in (top - 1, 12, 7, 3, 0):
+                vm.rewind_to(n)
+                assert vm.commit_index == n and len(vm.commits) == n
+                assert fixtures.state(vm) == states[n], (heap_class, n)
+            for n in (1, 4, 5, top):
+                vm.fast_forward(n)
+                assert fixtures.state(vm) == states[n], (heap_class, n)
+            vm.rewind_to(4)
+            vm.fast_forward()
+            assert fixtures.state(vm) == states[top]
+            assert [c.calc_hash() for c in vm.commits][-1] == vm.chain_head
+
+            # a new commit drops the rewound ones
+            vm.rewind_to(5)
+            Infantry.get_by_id(vm, 1).move(7, 7)
+            vm.commit()
+            assert vm.rewound == []
+            self.assertRaises(ValueError, vm.fast_forward, 7)
+            vm.rewind_to(5)
+            assert fixtures.state(vm) == states[5]
+
+    def test_errors(self):
+
+        vm = VM('simple_game_test')
+        self.play(vm, 2)
+        self.assertRaises(ValueError, vm.rewind_to, 2)
+
+        vm = VM('simple_game_test', undo_records=True)
+        self.play(vm, 2)
+        self.assertRaises(ValueError, vm.rewind_to, vm.commit_index + 1)
+        vm.rewind_to(3)
+        self.assertRaises(ValueError, vm.fast_forward, 2)
+        self.assertRaises(ValueError, vm.fast_forward, vm.commit_index + 10)
+        Infantry.get_by_id(vm, 1).move(2, 2)
+        self.assertRaises(Exception, vm.rewind_to, 1)
+        vm.rollback()
+
+        # a rolled back transaction leaves no undo record behind
+        unit = Infantry.get_by_id(vm, 1)
+        position = unit.position
+        unit.move(3, 3)
+        vm.commit()
+        vm.rewind_to(3)
+        assert Infantry.get_by_id(vm, 1).position == position
+
+    def test_performance(self):
+
+        vm = VM('simple_game_test', undo_records=True, compaction=CompactionPolicy())
+        records = []
+        board = Board(vm, width=50, height=50)
+        units = [Infantry(vm, n_units=1, attack_dmg=3, armor=0, health=10, action=10 ** 9, position=(i, i),
+                          board=board) for i in range(10)]
+        vm.commit()
+        records.append(encode_record(vm.get_last_commit()))
+        for i in range(3000):
+            units[i % 10].move(1 + i % 7, 1 + i % 11)
+            vm.commit()
+            records.append(encode_record(vm.get_last_commit()))
+        target = vm.commit_index - 10
+
+        a = time.time()
+        vm.rewind_to(target)
+        b = time.time()
+        replayed = VM('simple_game_test')
+        replayed.replay_stream(records[:target])
+        c = time.time()
+        assert replayed.state_hash() == vm.state_hash()
+        print('rewind_to() 10 commits back: %.5fs, replay_stream() of %i commits: %.3fs, %.0fx faster' % (
+            b - a, target, c - b, (c - b) / (b - a)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import time
+import unittest
+
+from dgvm.builtin_instructions import CollapseHeap
+from dgvm.data_structures import Heap, FlatHeap, VersionedHeap, PersistentHeap
+from dgvm.vm import LocalVM as VM, encode_record
+from dgvm.tests import fixtures
+from dgvm.tests.simple_game_test.datamodels import Infantry, Board
+
+
+class SavepointTests(unittest.TestCase):
+
+    def setup(self, vm, n=3):
+        units = fixtures.make_units(vm, n=n)
+        vm.commit()
+        return units
+
+    def test_savepoints(self):
+
+        for heap_class in (Heap, FlatHeap, VersionedHeap, PersistentHeap):
+            vm = VM('simple_game_test', heap_class=heap_class, heap_hashed=True, undo_records=True)
+            units = self.setup(vm)
+            committed = fixtures.state(vm, (5, 5), 1)
+
+            units[0].move(5, 5)
+            first = vm.savepoint()
+            moved = fixtures.state(vm, (5, 5), 1), len(vm.workspace)
+            units[1].attack(units[3])
+            second = vm.savepoint()
+            units[0].move(6, 6)
+            units[5].destroy()
+            Infantry(vm, n_units=1, attack_dmg=3, armor=0, health=10, action=10, position=(5, 4),
+                     board=Board.get_by_id(vm, 1))
+            vm.rollback_to(second)
+            vm.rollback_to(first)
+            assert (fixtures.state(vm, (5, 5), 1), len(vm.workspace)) == moved, heap_class
+            self.assertRaises(ValueError, vm.rollback_to, second)
+
+            # the savepoint can be rolled back to again, and released
+            units[2].move(5, 6)
+            vm.rollback_to(first)
+            units[4].move(4, 4)
+            third = vm.savepoint()
+            units[1].move(5, 5)
+            vm.release(third)
+            self.assertRaises(ValueError, vm.release, third)
+            assert vm.heap_size() == len(list(vm.heap.all_items())), heap_class
+
+            # releasing a nested savepoint keeps the live address count of the layers right
+            fourth = vm.savepoint()
+            fifth = vm.savepoint()
+            Infantry(vm, n_units=1, attack_dmg=3, armor=0, health=10, action=10, position=(7, 7),
+                     board=Board.get_by_id(vm, 1))
+            vm.release(fifth)
+            assert vm.heap_size() == len(list(vm.heap.all_items())), heap_class
+            vm.rollback_to(fourth)
+            assert vm.heap_size() == len(list(vm.heap.all_items())), heap_class
+            vm.release(fourth)
+            vm.commit()
+            assert vm.savepoints == [] and vm.heap.depth() == 2
+
+            # the commit holds the kept instructions only, so it replays to the same state
+            replica = VM('simple_game_test', heap_class=heap_class, heap_hashed=True)
+            replica.replay_stream([encode_record(c) for c in vm.commits])
+            assert fixtures.state(replica, (5, 5), 1) == fixtures.state(vm, (5, 5), 1), heap_class
+            assert replica.chain_head == vm.chain_head
+            # and its undo record only covers what was kept
+            assert not any(a.startswith('Soldier/O/3') for a in vm.get_last_commit().undo.addresses)
+            vm.rewind_to(1)
+            assert fixtures.state(vm, (5, 5), 1) == committed
+            vm.fast_forward()
+            assert fixtures.state(vm, (5, 5), 1) == fixtures.state(replica, (5, 5), 1)
+
+            # rollback() drops the savepoints with the rest of the workspace
+            vm.savepoint()
+            units[0].move(1, 1)
+            vm.savepoint()
+            units[0].move(2, 2)
+            vm.rollback()
+            assert vm.savepoints == [] and fixtures.state(vm, (5, 5), 1) == fixtures.state(replica, (5, 5), 1)
+
+    def test_collapse(self):
+
+        for heap_class in (Heap, FlatHeap, VersionedHeap, PersistentHeap):
+            vm = VM('simple_game_test', heap_class=heap_class)
+            units = self.setup(vm)
+            units[0].move(2, 2)
+            vm.savepoint()
+            units[0].move(3, 3)
+            # CollapseHeap leaves the layers of the transaction and of its savepoints alone
+            vm.execute([CollapseHeap(1)])
+            assert vm.heap.depth() == 2
+            vm.rollback()
+            assert units[0].position == (0, 0) and vm.heap.depth() == 0, heap_class
+
+    def test_performance(self):
+
+        n_units = 50
+        candidates = 200
+        for heap_class in (Heap, FlatHeap, VersionedHeap, PersistentHeap):
+            vm = VM('simple_game_test', heap_class=heap_class)
+            units = self.setup(vm, n_units // 2)
+            # a turn which already moved every unit, trying candidate moves for each of them
+            for i, unit in enumerate(units):
+                unit.move(i % 50, i // 50)
+            a = time.time()
+            for i in range(candidates):
+                savepoint = vm.savepoint()
+                units[i % n_units].move(i % 50, 10)
+                units[(i + 1) % n_units].attack(units[i % n_units])
+                vm.rollback_to(savepoint)
+                vm.release(savepoint)
+            b = time.time()
+            # the same candidates without savepoints: commit the turn and try each one on a fork
+            vm.commit()
+            for i in range(candidates):
+                trial = vm.fork()
+                unit, target = units[i % n_units], units[(i + 1) % n_units]
+                unit = type(unit).get_by_id(trial, unit.id)
+                unit.move(i % 50, 10)
+                type(target).get_by_id(trial, target.id).attack(unit)
+            c = time.time()
+            print('%s: %i candidates/s with savepoints, %i candidates/s forking the turn' % (
+                heap_class.__name__, candidates / (b - a), candidates / (c - b)))
+
+
+if __name__ == '__main__':
+    unittest.main()
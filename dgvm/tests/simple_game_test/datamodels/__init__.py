@@ -2,4 +2,5 @@ __author__ = 'salvia'
 
 from .infantry import Infantry
 from .board import Board
-from .tank import Tank
\ No newline at end of file
+from .tank import Tank
+from .soldier import Soldier
@@ -19,7 +19,7 @@ class Infantry(Datamodel):
     health = Integer(null=False)
     action = Integer(null=False)
     tag = String(null=True)
-    position = Pair(int, null=False, default=(0, 0))
+    position = Pair(int, null=False, default=(0, 0), spatial_index=4)
     board = ForeignModel(Board, null=False)
 
     @property
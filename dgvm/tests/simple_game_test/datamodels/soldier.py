@@ -0,0 +1,49 @@
+__author__ = 'salvia'
+
+from dgvm.datamodel import Datamodel
+from dgvm.datamodel import Integer, Float, Boolean, Pair, ForeignModel, String
+from dgvm.constraints import constraint
+from .board import Board
+from dgvm.instruction import instruction
+import math
+
+
+class Soldier(Datamodel):
+    """
+    Columnar version of the infantry datamodel,
+    used to test DGVM columnar storage
+    """
+    columnar = True
+
+    n_units = Integer(null=False)
+    attack_dmg = Integer(null=False)
+    armor = Integer(null=False)
+    health = Integer(null=False)
+    action = Integer(null=False)
+    morale = Float(null=True)
+    veteran = Boolean(null=True)
+    tag = String(null=True)
+    position = Pair(int, null=False, default=(0, 0))
+    board = ForeignModel(Board, null=False)
+
+    @instruction(opcode=301, mnemonic='SOLD.MOVE', args=(Datamodel, int, int))
+    def move(self, x, y):
+        dx = (x - self.position.x) ** 2
+        dy = (y - self.position.y) ** 2
+        d = dx + dy
+        root = math.sqrt(d)
+        self.action -= math.ceil(root)
+        self.position = (x, y)
+
+    @instruction(opcode=302, mnemonic='SOLD.ATTK', args=(Datamodel, Datamodel))
+    def attack(self, other):
+
+        self.action -= 10
+        val = other.health - (self.attack_dmg - other.armor)
+        other.health = val
+
+    @constraint.on_change(action)
+    def action_limit(cons, old, new, related):
+        if new < 0:
+            return False
+        return True
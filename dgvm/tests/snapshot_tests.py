@@ -0,0 +1,105 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from dgvm.commit_log import CommitLog
+from dgvm.snapshots import SnapshotStore
+from dgvm.vm import LocalVM as VM, CompactionPolicy
+from dgvm.tests import fixtures
+from dgvm.tests.simple_game_test.datamodels import Infantry, Board, Soldier
+
+
+class SnapshotTests(unittest.TestCase):
+
+    def play(self, vm):
+        board = Board(vm, width=50, height=50)
+        vm.commit()
+        units = []
+        for i in range(5):
+            units += fixtures.make_units(vm, board, 1, i, health=10, action=100)
+            vm.commit()
+        units[0].move(3, 3)
+        vm.commit()
+        units[1].move(4, 4)
+        vm.commit()
+        units[2].attack(units[4])
+        vm.commit()
+        units[5].destroy()
+        vm.commit()
+
+    def test_recover(self):
+
+        with tempfile.TemporaryDirectory() as path:
+            snapshots = SnapshotStore(os.path.join(path, 'snapshots'), every=3)
+            with CommitLog(os.path.join(path, 'log')) as log:
+                vm = VM('simple_game_test', commit_log=log, snapshots=snapshots)
+                self.play(vm)
+                assert vm.commit_index == 10
+                assert snapshots.indexes() == [6, 9]
+
+            for store in (None, snapshots):
+                with CommitLog(os.path.join(path, 'log')) as log:
+                    recovered = VM('simple_game_test', commit_log=log, snapshots=store)
+
+                    assert len(recovered.commits) == (10 if store is None else 1)
+                    assert recovered.commit_index == vm.commit_index
+                    assert recovered.chain_head == vm.chain_head
+                    assert recovered.state_hash() == vm.state_hash()
+                    assert [i.id for i in Soldier.objects(recovered).all()] == [1, 2, 4, 5]
+                    assert [i.id for i in Infantry.objects(recovered).near('position', (3, 3), 1)] == [1, 4]
+
+            # a recovered VM keeps logging and taking snapshots
+            for _ in range(2):
+                with CommitLog(os.path.join(path, 'log')) as log:
+                    recovered = VM('simple_game_test', commit_log=log, snapshots=snapshots)
+                    Infantry.get_by_id(recovered, 2).move(recovered.commit_index - 5, 5)
+                    recovered.commit()
+
+            assert snapshots.indexes() == [9, 12]
+            with CommitLog(os.path.join(path, 'log')) as log:
+                assert Infantry.get_by_id(VM('simple_game_test', commit_log=log), 2).position == (6, 5)
+
+    def test_performance(self):
+
+        history = 100000
+
+        with tempfile.TemporaryDirectory() as path:
+            with CommitLog(os.path.join(path, 'log'), sync_every=None) as log:
+                log.append(json.dumps([
+                    ['VM_BEGINTRANS'], ['INST', ['DatamodelMeta', 'Board'], {'width': 50, 'height': 50, 'id': 1}]
+                ]).encode('utf-8'))
+                log.append(json.dumps([['VM_BEGINTRANS'], ['INST', ['DatamodelMeta', 'Infantry'], {
+                    'n_units': 1, 'attack_dmg': 1, 'armor': 0, 'health': 1, 'action': 10 ** 12, 'tag': None,
+                    'position': [1, 1], 'board_id': 1, 'id': 1
+                }]]).encode('utf-8'))
+                for i in range(history - 2):
+                    if i % 10:
+                        commit = [['VM_BEGINTRANS'], ['INF.MOVE', ['Infantry', 1], 1 + i % 2, 1 + i % 2]]
+                    else:
+                        commit = [['VM_BEGINTRANS'], ['INST', ['DatamodelMeta', 'Board'], {
+                            'width': 10, 'height': 10, 'id': 2 + i // 10
+                        }]]
+                    log.append(json.dumps(commit).encode('utf-8'))
+
+            snapshots = SnapshotStore(os.path.join(path, 'snapshots'), every=33000)
+            times = []
+            for _ in range(2):
+                with CommitLog(os.path.join(path, 'log')) as log:
+                    a = time.time()
+                    vm = VM('simple_game_test', commit_log=log, snapshots=snapshots, compaction=CompactionPolicy())
+                    times.append(time.time() - a)
+                    assert vm.commit_index == history
+                    assert Infantry.get_by_id(vm, 1).position == (2, 2)
+                    hashes = vm.state_hash(), vm.chain_head
+                if len(times) == 2:
+                    assert hashes == previous
+                previous = hashes
+
+            print('%i commit history: full replay took: %f, snapshot of %i commits plus tail took: %f' % (
+                history, times[0], snapshots.latest(), times[1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+import random
+import threading
+import time
+import unittest
+
+from dgvm.data_structures import PersistentHeap
+from dgvm.transaction import TransactionConflict
+from dgvm.vm import LocalVM as VM, encode_record
+from dgvm.tests import fixtures
+from dgvm.tests.simple_game_test.datamodels import Infantry, Board, Soldier
+
+
+class TransactionTests(unittest.TestCase):
+
+    def setup(self, vm, n=4):
+        units = fixtures.make_units(vm, n=n)
+        vm.commit()
+        return units
+
+    def test_transactions(self):
+
+        vm = VM('simple_game_test', heap_class=PersistentHeap, heap_hashed=True)
+        self.setup(vm)
+        records = [encode_record(vm.get_last_commit())]
+
+        a, b, c, d, x = (vm.transaction() for _ in range(5))
+        Infantry.get_by_id(a, 1).move(10, 10)
+        Soldier.get_by_id(b, 2).move(11, 11)
+        Soldier.get_by_id(c, 1).attack(Soldier.get_by_id(c, 2))
+        Infantry.get_by_id(d, 1).move(12, 12)
+        Soldier.get_by_id(x, 3).attack(Soldier.get_by_id(x, 2))
+        # nothing is visible outside a transaction before it commits
+        assert Infantry.get_by_id(vm, 1).position == (0, 0)
+        assert Infantry.get_by_id(a, 1).position == (10, 10)
+
+        a.commit()
+        records.append(encode_record(vm.get_last_commit()))
+        b.commit()
+        records.append(encode_record(vm.get_last_commit()))
+        # c read the health and armor of Soldier 2, which b did not change
+        c.commit()
+        records.append(encode_record(vm.get_last_commit()))
+        # x read the health c changed (a column cell)
+        assert x.conflicts() == {'Soldier/O/2/health'}
+        self.assertRaises(TransactionConflict, x.commit)
+        # d moved a unit a moved
+        assert 'Infantry/O/1/position' in d.conflicts()
+        self.assertRaises(TransactionConflict, d.commit)
+        self.assertRaises(Exception, d.commit)
+        assert vm.commit_index == 4
+
+        assert Infantry.get_by_id(vm, 1).position == (10, 10)
+        assert Soldier.get_by_id(vm, 2).position == (11, 11)
+        assert Soldier.get_by_id(vm, 2).health == 997
+        assert Soldier.get_by_id(vm, 3).action == 10 ** 9
+        assert [u.id for u in Infantry.objects(vm).near('position', (10, 10), 1)] == [1]
+
+        # new instances, and a destroy
+        e, f = vm.transaction(), vm.transaction()
+        unit = Infantry(e, n_units=1, attack_dmg=3, armor=0, health=10, action=10, position=(20, 20),
+                        board=Board.get_by_id(e, 1))
+        assert unit.id == 5
+        Soldier.get_by_id(f, 4).destroy()
+        e.commit()
+        records.append(encode_record(vm.get_last_commit()))
+        f.commit()
+        records.append(encode_record(vm.get_last_commit()))
+        assert Infantry.get_by_id(vm, 5).position == (20, 20)
+        assert [u.id for u in Soldier.objects(vm)] == [1, 2, 3]
+        # both read the id counter of Infantry
+        g, h = vm.transaction(), vm.transaction()
+        for txn in (g, h):
+            Infantry(txn, n_units=1, attack_dmg=3, armor=0, health=10, action=10, position=(1, 2),
+                     board=Board.get_by_id(txn, 1))
+        g.commit()
+        records.append(encode_record(vm.get_last_commit()))
+        self.assertRaises(TransactionConflict, h.commit)
+
+        # writes made without reading the address first conflict as well: destroy writes every attribute blindly
+        i, j = vm.transaction(), vm.transaction()
+        Infantry.get_by_id(i, 5).move(21, 21)
+        Infantry.get_by_id(j, 5).destroy()
+        assert 'Infantry/O/5/position' not in j.heap.reads
+        i.commit()
+        records.append(encode_record(vm.get_last_commit()))
+        assert 'Infantry/O/5/position' in j.conflicts()
+        self.assertRaises(TransactionConflict, j.commit)
+
+        # binary instructions executed on a transaction act on the transaction's models
+        source, txn = vm.transaction(), vm.transaction()
+        Infantry.get_by_id(source, 2).move(4, 4)
+        txn.execute_from_binary(vm.binary_codec.encode(list(source.workspace)[1:]))
+        assert Infantry.get_by_id(txn, 2).position == (4, 4) and Infantry.get_by_id(vm, 2).position == (1, 1)
+        source.rollback()
+        txn.rollback()
+
+        # read-only transactions commit nothing, and the workspace is still usable
+        vm.transaction().commit()
+        Infantry.get_by_id(vm, 2).move(3, 3)
+        self.assertRaises(Exception, vm.transaction)
+        vm.commit()
+        records.append(encode_record(vm.get_last_commit()))
+
+        # with no transaction open, the VM stops tracking its writes
+        assert vm.versions is None and vm.heap.changes is None
+        txn = vm.transaction()
+        assert vm.versions == {} and vm.heap.changes is not None
+        txn.rollback()
+        assert vm.versions is None and vm.heap.changes is None
+
+        # the commits replay to the same state
+        replica = VM('simple_game_test', heap_hashed=True)
+        replica.replay_stream(records)
+        assert replica.state_hash() == vm.state_hash()
+        assert replica.chain_head == vm.chain_head
+
+    def test_threads(self):
+
+        vm = VM('simple_game_test', heap_class=PersistentHeap)
+        units = self.setup(vm, 8)
+        prepared = []
+
+        def play(i):
+            txn = vm.transaction()
+            unit = type(units[i]).get_by_id(txn, units[i].id)
+            for step in range(20):
+                unit.move(i, step)
+            prepared.append(txn)
+
+        threads = [threading.Thread(target=play, args=(i, )) for i in range(len(units))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for txn in prepared:
+            txn.commit()
+        assert sorted(tuple(u.position) for u in Infantry.objects(vm)) == [(i, 19) for i in range(0, 16, 2)]
+
+    def test_performance(self):
+
+        random.seed(3)
+        n_players = 32
+        rounds = 100
+        vm = VM('simple_game_test', heap_class=PersistentHeap)
+        units = self.setup(vm, n_players // 2)
+        a = time.time()
+        for r in range(rounds):
+            for i, unit in enumerate(units):
+                unit.move(r % 50, i)
+                vm.commit()
+        b = time.time()
+        print('one workspace: %i commits/s' % (rounds * len(units) / (b - a), ))
+        for overlap in (0.0, 0.1, 0.25, 0.5, 1.0):
+            vm = VM('simple_game_test', heap_class=PersistentHeap)
+            units = self.setup(vm, n_players // 2)
+            committed = aborted = 0
+            a = time.time()
+            for r in range(rounds):
+                # every player prepares a move at once, some of them moving a shared unit
+                txns = []
+                for i, unit in enumerate(units):
+                    target = units[0] if i and random.random() < overlap else unit
+                    txn = vm.transaction()
+                    type(target).get_by_id(txn, target.id).move(r % 50, i)
+                    txns.append(txn)
+                for txn in txns:
+                    try:
+                        txn.commit()
+                        committed += 1
+                    except TransactionConflict:
+                        aborted += 1
+            b = time.time()
+            print('overlap %.2f: %i transactions/s, %i committed/s, %.0f%% aborted' % (
+                overlap, (committed + aborted) / (b - a), committed / (b - a), 100.0 * aborted / (committed + aborted)))
+
+
+if __name__ == '__main__':
+    unittest.main()
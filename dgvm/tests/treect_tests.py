@@ -1,6 +1,6 @@
 import unittest
 
-from dgvm.data_structures import Treect
+from dgvm.data_structures import Treect, HashedTreect
 
 
 class TreectTests(unittest.TestCase):
@@ -290,6 +290,47 @@ class TreectTests(unittest.TestCase):
 
         assert t == t2 == t3
 
+    def test_hashed(self):
+
+        t = HashedTreect()
+        t['a/b/c'] = 1
+        t['a/b/d'] = (1, 2)
+        t['a/e'] = 'x'
+        t['f'] = None
+
+        t2 = HashedTreect({'f': None, 'a': {'e': 'x', 'b': {'d': [1, 2]}}})
+        t2['a/b/c'] = 1
+
+        assert t.hash == t2.hash
+        assert t == t2
+        assert t.diff(t2) == []
+        assert t['a'].hash == t2['a'].hash
+
+        t2['a/b/c'] = 2
+        t2['g/h'] = 3
+        del t2['a/e']
+        assert t != t2
+        assert t['a/b'].hash != t2['a/b'].hash
+        assert sorted(t.diff(t2)) == ['a/b/c', 'a/e', 'g/h']
+
+        c = t2.copy()
+        t2['a/b/c'] = 1
+        t2['a/e'] = 'x'
+        del t2['g/h']
+        # empty subtrees don't count
+        assert t == t2
+        assert c.diff(t2) == ['a/b/c', 'a/e', 'g/h']
+
+        # the copy shares the nodes until either tree writes through them
+        c2 = c.copy()
+        assert c2['a'] is c['a'] and c2['g'] is c['g']
+        c2['a/b/c'] = 5
+        del c['g/h']
+        assert c2['g'] is not c['g'] and c2['a/b/d'] == c['a/b/d']
+        assert c['a/b/c'] == 2 and c2['a/b/c'] == 5 and c2['g/h'] == 3
+        assert c.hash == HashedTreect(dict(c.all_items())).hash
+        assert c2.hash == HashedTreect(dict(c2.all_items())).hash
+
 if __name__ == '__main__':
     unittest.main()
 
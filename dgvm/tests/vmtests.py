@@ -1,13 +1,16 @@
 import os
+import time
+import tracemalloc
 import unittest
-from dgvm.datamodel.meta import ModelDestroyedError
+from dgvm.datamodel.meta import ModelDestroyedError, DatamodelStates
 from dgvm.constraints import ConstraintViolation
 from dgvm.ipc.client import BaseIPCClient
-from dgvm.builtin_instructions import BeginTransaction, EndTransaction, InstantiateModel
+from dgvm.builtin_instructions import BeginTransaction, EndTransaction, InstantiateModel, CollapseHeap
 from dgvm.ipc.command import IPCServerException
 from dgvm.tests.simple_game_test.datamodels.tank import Tank
-from dgvm.vm import LocalVM as VM
-from dgvm.tests.simple_game_test.datamodels import Infantry, Board
+from dgvm.vm import LocalVM as VM, RemoteVM, CompactionPolicy
+from dgvm.data_structures import Heap, FlatHeap, VersionedHeap, PersistentHeap
+from dgvm.tests.simple_game_test.datamodels import Infantry, Board, Soldier
 __author__ = 'salvia'
 
 
@@ -393,6 +396,455 @@ class VMTests(unittest.TestCase):
 
             assert i1.health == 0
 
+    def test_flat_heap(self):
+        self._test_heap_class(FlatHeap)
+
+    def test_versioned_heap(self):
+        self._test_heap_class(VersionedHeap)
+
+    def test_persistent_heap(self):
+        self._test_heap_class(PersistentHeap)
+
+    def _test_heap_class(self, heap_class):
+
+        with VM('simple_game_test', heap_class=heap_class) as vm:
+            i = Infantry(
+                vm,
+                n_units=1,
+                attack_dmg=1,
+                armor=0,
+                health=1,
+                action=10,
+                position=(1, 1),
+                board=Board(vm, width=20, height=20)
+            )
+
+            vm.commit()
+
+            i.move(2, 2)
+
+            vm.commit()
+
+            assert i.position == (2, 2)
+
+            i.move(3, 3)
+
+            vm.rollback()
+
+            assert i.position == (2, 2)
+            assert vm.heap.get('Board/O/1/width') == 20
+            assert dict(vm.heap.all_items('Board/O')) == {
+                'Board/O/1/_id': 1,
+                'Board/O/1/width': 20,
+                'Board/O/1/height': 20,
+            }
+
+    def test_collapse_heap(self):
+
+        with VM('simple_game_test') as vm:
+            i = Infantry(
+                vm,
+                n_units=1,
+                attack_dmg=1,
+                armor=0,
+                health=1,
+                action=10,
+                position=(1, 1),
+                board=Board(vm, width=20, height=20)
+            )
+
+            vm.commit()
+
+            i.move(2, 2)
+
+            vm.commit()
+
+            vm.execute([CollapseHeap(0)])
+
+            # the running transaction keeps its own layer, so it can still be rolled back
+            assert vm.heap.depth() == 1
+
+            i.move(3, 3)
+            vm.rollback()
+
+            assert i.position == (2, 2)
+            assert vm.heap.depth() == 0
+
+    def test_compaction(self):
+
+        def play(vm, n_commits):
+            b = Board(vm, width=200, height=200)
+            units = [
+                Infantry(vm, n_units=1, attack_dmg=1, armor=0, health=1, action=10 ** 9, position=(1, 1), board=b)
+                for _ in range(10)
+            ]
+            vm.commit()
+            for n in range(n_commits):
+                units[n % 10].move(1 + n % 2, 1 + n % 2)
+                vm.commit()
+            return units
+
+        for compaction in (None, CompactionPolicy(keep=16, batch=16)):
+            with VM('simple_game_test', compaction=compaction) as vm:
+                tracemalloc.start()
+                units = play(vm, 400)
+                memory = tracemalloc.get_traced_memory()[0]
+                tracemalloc.stop()
+
+                assert units[0].position == (1, 1)
+                assert units[1].position == (2, 2)
+
+                i = units[-1]
+                i.move(5, 5)
+                vm.rollback()
+                assert i.position == (2, 2)
+
+                a = time.time()
+                for _ in range(1000):
+                    # never written after creation, so it is found in the oldest layer
+                    i.health
+                b = time.time()
+                print('compaction=%s: %i heap layers, %i bytes traced, 1k reads took: %f' % (
+                    compaction and 'keep=16' or None, vm.heap.depth() + 1, memory, b - a)
+                )
+
+    def test_fork(self):
+
+        with VM('simple_game_test', heap_class=PersistentHeap) as vm:
+            i = Infantry(
+                vm,
+                n_units=1,
+                attack_dmg=1,
+                armor=0,
+                health=1,
+                action=10,
+                position=(1, 1),
+                board=Board(vm, width=20, height=20)
+            )
+
+            vm.commit()
+
+            fork = vm.fork()
+            fi = Infantry.get_by_id(fork, i.id)
+            fi.move(3, 3)
+            fork.commit()
+
+            assert fi.position == (3, 3)
+            assert i.position == (1, 1)
+            assert len(fork.commits) == 1
+
+            # binary instructions executed on a fork act on the fork's models
+            other = vm.fork()
+            other.execute_from_binary(vm.binary_codec.encode(list(fork.get_last_commit())))
+            other.commit()
+            assert Infantry.get_by_id(other, i.id).position == (3, 3)
+            assert i.position == (1, 1)
+
+            i.move(2, 2)
+
+            self.assertRaises(Exception, vm.fork)
+
+            vm.commit()
+
+            assert i.position == (2, 2)
+            assert fi.position == (3, 3)
+
+    def test_remote_commits(self):
+
+        vm = VM('simple_game_test')
+        Board(vm, width=20, height=20)
+        vm.commit()
+        Board(vm, width=10, height=20)
+        vm.commit()
+
+        for codec in ('json', 'binary'):
+            mirror = VM('simple_game_test')
+            with RemoteVM('simple_game_test', codec=codec) as remote:
+                assert remote.get_current_commit() is None
+                for commit in vm.commits:
+                    remote.execute(list(commit))
+                    mirror.execute(list(commit))
+                    remote.commit()
+                    mirror.commit()
+                    # the commit is loaded chained to the one before, so it hashes the same on both sides
+                    assert hash(remote.get_last_commit()) == hash(mirror.get_last_commit()), codec
+                remote.execute(list(vm.commits[0]))
+                assert remote.get_current_commit().previous == mirror.chain_head
+
+    def test_snapshot_reads(self):
+
+        # the snapshot is retaken at every commit, which would copy any other heap
+        self.assertRaises(ValueError, VM, 'simple_game_test', heap_class=Heap, snapshot_reads=True)
+
+        with VM('simple_game_test', heap_class=PersistentHeap, heap_concurrency='rw', snapshot_reads=True) as vm:
+            i = Infantry(
+                vm,
+                n_units=1,
+                attack_dmg=1,
+                armor=0,
+                health=1,
+                action=10,
+                position=(1, 1),
+                board=Board(vm, width=20, height=20)
+            )
+            vm.commit()
+            address = 'Infantry/O/%i/position' % i.id
+
+            assert vm.snapshot[address] == (1, 1)
+
+            i.move(2, 2)
+            # the snapshot keeps showing the last commit while the transaction is open
+            assert vm.snapshot[address] == (1, 1)
+            vm.rollback()
+            assert vm.snapshot[address] == (1, 1)
+
+            i.move(3, 3)
+            vm.commit()
+            assert vm.snapshot[address] == (3, 3)
+
+    def test_objects(self):
+
+        read = []
+
+        class RecordingHeap(Heap):
+            def __getitem__(self, item):
+                read.append(item)
+                return super(RecordingHeap, self).__getitem__(item)
+
+        with VM('simple_game_test', heap_class=RecordingHeap) as vm:
+            board = Board(vm, width=20, height=20)
+            units = [
+                Infantry(vm, n_units=1, attack_dmg=1, armor=0, health=h, action=10, position=(1, 1), board=board)
+                for h in (5, 10, 15)
+            ]
+            vm.commit()
+
+            assert [i.id for i in Infantry.objects(vm).all()] == [i.id for i in units]
+            assert [b.id for b in Board.objects(vm).all()] == [board.id]
+            assert Tank.objects(vm).count() == 0
+
+            del read[:]
+            assert [i.health for i in Infantry.objects(vm).filter(health__gte=10)] == [10, 15]
+            # only the filtered attribute of the queried model is read
+            assert all(k.startswith('Infantry/O/') and k.endswith('/health') for k in read)
+
+            assert Infantry.objects(vm).filter(health__gt=5, health__lt=15).first().id == units[1].id
+            assert Infantry.objects(vm).filter(health__in=(5, 15)).count() == 2
+            assert Infantry.objects(vm).filter(board=board).count() == 3
+            assert Infantry.objects(vm).filter(id=units[2].id).first().health == 15
+            self.assertRaises(ValueError, Infantry.objects(vm).filter, hp=1)
+            self.assertRaises(ValueError, Infantry.objects(vm).filter, health__near=1)
+
+            units[0].destroy()
+            assert Infantry.objects(vm).count() == 2
+            vm.rollback()
+            assert Infantry.objects(vm).count() == 3
+
+            units[0].destroy()
+            Infantry(vm, n_units=1, attack_dmg=1, armor=0, health=20, action=10, position=(1, 1), board=board)
+            vm.commit()
+            assert [i.health for i in Infantry.objects(vm).all()] == [10, 15, 20]
+
+            fork = vm.fork()
+            Infantry.objects(fork).first().destroy()
+            fork.commit()
+            assert Infantry.objects(fork).count() == 2
+            assert Infantry.objects(vm).count() == 3
+
+    def test_spatial_index(self):
+
+        with VM('simple_game_test') as vm:
+            board = Board(vm, width=100, height=100)
+            units = [
+                Infantry(vm, n_units=1, attack_dmg=1, armor=0, health=1, action=100, position=p, board=board)
+                for p in ((1, 1), (2, 3), (9, 9), (1, 1), (40, 40))
+            ]
+            vm.commit()
+
+            def ids(queryset):
+                return [i.id for i in queryset]
+
+            objects = Infantry.objects(vm)
+            assert ids(objects.at('position', (1, 1))) == [units[0].id, units[3].id]
+            assert ids(objects.near('position', (1, 1), 3)) == [units[0].id, units[1].id, units[3].id]
+            assert ids(objects.near('position', (0, 0), 1000)) == ids(objects.all())
+            assert ids(objects.in_cell('position', (0, 0))) == [units[0].id, units[1].id, units[3].id]
+            assert ids(objects.near('position', (1, 1), 3).filter(id__gt=units[0].id)) == [units[1].id, units[3].id]
+            self.assertRaises(ValueError, objects.near, 'board', (1, 1), 3)
+
+            units[0].move(8, 8)
+            units[4].destroy()
+            assert ids(objects.near('position', (9, 9), 2)) == [units[0].id, units[2].id]
+            assert ids(objects.at('position', (40, 40))) == []
+
+            vm.rollback()
+            assert ids(objects.near('position', (9, 9), 2)) == [units[2].id]
+            assert ids(objects.at('position', (40, 40))) == [units[4].id]
+
+    def test_state_hash(self):
+
+        vms = [VM('simple_game_test', heap_hashed=True), VM('simple_game_test', heap_class=FlatHeap, heap_hashed=True)]
+        for vm in vms:
+            board = Board(vm, width=20, height=20)
+            Infantry(vm, n_units=1, attack_dmg=1, armor=0, health=1, action=10, position=(1, 1), board=board)
+            Soldier(vm, n_units=1, attack_dmg=1, armor=0, health=1, action=10, position=(1, 1), board=board)
+            vm.commit()
+
+        a, b = vms
+        assert a.state_hash() == b.state_hash()
+        Infantry.get_by_id(b, 1).move(2, 2)
+        Soldier.get_by_id(b, 1).move(2, 2)
+        assert a.state_hash() != b.state_hash()
+        assert sorted(a.heap.diff(b.heap)) == [
+            'Infantry/O/1/action', 'Infantry/O/1/position', 'Soldier/O/1/action', 'Soldier/O/1/position'
+        ]
+        b.rollback()
+        assert a.state_hash() == b.state_hash()
+
+    def test_columnar(self):
+
+        with VM('simple_game_test') as vm:
+            b = Board(vm, width=20, height=20)
+            s1 = Soldier(vm, n_units=1, attack_dmg=3, armor=1, health=10, action=10, position=(1, 1), board=b)
+            s2 = Soldier(vm, n_units=1, attack_dmg=3, armor=1, health=10, action=10, morale=0.5, board=b)
+
+            vm.commit()
+
+            assert s1.health == 10
+            assert s1.morale is None
+            assert s2.morale == 0.5
+            assert s2.veteran is None
+            # cells are not stored as addresses, but show up in the heap views
+            assert vm.heap.get('Soldier/O/1/health') is None
+            assert dict(vm.heap.all_items())['Soldier/O/1/health'] == 10
+            assert vm.heap.columns.columns['Soldier/health'].get(1) == 10
+            # 3 board addresses, 2 id counters, 2 * (id, tag, position, board) addresses, 2 * 7 cells
+            assert len(vm.heap) == 3 + 2 + 8 + 14
+            assert dict(vm.heap.all_items('Soldier/O/2'))['Soldier/O/2/morale'] == 0.5
+
+            s1.attack(s2)
+            vm.commit()
+
+            assert s2.health == 8
+            assert s1.action == 0
+
+            s2.move(2, 2)
+            assert s2.action == 7
+            s2.destroy()
+            vm.rollback()
+
+            s2 = Soldier.get_by_id(vm, 2)
+            assert s2.health == 8
+            assert s2.action == 10
+            assert s2.position == (0, 0)
+
+            s2.destroy()
+            vm.commit()
+
+            assert len(vm.heap) == 3 + 2 + 4 + 7
+            assert vm.heap.columns.columns['Soldier/health'].cell(2)[0] == 0
+
+            fork = vm.fork()
+            Soldier.get_by_id(fork, 1).armor
+            assert fork.heap.columns.columns['Soldier/armor'].get(1) == 1
+            fork.heap.columns.set(fork.heap.columns.columns['Soldier/armor'], 1, 5)
+            assert s1.armor == 1
+
+    def test_columnar_memory(self):
+
+        import gc
+
+        def measure(model):
+            with VM('simple_game_test') as vm:
+                b = Board(vm, width=20, height=20)
+                vm.commit()
+                gc.collect()
+                tracemalloc.start()
+                for i in range(2000):
+                    model(vm, n_units=1, attack_dmg=3, armor=1, health=10, action=10, position=(1, 1), board=b)
+                vm.commit()
+                # only the heap is measured, the commit history holds every instantiation as well
+                vm.commits.clear()
+                gc.collect()
+                with_undo = tracemalloc.get_traced_memory()[0]
+                vm.heap.collapse()
+                gc.collect()
+                collapsed = tracemalloc.get_traced_memory()[0]
+                tracemalloc.stop()
+                return with_undo / 2000.0, collapsed / 2000.0
+
+        print('heap bytes per instance (revertible, collapsed), Infantry: %i, %i, Soldier (columnar): %i, %i' % (
+            measure(Infantry) + measure(Soldier)
+        ))
+
+    def test_attribute_performance(self):
+
+        for heap_class in (Heap, FlatHeap):
+            with VM('simple_game_test', heap_class=heap_class) as vm:
+                i = Infantry(
+                    vm,
+                    n_units=1,
+                    attack_dmg=1,
+                    armor=0,
+                    health=1,
+                    action=10,
+                    position=(1, 1),
+                    board=Board(vm, width=20, height=20)
+                )
+                vm.commit()
+
+                gets, sets = [], []
+                for _ in range(5):
+                    a = time.time()
+                    for _ in range(20000):
+                        i.health
+                    b = time.time()
+
+                    i._to_user_changing_state()
+                    for n in range(20000):
+                        i.health = n
+                    c = time.time()
+                    i._to_normal_state()
+                    gets.append(b - a)
+                    sets.append(c - b)
+
+                assert i.health == 19999
+                print('%s attributes: %i gets/s, %i sets/s' % (heap_class.__name__, 20000 / min(gets), 20000 / min(sets)))
+
+    def test_member_instruction_performance(self):
+
+        with VM('simple_game_test', compaction=CompactionPolicy(keep=1, batch=1)) as vm:
+            i = Infantry(
+                vm,
+                n_units=1,
+                attack_dmg=1,
+                armor=0,
+                health=1,
+                action=10 ** 9,
+                position=(1, 1),
+                board=Board(vm, width=20, height=20)
+            )
+            vm.commit()
+
+            # calls through the mnemonic form, as member instructions used to run
+            def mnemonic_move(x, y):
+                vm.execute_from_mnemonic([Infantry.move(i, x, y).mnemonize()])
+
+            times = {}
+            for name, move in (('mnemonic', mnemonic_move), ('direct', i.move)):
+                a = time.time()
+                for n in range(5000):
+                    move(1 + n % 2, 1)
+                    if n % 10 == 9:
+                        vm.commit()
+                times[name] = time.time() - a
+                assert i.position == (2, 1)
+                assert i._state == DatamodelStates.NORMAL
+
+            print('member instruction calls: %i/s through the mnemonic form, %i/s direct' % (
+                5000 / times['mnemonic'], 5000 / times['direct']))
+
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,188 @@
+# coding: utf-8
+__author__ = 'salvia'
+
+from .codec import BinaryCodec
+from .builtin_instructions import BeginTransaction
+from .vm import LocalVM, Commit
+
+
+class TransactionConflict(Exception):
+    pass
+
+
+class _ColumnReads(object):
+    """
+        Column of a TransactionHeap: records the cells read, as heap addresses.
+    """
+
+    __slots__ = ('column', 'reads')
+
+    def __init__(self, column, reads):
+        self.column = column
+        self.reads = reads
+
+    def get(self, id):
+        self.reads.add(self.column.address(id))
+        return self.column.get(id)
+
+    def __getattr__(self, item):
+        return getattr(self.column, item)
+
+
+class _ColumnStoreReads(object):
+    """
+        ColumnStore of a TransactionHeap, handing out columns which record their reads.
+    """
+
+    def __init__(self, store, reads):
+        self._store = store
+        self._reads = reads
+        # column key -> _ColumnReads
+        self.columns = {}
+
+    def _wrap(self, column):
+        wrapped = self.columns.get(column.key)
+        if wrapped is None:
+            wrapped = self.columns[column.key] = _ColumnReads(column, self._reads)
+        return wrapped
+
+    def column(self, model_name, attr_name, typecode, cast):
+        return self._wrap(self._store.column(model_name, attr_name, typecode, cast))
+
+    def set(self, column, id, value):
+        self._store.set(column.column, id, value)
+
+    def delete(self, column, id):
+        self._store.delete(column.column, id)
+
+    def __getattr__(self, item):
+        return getattr(self._store, item)
+
+
+class TransactionHeap(object):
+    """
+        Heap of a Transaction: a private fork of the committed heap which records the addresses read through it,
+        column cells included, in `reads`. Writes and everything else go straight to the fork.
+    """
+
+    def __init__(self, heap):
+        self._heap = heap
+        self.reads = set()
+        self.columns = _ColumnStoreReads(heap.columns, self.reads)
+        for column in heap.columns.columns.values():
+            self.columns._wrap(column)
+
+    def get(self, item, default=None):
+        self.reads.add(item)
+        return self._heap.get(item, default)
+
+    def __getitem__(self, item):
+        self.reads.add(item)
+        return self._heap[item]
+
+    def __setitem__(self, key, value):
+        self._heap[key] = value
+
+    def __delitem__(self, key):
+        del self._heap[key]
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __getattr__(self, item):
+        return getattr(self._heap, item)
+
+
+class Transaction(LocalVM):
+    """
+        Optimistic transaction on a LocalVM, started with vm.transaction(). It stands for the VM: models are fetched
+        or created with the transaction in place of the vm, and their instructions run on a private fork of the
+        state committed when it began, recording the heap addresses they read. Any number of transactions can be
+        open at once, and prepared in different threads.
+        commit() checks that no commit made since the transaction began wrote an address it read or wrote, so
+        writes made without reading the address first (e.g. a destroy) are not lost either, then applies
+        its writes to the VM as a single commit holding its instructions, so replaying that commit gives the same
+        state. Otherwise it raises TransactionConflict and the transaction is dropped, as with rollback().
+        Reads of the instance and spatial indexes (e.g. Model.objects(txn)) are not recorded. Beginning a
+        transaction forks the heap, which costs O(1) with a PersistentHeap and a copy of the heap otherwise.
+    """
+
+    def __init__(self, vm):
+        self.__dict__.update(vm.__dict__)
+        self.vm = vm
+        # commit index and generation (see LocalVM.transaction) the transaction began at
+        self.start = vm.commit_index
+        self.generation = vm._generation
+        self.heap = TransactionHeap(vm.heap.fork())
+        self.workspace = None
+        self.savepoints = []
+        self.commits = vm.commits.fork(self)
+        self.rewound = []
+        self.compaction = None
+        self.commit_log = None
+        self.snapshots = None
+        self.history = None
+        self.versions = None
+        self.snapshot_reads = False
+        self.snapshot = None
+        self.binary_codec = BinaryCodec(self)
+        self.finished = False
+
+    def conflicts(self):
+        """
+            Returns the addresses read or written by the transaction and written by the VM since it began.
+        """
+        vm = self.vm
+        accessed = self.heap.reads.union(self.heap.changes.old)
+        if vm._generation != self.generation:
+            return accessed
+        versions = vm.versions
+        start = self.start
+        return {address for address in accessed if versions.get(address, 0) > start}
+
+    def begin_transaction(self):
+        if self.finished:
+            raise Exception('Transaction already committed or rolled back.')
+        # hashed by the VM when committed, as the chain head may have moved by then. The fork needs no checkpoint,
+        # the whole transaction is dropped on rollback
+        self.workspace = Commit(self.chain_head, 0)
+        self.workspace.append(BeginTransaction())
+
+    def commit(self):
+        if self.finished:
+            raise Exception('Transaction already committed or rolled back.')
+        self.finished = True
+        vm = self.vm
+        with vm._transaction_lock:
+            vm._transactions -= 1
+            try:
+                if vm.workspace:
+                    raise Exception('Cannot commit a transaction with an uncomitted transaction (dirty workspace).')
+                conflicts = self.conflicts()
+                if conflicts:
+                    raise TransactionConflict('Addresses used by the transaction were changed: %s' % (
+                        ', '.join(sorted(str(a) for a in conflicts)[:10]), ))
+                if not self.workspace:
+                    return
+                writes = self.heap.changes.take()
+                vm.begin_transaction()
+                vm._write_values(writes.addresses, writes.new)
+                vm.workspace.extend(list(self.workspace)[1:])
+                vm.commit()
+            finally:
+                vm._track_versions()
+
+    def rollback(self):
+        """
+            Drops the transaction.
+        """
+        if not self.finished:
+            vm = self.vm
+            with vm._transaction_lock:
+                vm._transactions -= 1
+                vm._track_versions()
+        self.finished = True
+        self.workspace = None
+
+    def transaction(self):
+        raise Exception('Transactions cannot be nested.')
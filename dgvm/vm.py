@@ -2,16 +2,26 @@
 __author__ = 'salvia'
 
 import os
+import copy
 import hashlib
 import json
+import pickle
 import random
-from collections import deque
+import struct
+import tempfile
+import threading
+from array import array
+from collections import deque, OrderedDict
 from functools import partial
 
-from .datamodel.meta import DatamodelMeta
-from .data_structures import Heap
+from .codec import BinaryCodec, MARKER, encode_delta, decode_delta
+from .commit_log import CorruptLogError
+from .compiler import compile_instructions
+from .datamodel.meta import DatamodelMeta, DatamodelStates
+from .data_structures import Heap, PersistentHeap, ChangeLog, Heap_Nothing
+from .history import CommitIndex, CorruptIndexError
 from .ipc.client import BaseIPCClient
-from .instruction import InvalidInstruction, MemberInstructionWrapper
+from .instruction import InvalidInstruction, MemberInstruction, MemberInstructionWrapper
 from .ipc.server import BaseIPCServer
 from .builtin_instructions import *
 from .datamodel import InvalidModel, Datamodel
@@ -24,29 +34,38 @@ def file_here(file):
 
 
 class Commit(object):
-
-    def __init__(self):
-        self.__has_valid_hash = False
-        self.__hash = None
+    """
+        The instructions of a transaction. The hash of a commit covers the hash of the previous commit, given as
+        `previous`, and then each instruction, fed to an incremental sha256 as it is appended, so the hash of the
+        last commit stands for the whole history (see LocalVM.chain_head) and hashing a commit costs nothing more
+        than encoding each of its instructions once.
+        A commit built with a `known_hash` does not hash its instructions and just returns that hash.
+        `undo` is the UndoRecord of the commit's writes, kept by VMs created with undo_records=True.
+        `delta` is the (addresses, values) write set of the commit, Heap_Nothing deleting an address, kept by VMs
+        created with delta_commits=True (see LocalVM.apply_delta).
+    """
+
+    def __init__(self, previous=0, known_hash=None):
+        self.previous = previous
+        self.__hash = known_hash
+        self.__hasher = None
+        if known_hash is None:
+            self.__hasher = hashlib.sha256(('%064x\n' % (previous, )).encode('ascii'))
         self.__diff = deque()
+        self.undo = None
+        self.delta = None
 
     def calc_hash(self):
-        if not self.__has_valid_hash:
-            pre_str = deque()
-            for instruction in self.__diff:
-                pre_str.append(instruction.mnemonize())
-
-            pre_str = '\n'.join(pre_str)
-            pre_str = pre_str.encode('utf-8')
-            self.__hash = int(hashlib.sha256(pre_str).hexdigest(), 16)
-            self.__has_valid_hash = True
+        if self.__hash is None:
+            self.__hash = int(self.__hasher.copy().hexdigest(), 16)
         return self.__hash
 
     def append(self, item):
         if not isinstance(item, Instruction):
             raise ValueError('Commit item must be of type Instruction, not ' + type(item).__name__)
-        self.__has_valid_hash = False
-        self.__hash = None
+        if self.__hasher is not None:
+            self.__hasher.update((item.mnemonize() + '\n').encode('utf-8'))
+            self.__hash = None
         self.__diff.append(item)
 
     def extend(self, items):
@@ -56,14 +75,38 @@ class Commit(object):
         for item in items:
             self.append(item)
 
-    def dumps(self):
+    def mark(self):
+        """
+            Returns what truncate() needs to take the commit back to its current instructions and hash.
+        """
+        return len(self.__diff), self.__hash, None if self.__hasher is None else self.__hasher.copy()
+
+    def truncate(self, mark):
+        """
+            Drops the instructions appended since mark() returned `mark`.
+        """
+        n, self.__hash, hasher = mark
+        diff = self.__diff
+        while len(diff) > n:
+            diff.pop()
+        if hasher is not None:
+            self.__hasher = hasher.copy()
+
+    def dumps(self, codec=None):
+        """
+            Serializes the commit to JSON text, or to bytes with a codec such as dgvm.codec.BinaryCodec.
+        """
+        if codec is not None:
+            return codec.encode(self)
         return json.dumps([i._mnemonize() for i in self.__diff])
 
     @classmethod
-    def loads(cls, vm, dump):
-        dat = json.loads(dump)
-        c = Commit()
-        c.extend([Instruction._load(vm, d) for d in dat])
+    def loads(cls, vm, dump, previous=0, known_hash=None):
+        c = Commit(previous, known_hash)
+        if isinstance(dump, bytes):
+            c.extend(vm.binary_codec.loads(dump))
+        else:
+            c.extend([Instruction._load(vm, d) for d in json.loads(dump)])
         return c
 
     def __len__(self):
@@ -89,10 +132,205 @@ class Commit(object):
 
 _LIVE_VMS = {}
 
+# first byte after the hashes of a record carrying the commit's delta, followed by the size of the encoded delta
+_DELTA = b'\x01'
+_DELTA_SIZE = struct.Struct('>I')
+
+
+def encode_record(commit, codec=None):
+    """
+        Commit log record of a commit: the hash of the previous commit and its own, in hex, followed by
+        Commit.dumps(codec). The delta of the commit, when it has one, is put between the two, encoded by
+        dgvm.codec.encode_delta().
+    """
+    dump = commit.dumps(codec)
+    if codec is None:
+        dump = dump.encode('utf-8')
+    head = ('%064x%064x' % (commit.previous, commit.calc_hash())).encode('ascii')
+    if commit.delta is None:
+        return head + dump
+    delta = encode_delta(commit.delta)
+    return head + _DELTA + _DELTA_SIZE.pack(len(delta)) + delta + dump
+
+
+def decode_record(record):
+    """
+        Returns (previous commit hash, commit hash, dump) of a record made by encode_record. The dump is JSON text,
+        or bytes for binary encoded commits. Records holding only a JSON dump, as written by older versions, give
+        None for both hashes.
+    """
+    return _decode_record(record)[:3]
+
+
+def _decode_record(record):
+    """
+        decode_record() followed by the encoded delta of the record (see dgvm.codec.decode_delta), or None.
+    """
+    if record[:1] == b'[':
+        return None, None, record.decode('utf-8'), None
+    dump = record[128:]
+    delta = None
+    if dump[:1] == _DELTA:
+        end = 1 + _DELTA_SIZE.size + _DELTA_SIZE.unpack_from(dump, 1)[0]
+        delta = dump[1 + _DELTA_SIZE.size:end]
+        dump = dump[end:]
+    if dump[:1] != MARKER:
+        dump = dump.decode('utf-8')
+    return int(record[:64], 16), int(record[64:128], 16), dump, delta
+
+
+class Savepoint(object):
+    """
+        Point of the workspace returned by LocalVM.savepoint(): the heap checkpoint it made, the Commit.mark() of
+        the workspace and the number of addresses in the heap's ChangeLog at that time.
+    """
+
+    __slots__ = ('workspace', 'depth', 'mark', 'changes')
+
+    def __init__(self, workspace, depth, mark, changes):
+        self.workspace = workspace
+        self.depth = depth
+        self.mark = mark
+        self.changes = changes
+
+
+class CommitStore(object):
+    """
+        Commit history of a LocalVM, indexed like a list from the oldest commit it holds. Only the newest
+        `resident` commits stay in memory: older ones are spilled to a temporary file in `spill_dir`, binary encoded
+        (see dgvm.codec) together with their undo records, and loaded back on access into an LRU cache of the last
+        `cache` ones read. resident=None keeps every commit in memory.
+        Loaded commits reference the model instances of the current state, like the commits read from a commit log.
+    """
+
+    def __init__(self, vm, resident=None, spill_dir=None, cache=64):
+        if resident is not None and resident < 1:
+            raise ValueError('resident must be >= 1 or None')
+        self.vm = vm
+        self.resident = resident
+        self.spill_dir = spill_dir
+        self.cache = cache
+        self._commits = deque()
+        # offset of each spilled commit in the spill file, and the end of the last one
+        self._offsets = array('q')
+        self._end = 0
+        self._file = None
+        # spilled commit index -> Commit, least recently used first
+        self._lru = OrderedDict()
+
+    def fork(self, vm):
+        """
+            Returns an empty CommitStore with the same settings, for `vm`.
+        """
+        return CommitStore(vm, self.resident, self.spill_dir, self.cache)
+
+    def spilled(self):
+        """
+            Number of commits held in the spill file.
+        """
+        return len(self._offsets)
+
+    def append(self, commit):
+        self._commits.append(commit)
+        if self.resident is not None and len(self._commits) > self.resident:
+            self._spill(self._commits.popleft())
+
+    def _spill(self, commit):
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(dir=self.spill_dir)
+        data = pickle.dumps((encode_record(commit, self.vm.binary_codec), commit.undo), pickle.HIGHEST_PROTOCOL)
+        self._file.seek(self._end)
+        self._file.write(data)
+        self._offsets.append(self._end)
+        self._end += len(data)
+
+    def _load(self, i):
+        commit = self._lru.get(i)
+        if commit is not None:
+            self._lru.move_to_end(i)
+            return commit
+        start = self._offsets[i]
+        end = self._offsets[i + 1] if i + 1 < len(self._offsets) else self._end
+        self._file.seek(start)
+        record, undo = pickle.loads(self._file.read(end - start))
+        previous, commit_hash, dump, delta = _decode_record(record)
+        commit = Commit.loads(self.vm, dump, previous, commit_hash)
+        commit.undo = undo
+        if delta is not None:
+            commit.delta = decode_delta(delta)
+        self._lru[i] = commit
+        if len(self._lru) > self.cache:
+            self._lru.popitem(last=False)
+        return commit
+
+    def pop(self):
+        if self._commits:
+            return self._commits.pop()
+        if not self._offsets:
+            raise IndexError('pop from an empty CommitStore')
+        i = len(self._offsets) - 1
+        commit = self._load(i)
+        del self._lru[i]
+        self._end = self._offsets.pop()
+        return commit
+
+    def clear(self):
+        self._commits.clear()
+        self._offsets = array('q')
+        self._end = 0
+        self._lru.clear()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __len__(self):
+        return len(self._offsets) + len(self._commits)
+
+    def __getitem__(self, item):
+        n = len(self)
+        if item < 0:
+            item += n
+        if not 0 <= item < n:
+            raise IndexError('commit index out of range')
+        spilled = len(self._offsets)
+        if item >= spilled:
+            return self._commits[item - spilled]
+        return self._load(item)
+
+    def __iter__(self):
+        for i in range(len(self._offsets)):
+            yield self._load(i)
+        for commit in self._commits:
+            yield commit
+
+
+class CompactionPolicy(object):
+    """
+        Heap compaction policy for LocalVM. After each commit, once more than `keep + batch` checkpoints are
+        stacked in the heap, everything older than the last `keep` checkpoints is merged into the base layer.
+        Merging in batches amortizes the cost of a merge over `batch` commits.
+    """
+
+    def __init__(self, keep=16, batch=16):
+        if keep < 0 or batch < 1:
+            raise ValueError('keep must be >= 0 and batch must be >= 1')
+        self.keep = keep
+        self.batch = batch
+
+    def __call__(self, vm):
+        # only called with a clean workspace, so every checkpoint belongs to a finished commit
+        if vm.heap.depth() > self.keep + self.batch:
+            vm.heap.collapse(self.keep)
+
 
 class LocalVM(object):
 
-    def __init__(self, definitions_package):
+    def __init__(self, definitions_package, heap_class=Heap, compaction=None, heap_concurrency='lock',
+                 snapshot_reads=False, heap_hashed=False, commit_log=None, snapshots=None, commit_codec='json',
+                 compiled=True, undo_records=False, history_index=False, resident_commits=None, spill_dir=None,
+                 delta_commits=False):
 
         self.instructions_pack = __import__(definitions_package + '.instructions')
         self.datamodels_pack = __import__(definitions_package + '.datamodels')
@@ -104,17 +342,75 @@ class LocalVM(object):
         self.load_instructions()
         self.load_datamodels()
 
+        # constructors and executors generated for each instruction class (see dgvm.compiler), or {} to only
+        # interpret them. Instructions added later are interpreted
+        self.compiled = compile_instructions(definitions_package, self.instructions['opcodes'].values()) \
+            if compiled else {}
+
+        # encoding of instructions by opcode (see dgvm.codec.BinaryCodec)
+        self.binary_codec = BinaryCodec(self)
+
         # initialize heap (16k starting size)
-        self.heap = Heap(16384)
+        self.heap = heap_class(16384, heap_concurrency, heap_hashed)
+        # every commit keeps the UndoRecord of its writes, so rewind_to() and fast_forward() can move through them
+        self.undo_records = undo_records
+        # every commit keeps its delta, written to the commit log with it, so replicas can apply_delta() it
+        self.delta_commits = delta_commits
+        if undo_records or delta_commits:
+            self.heap.changes = self.heap.attach(ChangeLog(self.heap))
+        # address -> commit index of its last write, kept while transactions are open (see dgvm.transaction)
+        self.versions = None
+        # number of open transactions
+        self._transactions = 0
+        # bumped whenever the state changes other than by a commit, which invalidates the open transactions
+        self._generation = 0
+        self._transaction_lock = threading.RLock()
 
         # temporary state of the commit. may be reversed or permanently commited
         self.workspace = None
-        # commit history
-        self.commits = deque()
+        # Savepoints of the workspace, oldest first (see savepoint())
+        self.savepoints = []
+        # commit history (see CommitStore), keeping the newest resident_commits in memory and spilling the older
+        # ones to a file in spill_dir
+        self.commits = CommitStore(self, resident_commits, spill_dir)
+        # commits undone by rewind_to(), the newest first, until fast_forward() or a new commit
+        self.rewound = []
+        # CommitIndex of the commits by model instance and opcode, queried with find_commits()
+        self.history = CommitIndex() if history_index else None
+
+        # heap compaction policy (see CompactionPolicy), called after every commit
+        self.compaction = compaction
+
+        # number of commits made since the history began, and the hash of the last one, which chains all of them
+        # (see Commit)
+        self.commit_index = 0
+        self.chain_head = 0
+
+        # durable log of the commits (see dgvm.commit_log.CommitLog), or None to only keep them in memory
+        self.commit_log = commit_log
+        # encoding of the commits in the log, 'json' or 'binary'. Logs can mix both
+        self.commit_codec = commit_codec
+        self.get_codec(commit_codec)
+        # heap snapshots (see dgvm.snapshots.SnapshotStore), written every snapshots.every commits, replayed ones
+        # included
+        self.snapshots = snapshots
+        self._replaying = False
+
+        # read-only snapshot of the last committed state (see refresh_snapshot), readable while a writer works on
+        # the next transaction. It is retaken at every commit, which only a PersistentHeap does in O(1)
+        if snapshot_reads and not isinstance(self.heap, PersistentHeap):
+            raise ValueError('snapshot_reads needs heap_class=PersistentHeap, other heaps copy the whole heap at '
+                             'every commit to take the snapshot.')
+        self.snapshot_reads = snapshot_reads
+        self.snapshot = None
+        self.refresh_snapshot()
 
         # debugging
         self.verbose = False
 
+        if commit_log is not None:
+            self.recover()
+
     def load_datamodels(self):
         models = deque()
         for k, model in self.datamodels_pack.datamodels.__dict__.items():
@@ -139,13 +435,15 @@ class LocalVM(object):
                 BeginTransaction.opcode: BeginTransaction,
                 EndTransaction.opcode: EndTransaction,
                 InstantiateModel.opcode: InstantiateModel,
-                DestroyInstance.opcode: DestroyInstance
+                DestroyInstance.opcode: DestroyInstance,
+                CollapseHeap.opcode: CollapseHeap
             },
             'mnemonics': {
                 BeginTransaction.mnemonic: BeginTransaction,
                 EndTransaction.mnemonic: EndTransaction,
                 InstantiateModel.mnemonic: InstantiateModel,
-                DestroyInstance.mnemonic: DestroyInstance
+                DestroyInstance.mnemonic: DestroyInstance,
+                CollapseHeap.mnemonic: CollapseHeap
             }
         }
         for k, v in self.instructions_pack.instructions.__dict__.items():
@@ -167,6 +465,17 @@ class LocalVM(object):
     def get_model(self, name):
         return self.datamodels_idx[name]
 
+    def get_codec(self, name):
+        """
+            Codec for Commit.dumps() by name: None for 'json', the default encoding, or self.binary_codec for
+            'binary'.
+        """
+        if name == 'json':
+            return None
+        if name == 'binary':
+            return self.binary_codec
+        raise ValueError('Unknown codec %s' % (name, ))
+
     def validate_instruction(self, instruction):
 
         def fmt(desc):
@@ -191,7 +500,9 @@ class LocalVM(object):
         """
         if self.workspace:
             raise Exception('Cannot begin transaction with an uncomitted transaction (dirty workspace).')
-        self.workspace = Commit()
+        if self.rewound and self.commit_log is not None:
+            raise Exception('Cannot begin transaction on a rewound VM with a commit log, fast_forward() first.')
+        self.workspace = Commit(self.chain_head)
         self.workspace.append(BeginTransaction())
         self.heap.checkpoint()
 
@@ -208,14 +519,23 @@ class LocalVM(object):
         if not self.workspace:
             self.begin_transaction()
 
+        compiled = self.compiled
         for instruction in instructions:
-            instruction(self)
+            c = compiled.get(type(instruction))
+            if c is None:
+                instruction(self)
+            else:
+                c.run(self, instruction)
         self.workspace.extend(instructions)
 
     def execute_from_mnemonic(self, mnemonic_forms):
 
         self.execute([Instruction.load(self, mnemonic_form) for mnemonic_form in mnemonic_forms])
 
+    def execute_from_binary(self, data):
+
+        self.execute(self.binary_codec.loads(data))
+
     def execute_member_instruction(self, mnemonic, model_instance, args, kwargs):
         i = self.get_instruction(mnemonic=mnemonic)
         m = self.get_model(model_instance[0])
@@ -225,30 +545,580 @@ class LocalVM(object):
 
     def commit(self):
         if self.workspace:
-            self.workspace.calc_hash()
-            self.commits.append(self.workspace)
+            if self.savepoints:
+                self.release(self.savepoints[0])
+            commit = self.workspace
+            commit.calc_hash()
+            self._take_undo(commit)
+            self.commits.append(commit)
+            if self.rewound and self.history is not None:
+                self.history.truncate(self.commit_index)
+            self.rewound = []
             self.end_transaction()
+            self.commit_index += 1
+            self.chain_head = commit.calc_hash()
+            if self.history is not None:
+                self.history.add_commit(self.commit_index, commit)
+            if self.commit_log is not None and not self._replaying:
+                self.commit_log.append(encode_record(commit, self.get_codec(self.commit_codec)))
+            if self.compaction:
+                self.compaction(self)
+            self._write_due_snapshot()
+            self.refresh_snapshot()
+            if self.versions is not None and not self._transactions:
+                self._track_versions()
+
+    def _write_due_snapshot(self):
+        if self.snapshots is not None and self.snapshots.due(self.commit_index) and \
+                not self.snapshots.has(self.commit_index):
+            self.snapshots.write(self.heap, self.commit_index, self.chain_head)
+            if self.history is not None and self.commit_log is not None:
+                self.save_history()
 
     def rollback(self):
+        if self.savepoints:
+            self._revert_to(self.savepoints[0])
+            self.savepoints = []
         if self.workspace:
             self.workspace = self.commits.pop()
         self.heap.revert()
+        if self.heap.changes is not None:
+            self.heap.changes.clear()
+        self.refresh_snapshot()
+
+    def savepoint(self):
+        """
+            Returns a Savepoint of the workspace, beginning a transaction if none is open. rollback_to() takes the
+            workspace back to it, and release() drops it. Savepoints nest: rolling back to, or releasing, one of
+            them also drops the savepoints made after it. They are dropped on commit and rollback.
+        """
+        if not self.workspace:
+            self.begin_transaction()
+        changes = self.heap.changes
+        self.heap.checkpoint()
+        savepoint = Savepoint(self.workspace, self.heap.depth(), self.workspace.mark(),
+                              None if changes is None else len(changes.old))
+        self.savepoints.append(savepoint)
+        return savepoint
+
+    def _find_savepoint(self, savepoint):
+        for i in range(len(self.savepoints) - 1, -1, -1):
+            if self.savepoints[i] is savepoint:
+                return i
+        raise ValueError('Unknown savepoint, it was released, rolled back over or its transaction ended.')
+
+    def _revert_to(self, savepoint):
+        heap = self.heap
+        while heap.depth() >= savepoint.depth:
+            heap.revert()
+        if heap.changes is not None:
+            heap.changes.forget(savepoint.changes)
+
+    def rollback_to(self, savepoint):
+        """
+            Takes the workspace back to `savepoint`: reverts the writes made since, which costs as much as those
+            writes, and drops the instructions recorded since. The savepoint stays usable.
+        """
+        i = self._find_savepoint(savepoint)
+        del self.savepoints[i + 1:]
+        self._revert_to(savepoint)
+        self.heap.checkpoint()
+        self.workspace.truncate(savepoint.mark)
+
+    def release(self, savepoint):
+        """
+            Drops `savepoint`, and the ones made after it, keeping the writes made since. Costs as much as those
+            writes with a Heap or FlatHeap, O(1) with a PersistentHeap.
+        """
+        i = self._find_savepoint(savepoint)
+        del self.savepoints[i:]
+        heap = self.heap
+        while heap.depth() >= savepoint.depth:
+            heap.merge()
+
+    def _take_undo(self, commit):
+        changes = self.heap.changes
+        if changes is None:
+            return
+        undo = changes.take()
+        if self.versions is not None:
+            position = self.commit_index + 1
+            versions = self.versions
+            for address in undo.addresses:
+                versions[address] = position
+        if self.undo_records:
+            # a commit reopened by rollback() keeps the writes it made before
+            commit.undo = undo if commit.undo is None else commit.undo.merge(undo)
+        if self.delta_commits:
+            if commit.delta is None:
+                commit.delta = (undo.addresses, undo.new)
+            else:
+                values = dict(zip(*commit.delta))
+                values.update(zip(undo.addresses, undo.new))
+                commit.delta = (tuple(values), tuple(values.values()))
+
+    def transaction(self):
+        """
+            Returns a new dgvm.transaction.Transaction on the committed state. Transactions are optimistic: any
+            number of them can be open at once, and each one is checked for conflicts when committed.
+        """
+        from .transaction import Transaction
+        with self._transaction_lock:
+            if self.workspace:
+                raise Exception('Cannot begin a transaction with an uncomitted transaction (dirty workspace).')
+            if self.versions is None:
+                if self.heap.changes is None:
+                    self.heap.changes = self.heap.attach(ChangeLog(self.heap))
+                self.versions = {}
+            self._transactions += 1
+            return Transaction(self)
+
+    def _track_versions(self):
+        """
+            Stops keeping self.versions once no transaction is open and the workspace is clean, and detaches the
+            heap's ChangeLog unless undo_records or delta_commits need it. transaction() starts them over.
+        """
+        with self._transaction_lock:
+            if self._transactions or self.versions is None or self.workspace:
+                return
+            self.versions = None
+            if not (self.undo_records or self.delta_commits):
+                del self.heap.attachments[ChangeLog.name]
+                self.heap.changes = None
+
+    def rewind_to(self, n):
+        """
+            Takes the state back to right after commit `n` (see commit_index) by writing back the previous values
+            of the addresses written by the commits after it, newest first, so it costs as much as those writes
+            rather than a replay. The undone commits leave self.commits for self.rewound, and fast_forward() redoes
+            them until a new commit is made. Needs a VM created with undo_records=True, whose self.commits holds
+            the commits after `n`.
+        """
+        if self.workspace:
+            raise Exception('Cannot rewind with an uncomitted transaction (dirty workspace).')
+        k = self.commit_index - n
+        if k < 0:
+            raise ValueError('Cannot rewind forward to commit %i, use fast_forward()' % (n, ))
+        commits = self.commits
+        if k > len(commits) or any(commits[-i].undo is None for i in range(1, k + 1)):
+            raise ValueError('No undo records to rewind to commit %i' % (n, ))
+        if not k:
+            return
+        self.heap.collapse()
+        for _ in range(k):
+            commit = commits.pop()
+            self._write_values(commit.undo.addresses, commit.undo.old)
+            self.rewound.append(commit)
+        self.commit_index = n
+        self.chain_head = commit.previous
+        self.heap.changes.clear()
+        self._generation += 1
+        self.refresh_snapshot()
+
+    def fast_forward(self, n=None):
+        """
+            Redoes the commits undone by rewind_to(), up to commit `n`, or all of them. Costs as much as their
+            writes.
+        """
+        top = self.commit_index + len(self.rewound)
+        if n is None:
+            n = top
+        if self.workspace:
+            raise Exception('Cannot fast forward with an uncomitted transaction (dirty workspace).')
+        if not self.commit_index <= n <= top:
+            raise ValueError('Cannot fast forward to commit %i, the rewound commits go up to %i' % (n, top))
+        if n == self.commit_index:
+            return
+        self.heap.collapse()
+        while self.commit_index < n:
+            commit = self.rewound.pop()
+            self._write_values(commit.undo.addresses, commit.undo.new)
+            self.commits.append(commit)
+            self.commit_index += 1
+            self.chain_head = commit.calc_hash()
+        self.heap.changes.clear()
+        self._generation += 1
+        self.refresh_snapshot()
+
+    def refresh_snapshot(self):
+        """
+            Retakes vm.snapshot from the current heap when the VM was created with snapshot_reads=True.
+            Called at every commit and rollback, so readers of the snapshot see the last committed state.
+        """
+        if self.snapshot_reads:
+            self.snapshot = self.heap.snapshot()
+
+    def replay(self, dump):
+        """
+            Executes and commits a commit serialized with Commit.dumps(), without writing it to the commit log.
+        """
+        commit = Commit.loads(self, dump)
+        self.execute([i for i in commit if not isinstance(i, (BeginTransaction, EndTransaction))])
+        self._replaying = True
+        try:
+            self.commit()
+        finally:
+            self._replaying = False
+
+    def recover(self):
+        """
+            Rebuilds the state from the newest snapshot, when there is one, and the commits logged after it.
+            Called when the VM is created with a commit_log. Only the replayed commits end up in self.commits.
+        """
+        start = 0
+        if self.snapshots is not None:
+            for index in reversed(self.snapshots.indexes()):
+                if index <= len(self.commit_log):
+                    self.chain_head, items = self.snapshots.read(index)
+                    self.restore_items(items)
+                    start = self.commit_index = index
+                    break
+        if self.history is not None:
+            self._recover_history(start)
+        self.replay_stream(self.commit_log.read(start))
+
+    def apply_delta(self, record):
+        """
+            Commits a commit log record carrying a delta, as written by VMs created with delta_commits=True, by
+            writing the delta to the heap instead of executing the instructions, which costs as much as the writes
+            whatever the instructions compute. The columns, spatial indexes and instance index follow the writes.
+            Returns the commit.
+        """
+        if _decode_record(record)[3] is None:
+            raise ValueError('The record carries no delta')
+        self.replay_stream([record])
+        return self.get_last_commit()
+
+    def replay_stream(self, records, batch_size=256, verify=False, deltas=True, trusted=False):
+        """
+            Replays a stream of commit log records (see encode_record) and returns how many were replayed. Much
+            faster than calling replay() for each one:
+            - JSON records are decoded a batch at a time, binary ones (see dgvm.codec) one by one
+            - the commits are applied straight to the base layer of the heap, without checkpoints, so the heap
+              is collapsed first and the replayed commits cannot be rolled back
+            - model instances are fetched once and reused by every instruction referencing them. With
+              trusted=True the instructions also run without the attribute constraint checks, which they passed
+              when first executed; only pass it for records known to come from a VM running the same models
+            - the stored hash of a commit is used without recomputing it, once the stored hash of the commit before
+              it is checked to be the current chain head. The log's crc32 guards the contents of the records;
+              pass verify=True to rehash every commit, which verifies the whole history in the same pass.
+            - records carrying a delta (see apply_delta) are applied by writing it rather than executing their
+              instructions, unless deltas=False. The hash of a commit covers its instructions, not its delta.
+            A record which does not follow the current chain head, or whose hash does not check out, raises
+            CorruptLogError.
+        """
+        if self.workspace:
+            raise Exception('Cannot replay with an uncomitted transaction (dirty workspace).')
+        self.heap.collapse()
+        if self.rewound and self.history is not None:
+            self.history.truncate(self.commit_index)
+        self.rewound = []
+
+        # (model name, id) -> model instance
+        proxies = {}
+        self._replaying = True
+        n = 0
+        try:
+            batch = []
+            for record in records:
+                batch.append(_decode_record(record))
+                if len(batch) == batch_size:
+                    n += self._replay_batch(batch, proxies, verify, deltas, trusted)
+                    batch = []
+            if batch:
+                n += self._replay_batch(batch, proxies, verify, deltas, trusted)
+        finally:
+            self.workspace = None
+            self._replaying = False
+            for proxy in proxies.values():
+                proxy._to_normal_state()
+            self.refresh_snapshot()
+        return n
+
+    def _replay_batch(self, batch, proxies, verify, deltas, trusted):
+        mnemonics = self.instructions['mnemonics']
+        # the instructions run straight on the instances, which check the values set on them unless trusted
+        state = DatamodelStates.ENGINE_CHANGING if trusted else DatamodelStates.USER_CHANGING
+        models = self.datamodels_idx
+        skip = (BeginTransaction, EndTransaction)
+        # instructions executed by the replayed ones go to a throwaway commit, as they are in the records already
+        self.workspace = Commit()
+        self.workspace.append(BeginTransaction())
+
+        def resolve(model, id):
+            key = (model.__name__, id)
+            proxy = proxies.get(key)
+            if proxy is None:
+                proxy = proxies[key] = model.get_by_id(self, id)
+                proxy._state = state
+            return proxy
+
+        def deserialize(a):
+            if isinstance(a, list) and len(a) == 2:
+                if a[0] == 'DatamodelMeta':
+                    return models[a[1]]
+                if a[0] in models:
+                    return resolve(models[a[0]], a[1])
+            return a
+
+        def from_json(parts):
+            for p in parts:
+                cls = mnemonics[p[0]]
+                if len(p) != cls.n_args + 1:
+                    raise InvalidInstruction('Cannot load mnemonic form: %s' % (p, ))
+                yield cls, tuple(deserialize(a) for a in p[1:])
+
+        begin, end = BeginTransaction(), EndTransaction()
+        json_dumps = iter(json.loads('[%s]' % (','.join(d for _, _, d, _ in batch if not isinstance(d, bytes)), )))
+        for previous, commit_hash, dump, delta in batch:
+            if previous is not None and previous != self.chain_head:
+                raise CorruptLogError('Commit %i does not follow the chain head' % (self.commit_index + 1, ))
+            if isinstance(dump, bytes):
+                instructions = self.binary_codec.decode(dump, resolve)
+            else:
+                instructions = from_json(next(json_dumps))
+            instructions = [(cls, args) for cls, args in instructions if cls not in skip]
+            # the commit is built and checked before any of it runs, so a rejected record leaves the state alone
+            commit = Commit(self.chain_head, None if verify else commit_hash)
+            commit.append(begin)
+            for cls, args in instructions:
+                commit.append(cls._unchecked(args))
+            commit.append(end)
+            if commit_hash is not None and commit.calc_hash() != commit_hash:
+                raise CorruptLogError('Wrong hash for commit %i' % (self.commit_index + 1, ))
+
+            execute = delta is None or not deltas
+            for cls, args in instructions:
+                if issubclass(cls, MemberInstruction):
+                    if execute:
+                        cls.execute(*args)
+                else:
+                    if execute:
+                        cls.execute(self, *args)
+                    if cls is DestroyInstance:
+                        proxy = proxies.pop((args[0].__name__, args[1]), None)
+                        if proxy is not None:
+                            proxy._state = DatamodelStates.DESTROYED
+            if not execute:
+                self._write_values(*decode_delta(delta))
+
+            self._take_undo(commit)
+            self.commits.append(commit)
+            self.commit_index += 1
+            self.chain_head = commit.calc_hash()
+            if self.history is not None:
+                self.history.add_commit(self.commit_index, commit)
+            self._write_due_snapshot()
+        return len(batch)
+
+    def restore_items(self, items):
+        """
+            Loads (address, value) pairs, as yielded by heap.iter_items(), into the empty heap. Attribute values go
+            back to their columns and spatial indexes, and the instance index is rebuilt from the ids.
+        """
+        heap = self.heap
+        ids = {}
+        for k, v in items:
+            model, attr, id = self._route(k)
+            if attr is None:
+                heap[k] = v
+                continue
+            if attr.columnar:
+                heap.columns.set(attr._column(self), id, v)
+            else:
+                heap[k] = v
+            if attr.spatial_index:
+                heap.spatial.move(attr._column_key, attr.spatial_index, id, v)
+            if attr.name == '_id':
+                ids.setdefault(model.__name__, []).append(id)
+        for name, model_ids in ids.items():
+            for id in sorted(model_ids):
+                heap.instances.add(name, id)
+        if heap.changes is not None:
+            heap.changes.clear()
+        self._generation += 1
+        self.refresh_snapshot()
+
+    def _route(self, address):
+        """
+            Returns (model, attribute, id) of an attribute address, or (None, None, None).
+        """
+        parts = address.split('/') if isinstance(address, str) else ()
+        model = self.datamodels_idx.get(parts[0]) if len(parts) == 4 and parts[1] == 'O' else None
+        attr = model._vmattrs.get(parts[3]) if model else None
+        if attr is None:
+            return None, None, None
+        return model, attr, int(parts[2])
+
+    def _write_values(self, addresses, values):
+        """
+            Writes the values of an UndoRecord or of a commit's delta, Heap_Nothing deleting the address, along with
+            the columns, spatial indexes and instance index which follow them.
+        """
+        heap = self.heap
+        for k, v in zip(addresses, values):
+            model, attr, id = self._route(k)
+            if attr is not None and attr.columnar:
+                if v is Heap_Nothing:
+                    heap.columns.delete(attr._column(self), id)
+                else:
+                    heap.columns.set(attr._column(self), id, v)
+            elif v is Heap_Nothing:
+                heap.delete(k)
+            else:
+                heap[k] = v
+            if attr is None:
+                continue
+            if attr.spatial_index:
+                heap.spatial.move(attr._column_key, attr.spatial_index, id, None if v is Heap_Nothing else v)
+            if attr.name == '_id':
+                if v is Heap_Nothing:
+                    heap.instances.discard(model.__name__, id)
+                else:
+                    heap.instances.add(model.__name__, id)
+
+    def _history_path(self, path):
+        if path is not None:
+            return path
+        if self.commit_log is None:
+            raise ValueError('No path given for the commit index, and no commit log to keep it beside')
+        return os.path.join(self.commit_log.path, 'commits.idx')
+
+    def save_history(self, path=None):
+        """
+            Saves self.history to `path`, by default beside the commit log, where recover() picks it up. Also done
+            with every snapshot written.
+        """
+        self.history.save(self._history_path(path), self.chain_head)
+
+    def _recover_history(self, start):
+        """
+            Loads the saved history index, unless the commit log no longer holds the commit it ends with, and
+            indexes the logged commits from there to `start`, where the replay begins.
+        """
+        path = self._history_path(None)
+        history = None
+        if os.path.exists(path):
+            try:
+                history, chain_head = CommitIndex.load(path)
+            except CorruptIndexError:
+                history = None
+            else:
+                if history.position > len(self.commit_log):
+                    history = None
+                elif history.position and \
+                        decode_record(self.commit_log.get(history.position - 1))[1] not in (chain_head, None):
+                    history = None
+        self.history = history or CommitIndex()
+        self._index_records(self.commit_log.read(self.history.position), start)
+
+    def _index_records(self, records, end):
+        position = self.history.position
+        for record in records:
+            if position >= end:
+                break
+            position += 1
+            self.history.add_dump(self, position, decode_record(record)[2])
+
+    def rebuild_history(self):
+        """
+            Rebuilds self.history in one pass over the commit log, or over self.commits without one, and returns
+            it.
+        """
+        self.history = CommitIndex()
+        if self.commit_log is not None:
+            self._index_records(self.commit_log.read(), self.commit_index)
+        else:
+            first = self.commit_index - len(self.commits)
+            for i, commit in enumerate(self.commits):
+                self.history.add_commit(first + i + 1, commit)
+        return self.history
+
+    def get_commit(self, position):
+        """
+            Returns the commit at `position` (1 for the first one, see commit_index), from self.commits or else
+            from the commit log. Raises KeyError when neither holds it.
+        """
+        first = self.commit_index - len(self.commits) + 1
+        if first <= position <= self.commit_index:
+            return self.commits[position - first]
+        if self.commit_log is not None and 0 < position <= min(len(self.commit_log), self.commit_index):
+            previous, commit_hash, dump = decode_record(self.commit_log.get(position - 1))
+            return Commit.loads(self, dump, previous or 0)
+        raise KeyError(position)
+
+    def find_commits(self, model=None, id=None, opcode=None, reverse=False):
+        """
+            Returns an iterator over the (position, commit) pairs of the commits which touched a model instance
+            and/or ran an opcode (see CommitIndex.find), oldest first or newest first with reverse=True. Commits
+            are only fetched as the iterator reaches them, e.g. the last commit which touched Board 2 is
+            next(vm.find_commits(Board, 2, reverse=True)). Needs a VM created with history_index=True.
+        """
+        if self.history is None:
+            raise ValueError('find_commits() needs a VM created with history_index=True')
+        positions = self.history.find(model, id, opcode, reverse, self.commit_index)
+        return ((position, self.get_commit(position)) for position in positions)
 
     def get_last_commit(self):
         return self.commits[-1]
 
-    def get_last_commit_dump(self):
-        return self.get_last_commit().dumps()
+    def get_last_commit_dump(self, codec='json'):
+        return self.get_last_commit().dumps(self.get_codec(codec))
 
     def get_current_commit(self):
         return self.workspace
 
-    def get_current_commit_dump(self):
-        return self.get_current_commit().dumps()
+    def get_current_commit_dump(self, codec='json'):
+        return self.get_current_commit().dumps(self.get_codec(codec))
+
+    def get_last_commit_record(self, codec='json'):
+        """
+            encode_record() of the last commit: its dump along with the hash it chains to and its own, so that a
+            client can load it with Commit.loads(vm, dump, previous) and check it hashes the same.
+        """
+        return encode_record(self.get_last_commit(), self.get_codec(codec))
+
+    def get_current_commit_record(self, codec='json'):
+        if self.workspace is None:
+            return None
+        return encode_record(self.workspace, self.get_codec(codec))
 
     def heap_size(self):
         return len(self.heap)
 
+    def state_hash(self):
+        """
+            Hash of the current state (see BaseHeap.state_hash). O(1) when the VM was created with heap_hashed=True.
+        """
+        return self.heap.state_hash()
+
+    def fork(self):
+        """
+            Returns an independent LocalVM at the current state of this one, sharing its definitions.
+            The fork starts with an empty commit history, kept in memory only: it has no commit log nor snapshots.
+            With a PersistentHeap, forking costs O(1) and the heaps share every address neither of them changed
+            afterwards.
+        """
+        if self.workspace:
+            raise Exception('Cannot fork with an uncomitted transaction (dirty workspace).')
+        vm = copy.copy(self)
+        vm.commit_log = None
+        vm.snapshots = None
+        vm.compaction = copy.copy(self.compaction)
+        vm.binary_codec = BinaryCodec(vm)
+        vm.heap = self.heap.fork()
+        vm.commits = self.commits.fork(vm)
+        vm.rewound = []
+        vm.savepoints = []
+        vm.history = CommitIndex() if self.history is not None else None
+        vm.versions = {} if self.versions is not None else None
+        vm._transactions = 0
+        vm._transaction_lock = threading.RLock()
+        # the transactions open on this VM are not the fork's
+        vm._track_versions()
+        vm.refresh_snapshot()
+        return vm
+
     def __enter__(self):
         return self
 
@@ -270,13 +1140,28 @@ class RemoteHeap(object):
         return self.rvm.heap_size()
 
 
+class RemoteHeapSnapshot(object):
+
+    def __init__(self, rvm):
+
+        self.rvm = rvm
+
+    def __getattr__(self, item):
+        client_idx = random.randint(0, self.rvm.nclients - 1)
+        return partial(self.rvm.clients[client_idx].vm_call_on_snapshot, self.rvm.definitions_package, item)
+
+
 class RemoteVM(object):
+    """
+        Client of a LocalVM served in another process. Commits and instructions travel in `codec`, 'json' or
+        'binary' (see LocalVM.get_codec).
+    """
 
-    def __init__(self, definitions_package):
+    def __init__(self, definitions_package, codec='json', **vm_options):
 
-        def make_vm(definitions_package):
+        def make_vm(definitions_package, **vm_options):
 
-            _LIVE_VMS[definitions_package] = LocalVM(definitions_package)
+            _LIVE_VMS[definitions_package] = LocalVM(definitions_package, **vm_options)
 
         def vm_call(definitions_package, fn, *args, **kwargs):
 
@@ -286,37 +1171,58 @@ class RemoteVM(object):
 
             return getattr(_LIVE_VMS[definitions_package].heap, fn)(*args, **kwargs)
 
+        def vm_call_on_snapshot(definitions_package, fn, *args, **kwargs):
+
+            return getattr(_LIVE_VMS[definitions_package].snapshot, fn)(*args, **kwargs)
+
         self.definitions_package = definitions_package
         self.server = BaseIPCServer()
         self.server.register_functor(make_vm, 'make_vm')
         self.server.register_functor(vm_call, 'vm_call')
         self.server.register_functor(vm_call_on_heap, 'vm_call_on_heap')
+        self.server.register_functor(vm_call_on_snapshot, 'vm_call_on_snapshot')
+        self.vm_options = vm_options
         self.clients = []
         self.started = False
         self.nclients = 5
         self.heap = RemoteHeap(self)
+        self.snapshot = RemoteHeapSnapshot(self)
         self._local_vm = LocalVM(definitions_package)
+        self.codec = codec
+        self._codec = self._local_vm.get_codec(codec)
+
+    def _load_record(self, record):
+        if record is None:
+            return None
+        previous, known_hash, dump = decode_record(record)
+        commit = Commit.loads(self._local_vm, dump, previous)
+        if commit.calc_hash() != known_hash:
+            raise ValueError('Commit received does not match its hash %x.' % (known_hash, ))
+        return commit
 
     def get_last_commit(self):
 
-        dump = self.clients[0].vm_call(self.definitions_package, 'get_last_commit_dump')
+        record = self.clients[0].vm_call(self.definitions_package, 'get_last_commit_record', self.codec)
 
-        return Commit.loads(self._local_vm, dump)
+        return self._load_record(record)
 
     def get_current_commit(self):
 
-        dump = self.clients[0].vm_call(self.definitions_package, 'get_current_commit_dump')
+        record = self.clients[0].vm_call(self.definitions_package, 'get_current_commit_record', self.codec)
 
-        return Commit.loads(self._local_vm, dump)
+        return self._load_record(record)
 
     def execute(self, instrs):
 
-        self.execute_from_mnemonic([instr.mnemonize() for instr in instrs])
+        if self._codec is not None:
+            self.execute_from_binary(self._codec.encode(instrs))
+        else:
+            self.execute_from_mnemonic([instr.mnemonize() for instr in instrs])
 
     def startup(self):
         self.server.startup()
         self.clients = [BaseIPCClient() for _ in range(self.nclients)]
-        self.clients[0].make_vm(self.definitions_package)
+        self.clients[0].make_vm(self.definitions_package, **self.vm_options)
         self.started = False
 
     def shutdown(self):
@@ -331,11 +1237,15 @@ class RemoteVM(object):
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.shutdown()
 
+    def diff_state(self, vm):
+        """
+            Returns the heap addresses whose values differ between the served VM and `vm`, a local mirror of it.
+            Only the hashes of the subtrees which differ are fetched. Both VMs must be created with heap_hashed=True.
+        """
+        if self.state_hash() == vm.state_hash():
+            return []
+        return vm.heap.diff(self.heap)
+
     def __getattr__(self, item):
         client_idx = random.randint(0, self.nclients - 1)
         return partial(self.clients[client_idx].vm_call, self.definitions_package, item)
-
-#TODO: implement commit log/history
-#TODO: implement serialization of heap and commit logs
-#TODO: implement VM compilation
-